@@ -0,0 +1,258 @@
+## USAGE: python misc/e2e_bench.py --backends HaproxySubprocess,AsyncioRelay --dataset 0.5 --output report.json
+## Runs a producer and a consumer S2CS on this machine (no SSL, no auth),
+## negotiates a stream between them with the s2uc functions and pushes
+## pub_bench.py traffic through it to sub_bench.py, once per S2DS backend:
+##
+##   pub_bench -> PROD S2DS (inbound) -> CONS S2DS (outbound) -> sub_bench
+##
+## The JSON report has, per backend, the setup latency of each side, the
+## throughput, jitter, efficiency and one-way latency (timestamped samples)
+## measured by sub_bench and the CPU time spent by S2CS and its proxies per
+## GB streamed.
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent import futures
+from optparse import OptionParser
+from pathlib import Path
+
+import grpc
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from src import utils
+from src.proto import scistream_pb2, scistream_pb2_grpc
+from src.s2uc import client_request, hello_request, update, wait_for_reservation
+
+BACKENDS = ["HaproxySubprocess", "StunnelSubprocess", "NginxSubprocess", "AsyncioRelay"]
+BINARIES = {"HaproxySubprocess": "haproxy", "StunnelSubprocess": "stunnel", "NginxSubprocess": "nginx"}
+SCOPE = "e2e-bench"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def parseOptions():
+    "Parse command line options"
+    parser = OptionParser()
+    parser.add_option("--backends", dest="backends", default=",".join(BACKENDS), help="Comma-separated S2DS types")
+    parser.add_option("--size", dest="size", type=int, default=1024, help="Sample size in bytes")
+    parser.add_option("--dataset", dest="dataset", type=float, default=1, help="Dataset size in Gbytes")
+    parser.add_option("--repeat", dest="repeat", type=int, default=1, help="Runs per backend")
+    parser.add_option("--base-port", dest="base_port", type=int, default=15000, help="First port used by the benchmark")
+    parser.add_option("--timeout", dest="timeout", type=float, default=600, help="Seconds allowed for a transfer")
+    parser.add_option("--output", dest="output", default="e2e_bench.json", help="JSON report file")
+    (options, args) = parser.parse_args()
+    return options, args
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue
+        ## utime and stime are fields 14 and 15 of /proc/pid/stat
+        total += int(fields[11]) + int(fields[12])
+    return total / CLOCK_TICKS
+
+
+def side_pids(root_pid, marker):
+    """S2CS and every process it started, proxies that daemonize are found by their config dir"""
+    children = {}
+    pids = set()
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            cmdline = (entry / "cmdline").read_bytes().decode(errors="replace")
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+        children.setdefault(int(stat[1]), []).append(int(entry.name))
+        if marker in cmdline:
+            pids.add(int(entry.name))
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.add(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+class Side:
+    """One S2CS started as a separate process, with its own config directory"""
+
+    def __init__(self, role, backend, port, port_range, workdir):
+        self.role = role
+        self.port = port
+        self.config_dir = Path(workdir) / role.lower()
+        self.config_dir.mkdir()
+        env = dict(os.environ, HAPROXY_CONFIG_PATH=str(self.config_dir), PYTHONPATH=str(ROOT))
+        self.proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "src.s2cs",
+                "--listener_ip=127.0.0.1", f"--port={port}", f"--port_range={port_range}",
+                f"--type={backend}", "--ssl=False", '--client_secret=""',
+            ],
+            cwd=self.config_dir,
+            env=env,
+            stdout=open(self.config_dir / "s2cs.log", "w"),
+            stderr=subprocess.STDOUT,
+        )
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        grpc.channel_ready_future(self.channel).result(timeout=30)
+        self.stub = scistream_pb2_grpc.ControlStub(self.channel)
+
+    def pids(self):
+        return side_pids(self.proc.pid, str(self.config_dir))
+
+    def negotiate(self, uid, num_conn, receivers, hello_role, remote_listeners):
+        """REQ, HELLO then UPDATE, returns the REQ response and the setup latency"""
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            req = executor.submit(client_request, self.stub, uid, self.role, num_conn, 0, scope_id=SCOPE)
+            wait_for_reservation(self.stub, [uid], scope_id=SCOPE)
+            hello_request(self.stub, uid, hello_role, receivers, scope_id=SCOPE)
+            response = req.result(timeout=30)
+        if response is None:
+            raise RuntimeError(f"{self.role} request failed, see {self.config_dir / 's2cs.log'}")
+        update(self.stub, uid, remote_listeners or list(response.prod_listeners), self.role, scope_id=SCOPE)
+        return response, time.perf_counter() - start
+
+    def release(self, uid):
+        metadata = (("authorization", utils.get_access_token(SCOPE)),)
+        self.stub.release(scistream_pb2.Release(uid=uid), metadata=metadata)
+
+    def stop(self):
+        self.channel.close()
+        self.proc.terminate()
+        self.proc.wait(timeout=10)
+        ## proxies that outlived S2CS, daemonized haproxy for instance
+        for pid in side_pids(self.proc.pid, str(self.config_dir)) - {self.proc.pid}:
+            try:
+                os.kill(pid, 15)
+            except ProcessLookupError:
+                pass
+
+
+def run(backend, opts, workdir, ports):
+    pub_port, sync_port, prod_port, cons_port, prod_range, cons_range = ports
+    uid = str(uuid.uuid1())
+    prod = cons = None
+    publisher = subscriber = None
+    try:
+        prod = Side("PROD", backend, prod_port, prod_range, workdir)
+        cons = Side("CONS", backend, cons_port, cons_range, workdir)
+        producer = [f"127.0.0.1:{pub_port}", f"127.0.0.1:{sync_port}"]
+        prod_resp, prod_setup = prod.negotiate(uid, 2, producer, "PROD", None)
+        cons_resp, cons_setup = cons.negotiate(uid, 2, producer, "PROD", list(prod_resp.listeners))
+
+        publisher = subprocess.Popen(
+            [
+                sys.executable, str(ROOT / "misc" / "pub_bench.py"), "--port", str(pub_port),
+                "--sync", str(sync_port), "--size", str(opts.size), "--dataset", str(opts.dataset),
+                "--timestamps",
+            ],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        wait_port(pub_port)
+        cons_host, cons_pub = cons_resp.listeners[0].rsplit(":", 1)
+        cons_sync = cons_resp.listeners[1].rsplit(":", 1)[1]
+        results_log = Path(workdir) / f"{backend}.log"
+        hist_file = Path(workdir) / f"{backend}.json"
+        pids = prod.pids() | cons.pids()
+        cpu_before = cpu_seconds(pids)
+        subscriber = subprocess.Popen(
+            [
+                sys.executable, str(ROOT / "misc" / "sub_bench.py"), "--remote-host", cons_host,
+                "--remote-port", cons_pub, "--sync", cons_sync, "--log-file", str(results_log),
+                "--hist-file", str(hist_file),
+            ],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        subscriber.wait(timeout=opts.timeout)
+        cpu = cpu_seconds(pids) - cpu_before
+        publisher.wait(timeout=30)
+        throughput, jitter, inter_message, efficiency = map(
+            float, results_log.read_text().strip().splitlines()[-1].split(",")
+        )
+        stats = json.loads(hist_file.read_text())
+        gigabytes = opts.size * int(opts.dataset * 10**9 / opts.size) * efficiency / 100 / 10**9
+        prod.release(uid)
+        cons.release(uid)
+        return {
+            "backend": backend,
+            "setup_latency_s": {"prod": prod_setup, "cons": cons_setup},
+            "throughput_gbps": throughput,
+            "jitter_s": jitter,
+            "inter_message_s": inter_message,
+            "efficiency_pct": efficiency,
+            "one_way_latency_s": stats["one_way_latency_s"],
+            "reordered": stats["reordered"],
+            "gigabytes": gigabytes,
+            "cpu_s": cpu,
+            "cpu_s_per_gb": cpu / gigabytes if gigabytes else None,
+        }
+    finally:
+        for proc in (subscriber, publisher):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+        for side in (cons, prod):
+            if side is not None:
+                side.stop()
+
+
+def main():
+    opts, args = parseOptions()
+    ## S2CS runs with an empty client secret, any token is accepted
+    utils._cache[SCOPE] = "mock-token"
+    base = opts.base_port
+    ports = (base, base + 1, base + 2, base + 3, f"{base + 100}-{base + 199}", f"{base + 200}-{base + 299}")
+    report = {
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {"size": opts.size, "dataset_gb": opts.dataset, "repeat": opts.repeat},
+        "results": [],
+    }
+    for backend in opts.backends.split(","):
+        binary = BINARIES.get(backend)
+        if binary and shutil.which(binary) is None:
+            report["results"].append({"backend": backend, "skipped": f"{binary} is not installed"})
+            print(f"{backend}: skipped, {binary} is not installed")
+            continue
+        for run_index in range(opts.repeat):
+            with tempfile.TemporaryDirectory(prefix=f"e2e-{backend}-") as workdir:
+                try:
+                    result = run(backend, opts, workdir, ports)
+                except Exception as e:
+                    result = {"backend": backend, "error": f"{type(e).__name__}: {e}"}
+            result["run"] = run_index
+            report["results"].append(result)
+            print(json.dumps(result))
+    Path(opts.output).write_text(json.dumps(report, indent=2))
+    print(f"Report written to {opts.output}")
+
+
+if __name__ == "__main__":
+    main()
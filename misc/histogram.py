@@ -0,0 +1,103 @@
+## Streaming latency histogram for the benchmarks, HDR style: values are
+## counted in log-linear buckets, so percentiles are within PRECISION of the
+## recorded values whatever the number of samples, in a fixed amount of memory.
+import math
+from array import array
+
+SUB_BUCKET_BITS = 11  # 2048 buckets per power of two
+PRECISION = 2.0 ** -(SUB_BUCKET_BITS - 1)  # relative error of a percentile, about 0.1%
+MAX_BITS = 44  # values up to 2**44 ns, about 4.9 hours
+
+
+def bucket_index(value):
+    if value < (1 << SUB_BUCKET_BITS):
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    return (1 << SUB_BUCKET_BITS) + (shift - 1) * half + ((value >> shift) - half)
+
+
+def bucket_value(index):
+    """Middle of the bucket"""
+    if index < (1 << SUB_BUCKET_BITS):
+        return index
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    shift = (index - (1 << SUB_BUCKET_BITS)) // half + 1
+    mantissa = (index - (1 << SUB_BUCKET_BITS)) % half + half
+    return (mantissa << shift) + (1 << (shift - 1))
+
+
+class Histogram:
+    """
+    Histogram of non-negative integers, nanoseconds in the benchmarks.
+
+    The mean and standard deviation are exact, from integer sums. Histograms
+    recorded by separate processes are combined with merge(), to_dict() and
+    from_dict() carry them across processes.
+    """
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * (bucket_index((1 << MAX_BITS) - 1) + 1)))
+        self.count = 0
+        self.total = 0
+        self.total_squares = 0
+
+    def record(self, value):
+        ## bucket_index inlined, this runs once per message
+        if value >= (1 << SUB_BUCKET_BITS):
+            if value >= (1 << MAX_BITS):
+                value = (1 << MAX_BITS) - 1
+            shift = value.bit_length() - SUB_BUCKET_BITS
+            self.counts[(shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)] += 1
+        else:
+            self.counts[value] += 1
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def stdev(self):
+        ## sample standard deviation, as statistics.stdev
+        if self.count < 2:
+            return 0.0
+        return math.sqrt((self.total_squares - self.total * self.total / self.count) / (self.count - 1))
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket_value(index)
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        return self
+
+    def to_dict(self):
+        return {
+            "buckets": {index: c for index, c in enumerate(self.counts) if c},
+            "count": self.count,
+            "total": self.total,
+            "total_squares": self.total_squares,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for index, bucket_count in data["buckets"].items():
+            histogram.counts[int(index)] = bucket_count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.total_squares = data["total_squares"]
+        return histogram
@@ -0,0 +1,267 @@
+## USAGE: python misc/load_bench.py --concurrency 1,2,4,8,16 --sessions 200 --type Mock --output load.json
+## Control plane load generator. For every concurrency level a fresh S2CS
+## (no SSL, no auth) is started and N simulated producer/consumer pairs
+## negotiate streams against it the way s2uc does:
+##
+##   req (held until HELLO) | watch until PORTS_RESERVED -> hello -> update -> release
+##
+## Reports sessions per second, p50/p99/p999 latency per RPC, the threads
+## and file descriptors of S2CS, and the first level where throughput
+## collapses. Each pair keeps up to 2 RPCs open per side (the pending req and
+## the watch), once more RPCs are in flight than --workers they queue. At
+## most half of --workers serve watches on the sync server, past that a pair
+## sleeps before HELLO as s2uc does.
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent import futures
+from optparse import OptionParser
+from pathlib import Path
+
+import grpc
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from src.proto import scistream_pb2, scistream_pb2_grpc
+from src.s2uc import HELLO_DELAY
+
+METADATA = (("authorization", "Bearer load-bench"),)
+
+RPCS = ["req", "reserved", "hello", "update", "release", "session"]
+
+
+def parseOptions():
+    "Parse command line options"
+    parser = OptionParser()
+    parser.add_option("--concurrency", dest="concurrency", default="1,2,4,8,16", help="Comma-separated numbers of concurrent pairs")
+    parser.add_option("--sessions", dest="sessions", type=int, default=200, help="Pairs negotiated per concurrency level")
+    parser.add_option("--type", dest="type", default="Mock", help="S2DS type of the S2CS under test")
+    parser.add_option("--num-conn", dest="num_conn", type=int, default=1, help="Connections per stream")
+    parser.add_option("--workers", dest="workers", type=int, default=10, help="S2CS server threads")
+    parser.add_option("--aio", dest="aio", action="store_true", default=False, help="Serve with grpc.aio")
+    parser.add_option("--port", dest="port", type=int, default=15500, help="S2CS control port")
+    parser.add_option("--port-range", dest="port_range", default="15600-16599", help="S2CS data ports")
+    parser.add_option("--rpc-timeout", dest="rpc_timeout", type=float, default=20, help="Deadline of every RPC in seconds")
+    parser.add_option("--output", dest="output", default=None, help="JSON report file")
+    (options, args) = parser.parse_args()
+    return options, args
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples"""
+    if not samples:
+        return None
+    index = max(0, min(len(samples) - 1, math.ceil(p / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+class ProcessSampler(threading.Thread):
+    """Samples the thread and file descriptor counts of a process"""
+
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.threads = []
+        self.fds = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with open(f"/proc/{self.pid}/status") as f:
+                    for line in f:
+                        if line.startswith("Threads:"):
+                            self.threads.append(int(line.split()[1]))
+                self.fds.append(len(os.listdir(f"/proc/{self.pid}/fd")))
+            except (FileNotFoundError, ProcessLookupError):
+                return
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return {
+            "threads_max": max(self.threads, default=None),
+            "fds_max": max(self.fds, default=None),
+        }
+
+
+class Server:
+    """S2CS under test, in its own process and config directory"""
+
+    def __init__(self, opts, workdir):
+        command = [
+            sys.executable, "-m", "src.s2cs", "--listener_ip=127.0.0.1", f"--port={opts.port}",
+            f"--port_range={opts.port_range}", f"--type={opts.type}", "--ssl=False",
+            '--client_secret=""', f"--workers={opts.workers}", f"--aio={opts.aio}",
+        ]
+        env = dict(os.environ, HAPROXY_CONFIG_PATH=workdir, PYTHONPATH=str(ROOT))
+        self.log = open(Path(workdir) / "s2cs.log", "w")
+        self.proc = subprocess.Popen(command, cwd=workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{opts.port}")
+        grpc.channel_ready_future(self.channel).result(timeout=30)
+        self.stub = scistream_pb2_grpc.ControlStub(self.channel)
+
+    def stop(self):
+        self.channel.close()
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {name: [] for name in RPCS}
+        self.errors = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def call(self, name, function, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except grpc.RpcError as e:
+            with self.lock:
+                key = f"{name}: {e.code().name}"
+                self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        with self.lock:
+            self.latencies[name].append(time.perf_counter() - start)
+        return result
+
+
+def wait_reserved(stub, uid, timeout):
+    try:
+        for event in stub.watch(scistream_pb2.WatchRequest(uid=uid), metadata=METADATA, timeout=timeout):
+            if event.state == scistream_pb2.SessionEvent.PORTS_RESERVED:
+                return event
+            if event.state in (scistream_pb2.SessionEvent.FAILED, scistream_pb2.SessionEvent.RELEASED):
+                raise RuntimeError(f"{uid} {scistream_pb2.SessionEvent.State.Name(event.state)}")
+    except grpc.RpcError as e:
+        ## every watch slot of the sync server is taken, wait like s2uc does
+        if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+            raise
+        time.sleep(HELLO_DELAY)
+
+
+def negotiate(stub, recorder, executor, role, num_conn, listeners, timeout):
+    """One side of a pair, returns the listeners of its proxy"""
+    uid = str(uuid.uuid1())
+    request = scistream_pb2.Request(uid=uid, role=role, num_conn=num_conn, rate=10000)
+    pending = executor.submit(recorder.call, "req", stub.req, request, metadata=METADATA, timeout=timeout)
+    recorder.call("reserved", wait_reserved, stub, uid, timeout)
+    hello = scistream_pb2.Hello(uid=uid, role="PROD", prod_listeners=listeners)
+    recorder.call("hello", stub.hello, hello, metadata=METADATA, timeout=timeout)
+    response = pending.result()
+    targets = scistream_pb2.UpdateTargets(uid=uid, remote_listeners=listeners, role=role)
+    recorder.call("update", stub.update, targets, metadata=METADATA, timeout=timeout)
+    recorder.call("release", stub.release, scistream_pb2.Release(uid=uid), metadata=METADATA, timeout=timeout)
+    return list(response.listeners)
+
+
+def pair(stub, recorder, executor, opts):
+    start = time.perf_counter()
+    producer = [f"127.0.0.1:{7000 + i}" for i in range(opts.num_conn)]
+    prod_listeners = negotiate(stub, recorder, executor, "PROD", opts.num_conn, producer, opts.rpc_timeout)
+    negotiate(stub, recorder, executor, "CONS", opts.num_conn, prod_listeners, opts.rpc_timeout)
+    with recorder.lock:
+        recorder.latencies["session"].append(time.perf_counter() - start)
+
+
+def run_level(opts, concurrency):
+    with tempfile.TemporaryDirectory(prefix="load-bench-") as workdir:
+        server = Server(opts, workdir)
+        sampler = ProcessSampler(server.proc.pid)
+        sampler.start()
+        recorder = Recorder()
+        failed = 0
+        ## one thread runs the pair, another keeps its blocking req open
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as clients, \
+                futures.ThreadPoolExecutor(max_workers=concurrency) as reqs:
+            start = time.perf_counter()
+            sessions = [clients.submit(pair, server.stub, recorder, reqs, opts) for _ in range(opts.sessions)]
+            for session in futures.as_completed(sessions):
+                if session.exception() is not None:
+                    failed += 1
+            elapsed = time.perf_counter() - start
+        usage = sampler.stop()
+        server.stop()
+    latencies = {}
+    for name, samples in recorder.latencies.items():
+        samples.sort()
+        latencies[name] = {
+            "count": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000 if samples else None,
+            "p99_ms": percentile(samples, 99) * 1000 if samples else None,
+            "p999_ms": percentile(samples, 99.9) * 1000 if samples else None,
+        }
+    return {
+        "concurrency": concurrency,
+        "sessions_per_s": (opts.sessions - failed) / elapsed,
+        "failed_sessions": failed,
+        "errors": recorder.errors,
+        "max_in_flight_rpcs": recorder.max_in_flight,
+        "latency": latencies,
+        **usage,
+    }
+
+
+def saturation(levels):
+    """First level that fails sessions or loses a fifth of the best throughput seen so far"""
+    best = 0
+    for level in levels:
+        if level["failed_sessions"] or level["sessions_per_s"] < best * 0.8:
+            return level["concurrency"]
+        best = max(best, level["sessions_per_s"])
+    return None
+
+
+def main():
+    opts, args = parseOptions()
+    levels = []
+    for concurrency in map(int, opts.concurrency.split(",")):
+        level = run_level(opts, concurrency)
+        levels.append(level)
+        session = level["latency"]["session"]
+        print(
+            f"{concurrency:>4} pairs  {level['sessions_per_s']:8.1f} sessions/s"
+            f"  session p50 {session['p50_ms'] or 0:8.1f} ms  p99 {session['p99_ms'] or 0:8.1f} ms"
+            f"  in flight {level['max_in_flight_rpcs']:>4}  threads {level['threads_max']}"
+            f"  fds {level['fds_max']}  failed {level['failed_sessions']}"
+        )
+    report = {
+        "parameters": {
+            "type": opts.type, "workers": opts.workers, "aio": opts.aio,
+            "sessions": opts.sessions, "num_conn": opts.num_conn,
+        },
+        "levels": levels,
+        "saturated_at": saturation(levels),
+    }
+    if report["saturated_at"] is None:
+        print("No saturation within the tested concurrency levels")
+    else:
+        print(f"Saturated at {report['saturated_at']} concurrent pairs ({opts.workers} workers, aio={opts.aio})")
+    if opts.output:
+        Path(opts.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
 ## USAGE: direct connection:
 # h2: python pub_bench.py --port 7000 --sync 17000
 # h4: python sub_bench.py --remote-host 172.16.1.1 --remote-port 7000 --sync 17000
-import time, hashlib, sys, zmq, logging, string, threading, queue
+## With --timestamps, sub_bench also reports one-way latency, loss and reordering
+## when both run on the same host.
+## With --procs N, N publishers bind --port + i and --sync + i and share the dataset:
+# h2: python pub_bench.py --port 7000 --sync 17000 --procs 4
+# h4: python sub_bench.py --remote-host 172.16.1.1 --remote-port 7000 --sync 17000 --procs 4
+import time, sys, zmq, logging, struct
+import multiprocessing
 from optparse import OptionParser
 
 logging.basicConfig(level=logging.INFO)
 
+## b"SciStream:" then kind, sequence number and CLOCK_MONOTONIC send time in ns.
+## Kind is b"T" for timestamped samples, sub_bench keeps reading b"a" samples
+## (untimed) and b"S" (STOP) as before.
+PREFIX = b"SciStream:"
+HEADER = struct.Struct("!cQQ")
+
 
 # Parse command line options and dump results
 def parseOptions():
@@ -22,7 +34,10 @@ def parseOptions():
         "--size", dest="size", type=int, default=1024, help="Sample size in bytes"
     )
     parser.add_option(
-        "--dataset", dest="dataset", type=int, default=10, help="Dataset size in Gbytes"
+        "--dataset", dest="dataset", type=float, default=10, help="Dataset size in Gbytes"
+    )
+    parser.add_option(
+        "--procs", dest="procs", type=int, default=1, help="Publisher processes"
     )
     parser.add_option(
         "--jitter",
@@ -31,50 +46,78 @@ def parseOptions():
         default=False,
         help="Reduce the generation rate to 1 KHz",
     )
+    parser.add_option(
+        "--timestamps",
+        dest="timestamps",
+        action="store_true",
+        default=False,
+        help="Send a sequence number and send time in every sample, to measure one-way latency on the same host",
+    )
     (options, args) = parser.parse_args()
 
     return options, args
 
 
-opts, args = parseOptions()
-samples = int(opts.dataset * (10**9) / opts.size)
-
-context = zmq.Context()
-
-sync_socket = context.socket(zmq.REP)
-sync_socket.bind("tcp://*:%s" % opts.sync)
-
-socket = context.socket(zmq.PUB)
-socket.set_hwm(0)
-socket.bind("tcp://*:" + opts.port)
-
-logging.info("SYNCing on port %s" % opts.sync)
-message = sync_socket.recv_string()
-logging.info("Received: %s" % message)
-sync_socket.send_string("%s, %s" % (opts.size, samples))
-logging.info("SYNCed")
-
-_msg = "SciStream:" + ("a" * opts.size)
-
-logging.info("Starting Publisher...")
-next_call = time.time()
-for i in range(samples):
-    socket.send_string(_msg)
-    if not (i % 10):
-        logging.debug("Produced sample %s" % i)
-    if opts.jitter:
-        next_call += 0.001
-        sleep_time = next_call - time.time()
-        if (
-            sleep_time > 0
-        ):  # If sleep_time is non-negative, then sleep for the remaining duration
-            time.sleep(sleep_time)
-
-socket.send_string(r"SciStream:STOP")
-logging.info("Streaming ended, exiting...")
-
-message = sync_socket.recv_string()
-logging.info("Received: %s" % message)
-sync_socket.send_string("FIN_ACK")
-logging.info("Bye, bye...")
-sys.exit(0)
+def publish(opts, index=0):
+    samples = int(opts.dataset * (10**9) / opts.size / opts.procs)
+
+    context = zmq.Context()
+
+    sync_socket = context.socket(zmq.REP)
+    sync_socket.bind("tcp://*:%s" % (int(opts.sync) + index))
+
+    socket = context.socket(zmq.PUB)
+    socket.set_hwm(0)
+    socket.bind("tcp://*:%s" % (int(opts.port) + index))
+
+    logging.info("SYNCing on port %s" % (int(opts.sync) + index))
+    message = sync_socket.recv_string()
+    logging.info("Received: %s" % message)
+    sync_socket.send_string("%s, %s" % (opts.size, samples))
+    logging.info("SYNCed")
+
+    ## one buffer for every sample, timestamped samples only rewrite the header
+    _msg = bytearray(PREFIX + b"a" * max(opts.size, HEADER.size if opts.timestamps else 0))
+    pack_into = HEADER.pack_into
+    clock = time.monotonic_ns
+
+    logging.info("Starting Publisher %s..." % index)
+    send = socket.send
+    next_call = time.time()
+    for i in range(samples):
+        if opts.timestamps:
+            pack_into(_msg, len(PREFIX), b"T", i, clock())
+        ## copied by zmq before the next sample rewrites the buffer
+        send(_msg, copy=True)
+        if opts.jitter:
+            next_call += 0.001
+            sleep_time = next_call - time.time()
+            if (
+                sleep_time > 0
+            ):  # If sleep_time is non-negative, then sleep for the remaining duration
+                time.sleep(sleep_time)
+
+    socket.send(b"SciStream:STOP")
+    logging.info("Streaming ended, exiting...")
+
+    message = sync_socket.recv_string()
+    logging.info("Received: %s" % message)
+    sync_socket.send_string("FIN_ACK")
+    context.destroy()
+
+
+if __name__ == "__main__":
+    opts, args = parseOptions()
+    if opts.procs == 1:
+        publish(opts)
+    else:
+        processes = [
+            multiprocessing.Process(target=publish, args=(opts, index))
+            for index in range(opts.procs)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    logging.info("Bye, bye...")
+    sys.exit(0)
@@ -0,0 +1,176 @@
+## USAGE: python misc/splice_bench.py --backends SpliceRelay,AsyncioRelay,HaproxySubprocess --size 2 --conns 2
+## Loopback throughput of the S2DS backends. For every backend a sink
+## process listens on --conns ports, the backend maps one local port to
+## each of them (PROD role, the haproxy.cfg.j2 layout) and a source process
+## pushes --size GB through them, split across the connections.
+##
+## Reports Gbps and the CPU seconds per GB spent by the backend: the
+## in-process relays are measured in this process, subprocess proxies with
+## their whole process tree. Backends whose binary is missing are skipped.
+import json
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+import multiprocessing
+from concurrent import futures
+from optparse import OptionParser
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+BINARIES = {"HaproxySubprocess": "haproxy", "NginxSubprocess": "nginx", "StunnelSubprocess": "stunnel"}
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def parseOptions():
+    "Parse command line options"
+    parser = OptionParser()
+    parser.add_option("--backends", dest="backends", default="SpliceRelay,AsyncioRelay,HaproxySubprocess", help="Comma-separated S2DS types")
+    parser.add_option("--size", dest="size", type=float, default=2, help="GB sent per run")
+    parser.add_option("--conns", dest="conns", type=int, default=2, help="Parallel connections, one per port")
+    parser.add_option("--bufsize", dest="bufsize", type=int, default=256 * 1024, help="Source and sink buffer size in bytes")
+    parser.add_option("--runs", dest="runs", type=int, default=3, help="Runs per backend, the median is reported")
+    parser.add_option("--output", dest="output", default=None, help="JSON report file")
+    (options, args) = parser.parse_args()
+    return options, args
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def sink(ports, received, conns, bufsize):
+    servers = [socket.create_server(("127.0.0.1", 0)) for _ in range(conns)]
+    ports.put([server.getsockname()[1] for server in servers])
+
+    def drain(server):
+        conn, _ = server.accept()
+        buf = bytearray(bufsize)
+        total = 0
+        with conn:
+            while True:
+                nbytes = conn.recv_into(buf)
+                if not nbytes:
+                    return total
+                total += nbytes
+
+    with futures.ThreadPoolExecutor(max_workers=conns) as executor:
+        received.put(sum(executor.map(drain, servers)))
+
+
+def source(ports, nbytes, bufsize):
+    payload = memoryview(bytearray(bufsize))
+
+    def send(port):
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            remaining = nbytes
+            while remaining:
+                remaining -= conn.send(payload[:min(bufsize, remaining)])
+
+    with futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        list(executor.map(send, ports))
+
+
+def descendants(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    found, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        found.append(current)
+        stack.extend(children.get(current, []))
+    return found
+
+
+def cpu_seconds(pids):
+    """User and system time of pids, of their descendants too except for this process"""
+    total = 0
+    for pid in pids:
+        ## the sink and source are children of this process
+        tree = [pid] if pid == os.getpid() else descendants(pid)
+        for member in tree:
+            try:
+                with open(f"/proc/{member}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return total
+
+
+def run(backend, opts):
+    from src.s2ds.s2ds import create_instance
+
+    nbytes = int(opts.size * 10**9 / opts.conns)
+    ports, received = multiprocessing.Queue(), multiprocessing.Queue()
+    sink_proc = multiprocessing.Process(target=sink, args=(ports, received, opts.conns, opts.bufsize))
+    sink_proc.start()
+    s2ds = create_instance(backend)
+    relay_ports = [free_port() for _ in range(opts.conns)]
+    entry = s2ds.start(opts.conns, "127.0.0.1", relay_ports)
+    try:
+        s2ds.update_listeners(
+            [f"127.0.0.1:{port}" for port in ports.get(timeout=10)], entry["s2ds_proc"], str(uuid.uuid4()), "PROD"
+        )
+        pids = {proc.pid for proc in entry["s2ds_proc"]}
+        cpu_start = cpu_seconds(pids)
+        start = time.perf_counter()
+        source_proc = multiprocessing.Process(target=source, args=(relay_ports, nbytes, opts.bufsize))
+        source_proc.start()
+        total = received.get()
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(pids) - cpu_start
+        source_proc.join()
+    finally:
+        s2ds.release(entry)
+        sink_proc.join(timeout=5)
+    return {
+        "gbps": 8 * total / elapsed / 10**9,
+        "cpu_s_per_gb": cpu / (total / 10**9),
+        "bytes": total,
+    }
+
+
+def main():
+    opts, args = parseOptions()
+    ## proxy configs and logs stay out of ~/.scistream
+    os.environ["HAPROXY_CONFIG_PATH"] = tempfile.mkdtemp(prefix="splice-bench-")
+    report = {"size_gb": opts.size, "conns": opts.conns, "backends": {}}
+    for backend in opts.backends.split(","):
+        binary = BINARIES.get(backend)
+        if binary and shutil.which(binary) is None:
+            print(f"Skipping {backend}, {binary} is not installed")
+            continue
+        runs = [run(backend, opts) for _ in range(opts.runs)]
+        report["backends"][backend] = {
+            "gbps": statistics.median(r["gbps"] for r in runs),
+            "cpu_s_per_gb": statistics.median(r["cpu_s_per_gb"] for r in runs),
+            "runs": runs,
+        }
+        print(
+            "%s: %.2f Gbps | %.3f CPU s/GB"
+            % (backend, report["backends"][backend]["gbps"], report["backends"][backend]["cpu_s_per_gb"])
+        )
+    shutil.rmtree(os.environ["HAPROXY_CONFIG_PATH"], ignore_errors=True)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
-import time, zmq, sys
+## USAGE: see pub_bench.py, with --procs N each subscriber process i connects
+## to --remote-port + i and --sync + i and the results are aggregated.
+import time, zmq, sys, json
 import logging
-import statistics
-from threading import Thread
+import multiprocessing
 from optparse import OptionParser
 
+from histogram import Histogram
+from pub_bench import HEADER, PREFIX
+
 logging.basicConfig(level=logging.INFO)
 
+STOP = ord("S")  # 11th byte of b"SciStream:STOP", data samples have "a" there
+TIMESTAMPED = ord("T")  # samples sent by pub_bench --timestamps
+
 
 # Parse command line options and dump results
 def parseOptions():
@@ -23,6 +30,15 @@ def parseOptions():
     parser.add_option(
         "--log-file", dest="fname", default="streaming_res.log", help="Log file name"
     )
+    parser.add_option(
+        "--hist-file",
+        dest="hist_fname",
+        default=None,
+        help="JSON file for the inter-message space percentiles and histogram",
+    )
+    parser.add_option(
+        "--procs", dest="procs", type=int, default=1, help="Subscriber processes"
+    )
     parser.add_option(
         "--pacing",
         dest="pacing",
@@ -38,82 +54,170 @@ def parseOptions():
     return options, args
 
 
-class Poller(Thread):
-    def __init__(self, id, topic):
-        super().__init__()
-        self.id = id
-        self.topic = topic
-
-    def run(self):
-        opts, args = parseOptions()
-        # Initialize log files
-        results_log = open(opts.fname, "a+")
-
-        context = zmq.Context()
-
-        sync_socket = context.socket(zmq.REQ)
-        sync_socket.connect("tcp://" + opts.host + ":" + opts.sync)
-
-        subscriber = context.socket(zmq.SUB)
-        subscriber.set_hwm(0)
-        subscriber.connect("tcp://" + opts.host + ":" + opts.port)
-        subscriber.setsockopt_string(zmq.SUBSCRIBE, self.topic)
-
-        logging.info("SYNCing with Publisher...")
-        sync_socket.send_string("SYNC")
-        resp = sync_socket.recv_string()
-        size = resp.split(",")[0]
-        samples = resp.split(",")[1]
-        logging.info("Expecting %s samples of %s bytes" % (samples, size))
-
-        logging.info("start poller {} with topic {}".format(self.id, self.topic))
-
-        count = 0
-        self.start = time.time()
-        inter_msg_space = []
-        while True:
-            # message = subscriber.recv_string()
-            message = subscriber.recv()
-            now = time.time()
-            if not (count % 10):
-                logging.debug(
-                    "{}: MSG {} @ local time {}".format(
-                        count, message[:11], time.strftime("%H:%M:%S")
-                    )
-                )
-            # if message == b'SciStream:STOP':
-            if message.decode("utf-8")[10] == "S":
-                t = t_last_msg - self.start
-                throughput = (8 * float(size) * count) / ((10**9) * t)
-                efficiency = 100 * count / float(samples)
-                avg_ims = statistics.mean(inter_msg_space)
-                jitter = statistics.stdev(inter_msg_space)
-                logging.info(
-                    "Elapsed: %s secs. | Throughput: %.3f Gbps | Jitter: %f | Inter-message Space: %f | Efficiency: %.2f%%"
-                    % (t, throughput, jitter, avg_ims, efficiency)
-                )
-                results_log.write(
-                    "%s,%s,%s,%s\n" % (throughput, jitter, avg_ims, efficiency)
-                )
-                results_log.flush()
-                results_log.close()
-                sync_socket.send_string("FIN")
-                resp = sync_socket.recv_string()
-                logging.info("Received reply: %s" % resp)
-                break
+def poll(opts, index=0, topic="SciStream"):
+    """Receives one publisher's stream, returns its counters and inter-message histogram"""
+    context = zmq.Context()
+
+    sync_socket = context.socket(zmq.REQ)
+    sync_socket.connect("tcp://%s:%s" % (opts.host, int(opts.sync) + index))
+
+    subscriber = context.socket(zmq.SUB)
+    subscriber.set_hwm(0)
+    subscriber.connect("tcp://%s:%s" % (opts.host, int(opts.port) + index))
+    subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+    logging.info("SYNCing with Publisher %s..." % index)
+    sync_socket.send_string("SYNC")
+    resp = sync_socket.recv_string()
+    size = int(resp.split(",")[0])
+    samples = int(resp.split(",")[1])
+    logging.info("Expecting %s samples of %s bytes" % (samples, size))
+
+    ## gaps and latencies in nanoseconds go to fixed size histograms instead of lists
+    inter_msg_space = Histogram()
+    latency = Histogram()
+    recv = subscriber.recv
+    record = inter_msg_space.record
+    record_latency = latency.record
+    unpack_from = HEADER.unpack_from
+    offset = len(PREFIX)
+    ## CLOCK_MONOTONIC, the publisher timestamps with the same clock
+    clock = time.monotonic_ns
+    count = 0
+    reordered = 0
+    next_seq = 0
+    start = clock()
+    t_last_msg = start
+    while True:
+        ## zero copy, the frame is only looked at, never decoded
+        frame = recv(copy=False)
+        now = clock()
+        buffer = frame.buffer
+        if buffer[offset] == TIMESTAMPED:
+            _, seq, sent = unpack_from(buffer, offset)
+            record_latency(now - sent)
+            if seq < next_seq:
+                reordered += 1
             else:
-                if count > 0:
-                    inter_msg_space.append(now - t_last_msg)
-                    t_last_msg = now
-                else:
-                    t_last_msg = now
-                count += 1
-                if opts.pacing:
-                    time.sleep(opts.st)
+                next_seq = seq + 1
+        elif buffer[offset] == STOP:
+            break
+        if count > 0:
+            record(now - t_last_msg)
+        t_last_msg = now
+        count += 1
+        if opts.pacing:
+            time.sleep(opts.st)
+
+    sync_socket.send_string("FIN")
+    resp = sync_socket.recv_string()
+    logging.info("Received reply: %s" % resp)
+    context.destroy()
+    return {
+        "size": size,
+        "samples": samples,
+        "count": count,
+        "elapsed": (t_last_msg - start) / 10**9,
+        "reordered": reordered,
+        "histogram": inter_msg_space.to_dict(),
+        "latency": latency.to_dict(),
+    }
+
+
+def aggregate(results):
+    """Combines the results of every subscriber, the streams ran side by side"""
+    histogram = Histogram()
+    latency = Histogram()
+    for result in results:
+        histogram.merge(Histogram.from_dict(result["histogram"]))
+        latency.merge(Histogram.from_dict(result["latency"]))
+    received = sum(result["size"] * result["count"] for result in results)
+    elapsed = max(result["elapsed"] for result in results)
+    return {
+        "throughput": (8 * received) / ((10**9) * elapsed) if elapsed else 0.0,
+        "efficiency": 100 * sum(r["count"] for r in results) / float(sum(r["samples"] for r in results)),
+        "elapsed": elapsed,
+        "histogram": histogram,
+        "latency": latency,
+        "lost": sum(result["samples"] - result["count"] for result in results),
+        "reordered": sum(result["reordered"] for result in results),
+    }
+
+
+def main():
+    opts, args = parseOptions()
+    if opts.procs == 1:
+        results = [poll(opts)]
+    else:
+        with multiprocessing.Pool(opts.procs) as pool:
+            results = pool.starmap(poll, [(opts, index) for index in range(opts.procs)])
+
+    summary = aggregate(results)
+    histogram = summary["histogram"]
+    ## seconds, as before
+    avg_ims = histogram.mean / 10**9
+    jitter = histogram.stdev() / 10**9
+    percentiles = {p: (histogram.percentile(p) or 0) / 10**9 for p in (50, 99, 99.9)}
+    logging.info(
+        "Elapsed: %s secs. | Throughput: %.3f Gbps | Jitter: %f | Inter-message Space: %f | Efficiency: %.2f%%"
+        % (summary["elapsed"], summary["throughput"], jitter, avg_ims, summary["efficiency"])
+    )
+    logging.info(
+        "Inter-message Space p50: %f | p99: %f | p99.9: %f"
+        % (percentiles[50], percentiles[99], percentiles[99.9])
+    )
+    latency = summary["latency"]
+    if latency.count:
+        logging.info(
+            "One-way latency p50: %f | p99: %f | p99.9: %f | max: %f | Lost: %s | Reordered: %s"
+            % tuple(
+                [(latency.percentile(p) or 0) / 10**9 for p in (50, 99, 99.9, 100)]
+                + [summary["lost"], summary["reordered"]]
+            )
+        )
+    with open(opts.fname, "a+") as results_log:
+        results_log.write(
+            "%s,%s,%s,%s\n" % (summary["throughput"], jitter, avg_ims, summary["efficiency"])
+        )
+    if opts.hist_fname:
+        with open(opts.hist_fname, "w") as f:
+            json.dump(
+                {
+                    "procs": opts.procs,
+                    "throughput_gbps": summary["throughput"],
+                    "efficiency_pct": summary["efficiency"],
+                    "inter_message_s": {
+                        "mean": avg_ims,
+                        "stdev": jitter,
+                        "p50": percentiles[50],
+                        "p99": percentiles[99],
+                        "p999": percentiles[99.9],
+                    },
+                    "histogram_ns": histogram.to_dict(),
+                    "one_way_latency_s": {
+                        "p50": (latency.percentile(50) or 0) / 10**9,
+                        "p99": (latency.percentile(99) or 0) / 10**9,
+                        "p999": (latency.percentile(99.9) or 0) / 10**9,
+                        "max": (latency.percentile(100) or 0) / 10**9,
+                    },
+                    "latency_histogram_ns": latency.to_dict(),
+                    "lost": summary["lost"],
+                    "reordered": summary["reordered"],
+                    "streams": [
+                        {
+                            "stream": index,
+                            "received": result["count"],
+                            "lost": result["samples"] - result["count"],
+                            "reordered": result["reordered"],
+                            "latency_p99_s": (Histogram.from_dict(result["latency"]).percentile(99) or 0) / 10**9,
+                        }
+                        for index, result in enumerate(results)
+                    ],
+                },
+                f,
+            )
 
 
 if __name__ == "__main__":
-    poller1 = Poller(1, "SciStream")
-    poller1.start()
-
+    main()
     sys.exit(0)
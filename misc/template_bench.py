@@ -0,0 +1,81 @@
+## USAGE: python misc/template_bench.py --streams 1000 --conn 4 --renders 20
+## Renders the shared HAProxy config (one frontend per connection of every
+## stream) the way S2DS did before the template registry, with a fresh
+## Environment per render, and through the registry.
+import sys
+import time
+import tempfile
+import statistics
+from optparse import OptionParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jinja2 import Environment, FileSystemLoader
+from src.s2ds.templates import TEMPLATE_DIR, TemplateRegistry
+
+
+def parseOptions():
+    "Parse command line options"
+    parser = OptionParser()
+    parser.add_option("--streams", dest="streams", type=int, default=1000, help="Streams in the config")
+    parser.add_option("--conn", dest="conn", type=int, default=4, help="Frontends per stream")
+    parser.add_option("--renders", dest="renders", type=int, default=20, help="Renders per method")
+    (options, args) = parser.parse_args()
+    return options, args
+
+
+def make_streams(num_streams, num_conn):
+    streams = {}
+    port = 5100
+    for i in range(num_streams):
+        uid = f"{i:08x}-a4d3-11ee-9fd6-034d1fcbd7c3"
+        streams[uid] = {
+            "local_ports": list(range(port, port + num_conn)),
+            "dest_array": [f"10.0.{i % 256}.1:{7000 + c}" for c in range(num_conn)],
+        }
+        port += num_conn
+    return streams
+
+
+def fresh_environment(context):
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return env.get_template("haproxy_shared.cfg.j2").render(**context)
+
+
+def timed(render, context, renders):
+    samples = []
+    for _ in range(renders):
+        start = time.perf_counter()
+        render(context)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    print(
+        f"{name:<22} median {statistics.median(samples) * 1000:8.2f} ms"
+        f"  min {min(samples) * 1000:8.2f} ms  max {max(samples) * 1000:8.2f} ms"
+    )
+
+
+opts, args = parseOptions()
+context = {
+    "streams": make_streams(opts.streams, opts.conn),
+    "pid_filename": "/tmp/haproxy.pid",
+    "stats_socket": "/tmp/haproxy.sock",
+}
+print(f"{opts.streams} streams, {opts.streams * opts.conn} frontends")
+
+report("fresh Environment", timed(fresh_environment, context, opts.renders))
+
+with tempfile.TemporaryDirectory() as bytecode_dir:
+    start = time.perf_counter()
+    registry = TemplateRegistry(bytecode_dir=bytecode_dir)
+    registry.preload()
+    print(f"{'registry preload':<22} {(time.perf_counter() - start) * 1000:8.2f} ms")
+    report("registry", timed(lambda ctx: registry.render("haproxy_shared.cfg.j2", **ctx), context, opts.renders))
+    ## a second process only loads the bytecode
+    start = time.perf_counter()
+    TemplateRegistry(bytecode_dir=bytecode_dir).preload()
+    print(f"{'bytecode cache preload':<22} {(time.perf_counter() - start) * 1000:8.2f} ms")
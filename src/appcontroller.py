@@ -10,7 +10,7 @@ import socket
 import sys
 import ipaddress
 from src.proto import scistream_pb2
-from src.proto import scistream_pb2_grpc
+from src.channel import control_stub
 
 def valid_ip(ip):
     try:
@@ -42,31 +42,27 @@ class AppCtrl():
             if not valid_ip(controller_ip):
                 sys.exit("AppCtrl: controller_ip not valid try again")
             request.prod_listeners.extend([f'{controller_ip}:5074', f'{controller_ip}:5075', f'{controller_ip}:5076', f'{controller_ip}:37000', f'{controller_ip}:47000'])
-        # load server certificate from file
-        with open('server.crt', 'rb') as f:
-            trusted_certs = f.read()
-            credentials = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
-        with grpc.secure_channel(s2cs, credentials) as channel:
-            s2cs = scistream_pb2_grpc.ControlStub(channel)
-            request.role = role
-            metadata = (
-                ('authorization', f'{access_token}'),
-            )
-            print("AppCtrl: SENDING HELLO")
-            while retry_count < MAX_RETRIES:
-                try:
-                    self.response = s2cs.hello(request, metadata=metadata)
-                    print("AppCtrl: Hello sent")
-                    break ## Exit the retry loop
-                except grpc.RpcError as e:
-                    if e.code() == grpc.StatusCode.UNAUTHENTICATED:
-                        sys.exit(f"AppCtrl: Authentication error for server scope, please obtain new credentials: {e.details()}")
-                    else:
-                        print(f"AppCtrl WARNING: GRPC error occurred: {e.details()}")
-                        retry_count += 1
-                time.sleep(0.1)
-            else:
-                sys.exit(f"AppCtrl: Failed after {MAX_RETRIES} attempts.")
+        # channels are cached per S2CS, controllers created in the same process share them
+        s2cs = control_stub(s2cs, 'server.crt')
+        request.role = role
+        metadata = (
+            ('authorization', f'{access_token}'),
+        )
+        print("AppCtrl: SENDING HELLO")
+        while retry_count < MAX_RETRIES:
+            try:
+                self.response = s2cs.hello(request, metadata=metadata)
+                print("AppCtrl: Hello sent")
+                break ## Exit the retry loop
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.UNAUTHENTICATED:
+                    sys.exit(f"AppCtrl: Authentication error for server scope, please obtain new credentials: {e.details()}")
+                else:
+                    print(f"AppCtrl WARNING: GRPC error occurred: {e.details()}")
+                    retry_count += 1
+            time.sleep(0.1)
+        else:
+            sys.exit(f"AppCtrl: Failed after {MAX_RETRIES} attempts.")
         self.start_app(role)
 
     def kill_python_processes_on_port(self, port):
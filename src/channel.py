@@ -0,0 +1,91 @@
+import atexit
+import os
+import threading
+
+import grpc
+
+from .proto import scistream_pb2_grpc
+
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+## HTTP/2 keepalive keeps an idle cached channel usable across NATs and
+## firewalls, BDP probing sizes the flow control window to the path
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.http2.bdp_probe", 1),
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+]
+
+## S2CS has to accept the client keepalive pings, otherwise it answers
+## them with GOAWAY too_many_pings
+SERVER_OPTIONS = [
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ("grpc.http2.max_ping_strikes", 0),
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+]
+
+
+class ChannelCache:
+    """
+    Secure channels to S2CS keyed by (target, server certificate).
+
+    The certificate is read and the TLS session set up once per key, every
+    later call on the same S2CS reuses the open HTTP/2 connection.
+    """
+
+    def __init__(self, options=CHANNEL_OPTIONS):
+        self.options = list(options)
+        self.channels = {}
+        self.stubs = {}
+        self.lock = threading.Lock()
+
+    def key(self, target, server_cert):
+        return target, os.path.realpath(server_cert)
+
+    def channel(self, target, server_cert="server.crt"):
+        key = self.key(target, server_cert)
+        with self.lock:
+            if key not in self.channels:
+                with open(server_cert, "rb") as f:
+                    trusted_certs = f.read()
+                credentials = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
+                self.channels[key] = grpc.secure_channel(target, credentials, options=self.options)
+            return self.channels[key]
+
+    def stub(self, target, server_cert="server.crt"):
+        key = self.key(target, server_cert)
+        channel = self.channel(target, server_cert)
+        with self.lock:
+            if key not in self.stubs:
+                self.stubs[key] = scistream_pb2_grpc.ControlStub(channel)
+            return self.stubs[key]
+
+    def close(self):
+        with self.lock:
+            channels = list(self.channels.values())
+            self.channels.clear()
+            self.stubs.clear()
+        for channel in channels:
+            channel.close()
+
+
+_cache_lock = threading.Lock()
+
+
+def channel_cache():
+    with _cache_lock:
+        if not hasattr(channel_cache, "_instance"):
+            channel_cache._instance = ChannelCache()
+            atexit.register(channel_cache._instance.close)
+    return channel_cache._instance
+
+
+def control_stub(target, server_cert="server.crt"):
+    """ControlStub on the process-wide cached channel to target"""
+    return channel_cache().stub(target, server_cert)
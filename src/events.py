@@ -0,0 +1,95 @@
+import asyncio
+import queue
+import threading
+
+from .proto import scistream_pb2
+
+State = scistream_pb2.SessionEvent.State
+TERMINAL_STATES = (State.RELEASED, State.FAILED)
+
+
+class SessionEvents:
+    """
+    Fan-out of session state transitions to the watch RPC.
+
+    Subscribers are callbacks invoked under the hub lock, so they must not
+    block, and every subscriber sees the events of a uid in order. A new
+    subscriber first receives the current state of the sessions it watches,
+    an empty uid watches every session.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.current = {}
+
+    def publish(self, uid, state, **fields):
+        event = scistream_pb2.SessionEvent(uid=uid, state=state, **fields)
+        with self.lock:
+            if state in TERMINAL_STATES:
+                self.current.pop(uid, None)
+            else:
+                self.current[uid] = event
+            for callback in self.subscribers.get(uid, ()) + self.subscribers.get("", ()):
+                callback(event)
+        return event
+
+    def subscribe(self, uid, callback):
+        with self.lock:
+            self.subscribers[uid] = self.subscribers.get(uid, ()) + (callback,)
+            if uid:
+                replay = [self.current[uid]] if uid in self.current else []
+            else:
+                replay = list(self.current.values())
+            for event in replay:
+                callback(event)
+
+    def unsubscribe(self, uid, callback):
+        with self.lock:
+            callbacks = tuple(cb for cb in self.subscribers.get(uid, ()) if cb != callback)
+            if callbacks:
+                self.subscribers[uid] = callbacks
+            else:
+                self.subscribers.pop(uid, None)
+
+    def watch(self, uid, is_active=lambda: True, poll_interval=1, add_callback=None):
+        """
+        Yields events until the watched uid reaches a terminal state, or
+        forever for an empty uid. is_active is polled so that a cancelled RPC
+        gives its worker thread back, add_callback (the RPC context's) lets a
+        cancellation wake the watch up right away.
+        """
+        events = queue.Queue()
+        self.subscribe(uid, events.put)
+        if add_callback is not None:
+            add_callback(lambda: events.put(None))
+        try:
+            while is_active():
+                try:
+                    event = events.get(timeout=poll_interval)
+                except queue.Empty:
+                    continue
+                if event is None:
+                    return
+                yield event
+                if uid and event.state in TERMINAL_STATES:
+                    return
+        finally:
+            self.unsubscribe(uid, events.put)
+
+    async def watch_async(self, uid):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def put(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        self.subscribe(uid, put)
+        try:
+            while True:
+                event = await events.get()
+                yield event
+                if uid and event.state in TERMINAL_STATES:
+                    return
+        finally:
+            self.unsubscribe(uid, put)
@@ -0,0 +1,215 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180
+)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def expose(self):
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [
+            f"{self.name}{format_labels(self.labels, key)} {value}"
+            for key, value in values.items()
+        ]
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from a callback at scrape time"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, callback):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def expose(self):
+        return self.header() + [f"{self.name} {self.callback()}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.values.get(self.key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def expose(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = self.header()
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """collector() returns exposition lines computed at scrape time"""
+        self.collectors.append(collector)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+class S2CSMetrics(Registry):
+    """Control plane metrics of an S2CS, per-stream data plane counters are added as a collector"""
+
+    def __init__(self):
+        super().__init__()
+        self.rpc_duration = self.add(
+            Histogram("s2cs_rpc_duration_seconds", "Duration of S2CS RPCs.", ["rpc"])
+        )
+        self.rpc_errors = self.add(
+            Counter("s2cs_rpc_errors_total", "S2CS RPCs that raised an error.", ["rpc"])
+        )
+        self.s2ds_duration = self.add(
+            Histogram(
+                "s2cs_s2ds_duration_seconds",
+                "Time spent starting (reserving listeners) or updating (launching proxies) S2DS.",
+                ["type", "stage"],
+            )
+        )
+        self.token_cache_lookups = self.add(
+            Counter(
+                "s2cs_token_cache_lookups_total",
+                "Access token validations by cache result (hit, negative_hit, miss).",
+                ["result"],
+            )
+        )
+        self.token_cache_evictions = self.add(
+            Counter(
+                "s2cs_token_cache_evictions_total",
+                "Validated tokens dropped from the cache, because they expired or the cache was full.",
+                ["reason"],
+            )
+        )
+
+    def observe_rpc(self, rpc, duration, error=False):
+        self.rpc_duration.observe(duration, rpc=rpc)
+        if error:
+            self.rpc_errors.inc(rpc=rpc)
+
+
+def stream_counters(streams):
+    """
+    Exposition lines for per-stream data plane counters.
+    streams is an iterable of (uid, stats) where stats maps counter names to values.
+    """
+    descriptions = {
+        "bytes_in": "Bytes received from the clients of a stream.",
+        "bytes_out": "Bytes sent back to the clients of a stream.",
+        "connections": "Connections accepted by a stream.",
+    }
+    samples = {name: [] for name in descriptions}
+    for uid, stats in streams:
+        for name, value in stats.items():
+            if name in samples:
+                samples[name].append(f's2ds_stream_{name}_total{format_labels(["uid"], [uid])} {value}')
+    lines = []
+    for name, help in descriptions.items():
+        lines.append(f"# HELP s2ds_stream_{name}_total {help}")
+        lines.append(f"# TYPE s2ds_stream_{name}_total counter")
+        lines.extend(samples[name])
+    return lines
+
+
+def start_metrics_server(registry, port, host="0.0.0.0"):
+    """Serves registry in the Prometheus text format on http://host:port/metrics"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="s2cs-metrics", daemon=True).start()
+    return server
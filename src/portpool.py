@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+
+class PortPoolException(Exception):
+    pass
+
+
+class PortPool:
+    """
+    Free-list of the data plane ports S2CS hands out to S2DS.
+
+    Allocating or releasing a port is O(1) regardless of the range width.
+    Ports are handed out lowest first, released ports go to the back of the
+    list, optionally after waiting `cooldown` seconds so sockets left in
+    TIME_WAIT by the previous stream can drain.
+    """
+
+    def __init__(self, start_port, end_port, cooldown=0):
+        if start_port > end_port:
+            raise PortPoolException("Start port must be less than or equal to end port")
+        self.start_port = start_port
+        self.end_port = end_port
+        self.cooldown = cooldown
+        self.free = collections.deque(range(start_port, end_port + 1))
+        self.cooling = collections.deque()
+        ## one byte per port in the range, 1 means allocated
+        self.used = bytearray(end_port - start_port + 1)
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self.used)
+
+    def available(self):
+        """Ports allocate() can hand out now, the cooling ones are not counted"""
+        with self.lock:
+            self.recycle(time.monotonic())
+            return len(self.free)
+
+    def allocate(self, count):
+        with self.lock:
+            self.recycle(time.monotonic())
+            if count > len(self.free):
+                raise PortPoolException(
+                    f"Port range {self.start_port}-{self.end_port} exhausted, "
+                    f"requested {count} ports but only {len(self.free)} are free"
+                )
+            ports = [self.free.popleft() for _ in range(count)]
+            for port in ports:
+                self.used[port - self.start_port] = 1
+            self.in_use += count
+            return ports
+
+    def reserve(self, ports):
+        """Marks specific ports as allocated, used when sessions are restored"""
+        with self.lock:
+            for port in ports:
+                index = port - self.start_port
+                if 0 <= index < len(self.used) and not self.used[index]:
+                    self.used[index] = 1
+                    self.in_use += 1
+            ## O(range) rebuild, only happens at startup
+            self.free = collections.deque(
+                port for port in self.free if not self.used[port - self.start_port]
+            )
+
+    def release(self, ports):
+        with self.lock:
+            ready_at = time.monotonic() + self.cooldown
+            for port in ports:
+                index = port - self.start_port
+                ## Ignore ports outside the range and double releases
+                if not 0 <= index < len(self.used) or not self.used[index]:
+                    continue
+                self.used[index] = 0
+                self.in_use -= 1
+                if self.cooldown:
+                    self.cooling.append((ready_at, port))
+                else:
+                    self.free.append(port)
+
+    def recycle(self, now):
+        ## cooling is ordered by ready time since cooldown is constant
+        while self.cooling and self.cooling[0][0] <= now:
+            self.free.append(self.cooling.popleft()[1])
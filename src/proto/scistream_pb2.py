@@ -13,25 +13,45 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0fscistream.proto\x12\tscistream\"D\n\x07Request\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x0c\n\x04role\x18\x02 \x01(\t\x12\x10\n\x08num_conn\x18\x03 \x01(\x05\x12\x0c\n\x04rate\x18\x04 \x01(\x05\"D\n\rUpdateTargets\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x18\n\x10remote_listeners\x18\x02 \x03(\t\x12\x0c\n\x04role\x18\x03 \x01(\t\"\x16\n\x07Release\x12\x0b\n\x03uid\x18\x01 \x01(\t\":\n\x05Hello\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x16\n\x0eprod_listeners\x18\x02 \x03(\t\x12\x0c\n\x04role\x18\x03 \x01(\t\"5\n\x08Response\x12\x11\n\tlisteners\x18\x01 \x03(\t\x12\x16\n\x0eprod_listeners\x18\x02 \x03(\t\"1\n\x0b\x41ppResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x11\n\tlisteners\x18\x02 \x03(\t2\xd9\x01\n\x07\x43ontrol\x12.\n\x03req\x12\x12.scistream.Request\x1a\x13.scistream.Response\x12\x37\n\x06update\x12\x18.scistream.UpdateTargets\x1a\x13.scistream.Response\x12\x32\n\x07release\x12\x12.scistream.Release\x1a\x13.scistream.Response\x12\x31\n\x05hello\x12\x10.scistream.Hello\x1a\x16.scistream.AppResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0fscistream.proto\x12\tscistream\"w\n\x07Request\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x0c\n\x04role\x18\x02 \x01(\t\x12\x10\n\x08num_conn\x18\x03 \x01(\x05\x12\x0c\n\x04rate\x18\x04 \x01(\x05\x12\x0e\n\x06\x64\x65tach\x18\x05 \x01(\x08\x12!\n\x06tuning\x18\x06 \x01(\x0b\x32\x11.scistream.Tuning\"\xb0\x01\n\x06Tuning\x12\x0f\n\x07profile\x18\x01 \x01(\t\x12\x0e\n\x06sndbuf\x18\x02 \x01(\x05\x12\x0e\n\x06rcvbuf\x18\x03 \x01(\x05\x12\x14\n\x07nodelay\x18\x04 \x01(\x08H\x00\x88\x01\x01\x12\x12\n\ncongestion\x18\x05 \x01(\t\x12\x0f\n\x07\x62ufsize\x18\x06 \x01(\x05\x12\x13\n\x06splice\x18\x07 \x01(\x08H\x01\x88\x01\x01\x12\x0e\n\x06rtt_ms\x18\x08 \x01(\x05\x42\n\n\x08_nodelayB\t\n\x07_splice\"D\n\rUpdateTargets\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x18\n\x10remote_listeners\x18\x02 \x03(\t\x12\x0c\n\x04role\x18\x03 \x01(\t\"\x16\n\x07Release\x12\x0b\n\x03uid\x18\x01 \x01(\t\":\n\x05Hello\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12\x16\n\x0eprod_listeners\x18\x02 \x03(\t\x12\x0c\n\x04role\x18\x03 \x01(\t\"5\n\x08Response\x12\x11\n\tlisteners\x18\x01 \x03(\t\x12\x16\n\x0eprod_listeners\x18\x02 \x03(\t\"1\n\x0b\x41ppResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x11\n\tlisteners\x18\x02 \x03(\t\"4\n\x0c\x42\x61tchRequest\x12$\n\x08requests\x18\x01 \x03(\x0b\x32\x12.scistream.Request\"\xf7\x01\n\rBatchResponse\x12:\n\tresponses\x18\x01 \x03(\x0b\x32\'.scistream.BatchResponse.ResponsesEntry\x12\x34\n\x06\x65rrors\x18\x02 \x03(\x0b\x32$.scistream.BatchResponse.ErrorsEntry\x1a\x45\n\x0eResponsesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\"\n\x05value\x18\x02 \x01(\x0b\x32\x13.scistream.Response:\x02\x38\x01\x1a-\n\x0b\x45rrorsEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"\x1b\n\x0cWatchRequest\x12\x0b\n\x03uid\x18\x01 \x01(\t\"\xfa\x01\n\x0cSessionEvent\x12\x0b\n\x03uid\x18\x01 \x01(\t\x12,\n\x05state\x18\x02 \x01(\x0e\x32\x1d.scistream.SessionEvent.State\x12\x11\n\tlisteners\x18\x03 \x03(\t\x12\x16\n\x0eprod_listeners\x18\x04 \x03(\t\x12\x0f\n\x07message\x18\x05 \x01(\t\"s\n\x05State\x12\r\n\tREQUESTED\x10\x00\x12\x12\n\x0eHELLO_RECEIVED\x10\x01\x12\x0c\n\x08PROXY_UP\x10\x02\x12\x0b\n\x07UPDATED\x10\x03\x12\x0c\n\x08RELEASED\x10\x04\x12\n\n\x06\x46\x41ILED\x10\x05\x12\x12\n\x0ePORTS_RESERVED\x10\x06\x32\xd6\x02\n\x07\x43ontrol\x12.\n\x03req\x12\x12.scistream.Request\x1a\x13.scistream.Response\x12\x37\n\x06update\x12\x18.scistream.UpdateTargets\x1a\x13.scistream.Response\x12\x32\n\x07release\x12\x12.scistream.Release\x1a\x13.scistream.Response\x12\x31\n\x05hello\x12\x10.scistream.Hello\x1a\x16.scistream.AppResponse\x12>\n\tbatch_req\x12\x17.scistream.BatchRequest\x1a\x18.scistream.BatchResponse\x12;\n\x05watch\x12\x17.scistream.WatchRequest\x1a\x17.scistream.SessionEvent0\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'scistream_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
+  _BATCHRESPONSE_RESPONSESENTRY._options = None
+  _BATCHRESPONSE_RESPONSESENTRY._serialized_options = b'8\001'
+  _BATCHRESPONSE_ERRORSENTRY._options = None
+  _BATCHRESPONSE_ERRORSENTRY._serialized_options = b'8\001'
   _REQUEST._serialized_start=30
-  _REQUEST._serialized_end=98
-  _UPDATETARGETS._serialized_start=100
-  _UPDATETARGETS._serialized_end=168
-  _RELEASE._serialized_start=170
-  _RELEASE._serialized_end=192
-  _HELLO._serialized_start=194
-  _HELLO._serialized_end=252
-  _RESPONSE._serialized_start=254
-  _RESPONSE._serialized_end=307
-  _APPRESPONSE._serialized_start=309
-  _APPRESPONSE._serialized_end=358
-  _CONTROL._serialized_start=361
-  _CONTROL._serialized_end=578
+  _REQUEST._serialized_end=149
+  _TUNING._serialized_start=152
+  _TUNING._serialized_end=328
+  _UPDATETARGETS._serialized_start=330
+  _UPDATETARGETS._serialized_end=398
+  _RELEASE._serialized_start=400
+  _RELEASE._serialized_end=422
+  _HELLO._serialized_start=424
+  _HELLO._serialized_end=482
+  _RESPONSE._serialized_start=484
+  _RESPONSE._serialized_end=537
+  _APPRESPONSE._serialized_start=539
+  _APPRESPONSE._serialized_end=588
+  _BATCHREQUEST._serialized_start=590
+  _BATCHREQUEST._serialized_end=642
+  _BATCHRESPONSE._serialized_start=645
+  _BATCHRESPONSE._serialized_end=892
+  _BATCHRESPONSE_RESPONSESENTRY._serialized_start=776
+  _BATCHRESPONSE_RESPONSESENTRY._serialized_end=845
+  _BATCHRESPONSE_ERRORSENTRY._serialized_start=847
+  _BATCHRESPONSE_ERRORSENTRY._serialized_end=892
+  _WATCHREQUEST._serialized_start=894
+  _WATCHREQUEST._serialized_end=921
+  _SESSIONEVENT._serialized_start=924
+  _SESSIONEVENT._serialized_end=1174
+  _SESSIONEVENT_STATE._serialized_start=1059
+  _SESSIONEVENT_STATE._serialized_end=1174
+  _CONTROL._serialized_start=1177
+  _CONTROL._serialized_end=1519
 # @@protoc_insertion_point(module_scope)
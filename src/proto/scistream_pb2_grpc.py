@@ -34,6 +34,16 @@ class ControlStub(object):
                 request_serializer=scistream__pb2.Hello.SerializeToString,
                 response_deserializer=scistream__pb2.AppResponse.FromString,
                 )
+        self.batch_req = channel.unary_unary(
+                '/scistream.Control/batch_req',
+                request_serializer=scistream__pb2.BatchRequest.SerializeToString,
+                response_deserializer=scistream__pb2.BatchResponse.FromString,
+                )
+        self.watch = channel.unary_stream(
+                '/scistream.Control/watch',
+                request_serializer=scistream__pb2.WatchRequest.SerializeToString,
+                response_deserializer=scistream__pb2.SessionEvent.FromString,
+                )
 
 
 class ControlServicer(object):
@@ -63,6 +73,18 @@ class ControlServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def batch_req(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def watch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ControlServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -86,6 +108,16 @@ def add_ControlServicer_to_server(servicer, server):
                     request_deserializer=scistream__pb2.Hello.FromString,
                     response_serializer=scistream__pb2.AppResponse.SerializeToString,
             ),
+            'batch_req': grpc.unary_unary_rpc_method_handler(
+                    servicer.batch_req,
+                    request_deserializer=scistream__pb2.BatchRequest.FromString,
+                    response_serializer=scistream__pb2.BatchResponse.SerializeToString,
+            ),
+            'watch': grpc.unary_stream_rpc_method_handler(
+                    servicer.watch,
+                    request_deserializer=scistream__pb2.WatchRequest.FromString,
+                    response_serializer=scistream__pb2.SessionEvent.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'scistream.Control', rpc_method_handlers)
@@ -163,3 +195,37 @@ class Control(object):
             scistream__pb2.AppResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def batch_req(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/scistream.Control/batch_req',
+            scistream__pb2.BatchRequest.SerializeToString,
+            scistream__pb2.BatchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def watch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/scistream.Control/watch',
+            scistream__pb2.WatchRequest.SerializeToString,
+            scistream__pb2.SessionEvent.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import sys
+import time
 import fire
 import grpc
 import threading
@@ -9,7 +11,18 @@ from .proto import scistream_pb2_grpc
 
 from concurrent import futures
 from .s2ds.s2ds import create_instance
-from .utils import request_decorator, set_verbosity, authenticated, read_file
+from .s2ds.templates import configure_templates
+from .s2ds.tuning import tuning_error
+from .portpool import PortPool
+from .sessions import SessionTable
+from .events import SessionEvents, State
+from .channel import SERVER_OPTIONS
+from .tokencache import TokenCache
+from .store import SessionStore
+from .metrics import S2CSMetrics, Gauge, stream_counters, start_metrics_server
+from .s2ds.subproc import AdoptedProcess
+from .s2ds.supervisor import SupervisedProcess
+from .utils import request_decorator, set_verbosity, authenticated, read_file, ValidationException
 from globus_action_provider_tools.authentication import TokenChecker
 
 
@@ -29,6 +42,7 @@ __version__ = importlib.metadata.version("scistream-proto")
 
 class S2CS(scistream_pb2_grpc.ControlServicer):
     TIMEOUT = 180  # timeout value in seconds
+    BATCH_WORKERS = 16  # streams of a batch started in parallel
 
     def __init__(
         self,
@@ -39,16 +53,30 @@ class S2CS(scistream_pb2_grpc.ControlServicer):
         type="Haproxy",
         client_id=default_cid,
         client_secret=default_secret,
+        port_cooldown=0,
+        state_db=None,
+        token_ttl=300,
+        max_watchers=0,
     ):
-        self.response = None
-        self.resource_map = {}
+        self.s2ds = None
+        self.resource_map = SessionTable()
+        self.events = SessionEvents()
         self.listener_ip = listener_ip
         self.client_id = client_id
         self.client_secret = client_secret
         self.type = type
         self.start_port = start_port
         self.end_port= end_port
-        self.used_ports=set()
+        self.port_pool = PortPool(start_port, end_port, cooldown=port_cooldown)
+        self.metrics = S2CSMetrics()
+        self.metrics.add(Gauge("s2cs_sessions", "Sessions held by S2CS.", lambda: len(self.resource_map)))
+        self.metrics.add(Gauge("s2cs_ports_in_use", "Ports allocated from the port range.", lambda: self.port_pool.in_use))
+        self.metrics.add(Gauge("s2cs_ports_total", "Size of the port range.", lambda: self.port_pool.size))
+        self.metrics.add_collector(lambda: stream_counters(self.stream_stats()))
+        self.token_cache = TokenCache(max_ttl=token_ttl, metrics=self.metrics)
+        ## a sync watch holds a worker thread for as long as it runs
+        self.watch_slots = threading.BoundedSemaphore(max_watchers) if max_watchers else None
+        self.metrics.add(Gauge("s2cs_token_cache_size", "Access tokens held by the validation cache.", lambda: len(self.token_cache)))
 
         # Moving checker instantiation to the begginning, this was making the request take too long
         if self.client_secret != "":
@@ -61,74 +89,239 @@ class S2CS(scistream_pb2_grpc.ControlServicer):
             )
         set_verbosity(self, verbose)
         self.logger.info(f"Starting S2CS server with type: {self.type}")
+        self.store = None
+        if state_db:
+            self.store = SessionStore(state_db)
+            self.restore_sessions()
+
+    def stream_stats(self):
+        ## Per-stream data plane counters, for backends that can report them
+        for uid in self.resource_map:
+            entry = self.resource_map.get(uid)
+            s2ds = self.get_s2ds(entry) if entry else None
+            if not hasattr(s2ds, "stats"):
+                continue
+            try:
+                yield uid, s2ds.stats(uid, entry)
+            except (OSError, ValueError, IndexError, KeyError) as e:
+                ## a bad reply from one proxy must not fail the whole scrape
+                self.logger.debug(f"Could not read stats for '{uid}': {e}")
+
+    def persist(self, uid, entry):
+        if self.store is None:
+            return
+        self.store.save(uid, self.type, entry)
+        for proc in entry.get("s2ds_proc", []):
+            if isinstance(proc, SupervisedProcess):
+                ## a restarted proxy has a new pid, the record must follow it
+                proc.on_restart = lambda proc: self.persist_restarted(uid, entry)
+
+    def persist_restarted(self, uid, entry):
+        ## runs on the supervisor thread, a released session is not written back
+        if self.resource_map.get(uid) is entry:
+            self.store.save(uid, self.type, entry)
+
+    def restore_sessions(self):
+        ## Re-adopt proxies left running by a previous S2CS instead of recreating them
+        restored_ports = []
+        for uid, type, record in self.store.load():
+            processes = [AdoptedProcess(proc["pid"], proc["args"]) for proc in record["processes"]]
+            if (
+                type != self.type
+                or not record["adoptable"]
+                or any(proc.poll() is not None for proc in processes)
+            ):
+                for proc in processes:
+                    proc.terminate()
+                self.store.delete(uid)
+                self.logger.info(f"Dropped stale session '{uid}'")
+                continue
+            restored_ports.extend(record["ports"])
+            hello_received = threading.Event()
+            hello_received.set()
+            self.resource_map[uid] = {
+                "role": record["role"],
+                "num_conn": record["num_conn"],
+                "rate": record["rate"],
+                "hello_received": hello_received,
+                "prod_listeners": record["prod_listeners"],
+                "prods2cs_listeners": record["prods2cs_listeners"],
+                "listeners": record["listeners"],
+                "ports": record["ports"],
+                "s2ds_proc": processes,
+                "s2ds": create_instance(self.type, self.logger),
+            }
+            self.events.publish(uid, State.PROXY_UP, listeners=record["listeners"], message="re-adopted")
+            self.logger.info(
+                f"Re-adopted session '{uid}' with pids {[proc.pid for proc in processes]}"
+            )
+        self.port_pool.reserve(restored_ports)
 
     # @validate_args(has=["role", "uid", "num_conn", "rate"])
     @request_decorator
     @authenticated
     def req(self, request: scistream_pb2.Request, context=None):
-        self.resource_map[request.uid] = {
+        self.setup_request(request, threading.Event())
+        ##DEBUG message here show resource map
+        entry = self.resource_map[request.uid]
+        if request.detach:
+            return scistream_pb2.Response(listeners=entry["listeners"])
+        hello_received = entry["hello_received"].wait(S2CS.TIMEOUT)
+
+        if not hello_received:
+            self.fail_request(request.uid, "Hello not received within the timeout period")
+            raise S2CSException(f"Hello not received within the timeout period")
+
+        return entry["response"]
+
+    @request_decorator
+    @authenticated
+    def batch_req(self, request: scistream_pb2.BatchRequest, context=None):
+        ## Reserve the ports of every stream in parallel, their UPDATEs launch the proxies
+        response = scistream_pb2.BatchResponse()
+        workers = max(1, min(len(request.requests), S2CS.BATCH_WORKERS))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            setups = [
+                (stream.uid, executor.submit(self.setup_request, stream, threading.Event()))
+                for stream in request.requests
+            ]
+        started = []
+        for uid, future in setups:
+            try:
+                future.result()
+                started.append(uid)
+            except Exception as e:
+                response.errors[uid] = str(e)
+        ## then wait for the HELLOs, all of them share the same deadline
+        deadline = time.time() + S2CS.TIMEOUT
+        for uid in started:
+            entry = self.resource_map.get(uid)
+            if entry is None:
+                response.errors[uid] = "Released before HELLO was received"
+            elif entry["hello_received"].wait(max(0, deadline - time.time())):
+                response.responses[uid].CopyFrom(entry["response"])
+            else:
+                self.fail_request(uid, "Hello not received within the timeout period")
+                response.errors[uid] = "Hello not received within the timeout period"
+        return response
+
+    def expire_later(self, uid):
+        ## detached requests still give up on a missing HELLO after TIMEOUT
+        timer = threading.Timer(S2CS.TIMEOUT, self.expire_request, [uid])
+        timer.daemon = True
+        self.resource_map[uid]["expiry"] = timer
+        timer.start()
+
+    def expire_request(self, uid):
+        with self.resource_map.lock(uid):
+            entry = self.resource_map.get(uid)
+            if entry is None or entry["hello_received"].is_set():
+                return
+            self.fail_request(uid, "Hello not received within the timeout period")
+
+    def fail_request(self, uid, message):
+        self.events.publish(uid, State.FAILED, message=message)
+        self.release_request(uid)
+
+    def setup_request(self, request, hello_received):
+        ## Holding the uid lock makes a concurrent HELLO wait for the listeners
+        with self.resource_map.lock(request.uid):
+            self.create_entry(request, hello_received)
+            self.start_s2ds(request)
+            self.persist(request.uid, self.resource_map[request.uid])
+            if request.detach:
+                self.expire_later(request.uid)
+
+    def create_entry(self, request, hello_received):
+        if request.HasField("tuning") and tuning_error(request.tuning):
+            raise ValidationException(tuning_error(request.tuning))
+        entry = {
             "role": request.role,
             "num_conn": request.num_conn,
             "rate": request.rate,
-            "hello_received": threading.Event(),
+            "hello_received": hello_received,
             "prod_listeners": [],
         }
+        if not self.resource_map.add(request.uid, entry):
+            raise ValidationException("Entry already found for uid")
+        self.events.publish(request.uid, State.REQUESTED)
         self.logger.debug(
-            f"Added key: '{request.uid}' with entry: {self.resource_map[request.uid]}"
-        )
-        ##FIXTHIS start function should be the same for all implementations
-        if self.type.lower() in ["stunnelsubprocess", "haproxysubprocess"]:
-            self.s2ds = create_instance(self.type, self.logger)
-            ports = self.get_available_ports(request.num_conn)
-            self.logger.debug(
-                f"Available ports: {ports}"
-            )
-            reply = self.s2ds.start(request.num_conn, self.listener_ip, ports)
-        else:
-            self.s2ds = create_instance(self.type)
-            reply = self.s2ds.start(request.num_conn, self.listener_ip)
-        self.resource_map[request.uid].update(reply)
-        ##DEBUG message here show resource map
-        hello_received = self.resource_map[request.uid]["hello_received"].wait(
-            S2CS.TIMEOUT
+            f"Added key: '{request.uid}' with entry: {entry}"
         )
 
-        if not hello_received:
-            self.release_request(request.uid)
-            raise S2CSException(f"Hello not received within the timeout period")
-
-        return self.response
+    def get_s2ds(self, entry):
+        ## entries that were not created by req fall back to the servicer instance
+        return entry.get("s2ds", self.s2ds)
+
+    def start_s2ds(self, request):
+        with self.resource_map.lock(request.uid):
+            entry = self.resource_map[request.uid]
+            try:
+                ##FIXTHIS start function should be the same for all implementations
+                s2ds = create_instance(self.type, self.logger)
+                if getattr(s2ds, "reserves_ports", False):
+                    ports = self.get_available_ports(request.num_conn)
+                    entry["ports"] = ports
+                    self.logger.debug(
+                        f"Available ports: {ports}"
+                    )
+                    start_time = time.time()
+                    tuning = request.tuning if request.HasField("tuning") else None
+                    reply = s2ds.start(request.num_conn, self.listener_ip, ports, request.rate, tuning)
+                else:
+                    start_time = time.time()
+                    reply = s2ds.start(request.num_conn, self.listener_ip)
+                self.metrics.s2ds_duration.observe(time.time() - start_time, type=self.type, stage="start")
+            except Exception as e:
+                self.resource_map.pop(request.uid)
+                self.port_pool.release(entry.get("ports", []))
+                self.events.publish(request.uid, State.FAILED, message=str(e))
+                raise
+            entry["s2ds"] = s2ds
+            entry.update(reply)
+            self.events.publish(request.uid, State.PORTS_RESERVED, listeners=entry["listeners"])
 
     @request_decorator
     @authenticated
     def update(self, request, context=None):
+        return self.update_s2ds(request)
+
+    def update_s2ds(self, request):
         # improve validation
         listeners = request.remote_listeners
         ## remote listeners are the destination ports
-        entry = self.resource_map[request.uid]
-        print(request.role)
-        if request.role == "PROD":
-            ## inbound proxy
-            listeners = [
-                listeners[i % len(listeners)] for i in range(entry["num_conn"])
-            ]
-        else:
-            ##outbound proxy
-            # TODO write a test case for this
-            listeners = [
-                listeners[i % len(listeners)] for i in range(entry["num_conn"])
-            ]
-            entry["prods2cs_listeners"] = listeners
-            # Include remote listeners for transparency to user
-        self.s2ds.update_listeners(
-            listeners, entry["s2ds_proc"], request.uid, request.role
-        )
-        self.logger.debug(
-            f"Updated : '{request.uid}' with entry: {self.resource_map[request.uid]}"
-        )
-        response = scistream_pb2.Response(
-            listeners=entry["listeners"], prod_listeners=listeners
-        )
+        with self.resource_map.lock(request.uid):
+            entry = self.resource_map[request.uid]
+            print(request.role)
+            if request.role == "PROD":
+                ## inbound proxy
+                listeners = [
+                    listeners[i % len(listeners)] for i in range(entry["num_conn"])
+                ]
+            else:
+                ##outbound proxy
+                # TODO write a test case for this
+                listeners = [
+                    listeners[i % len(listeners)] for i in range(entry["num_conn"])
+                ]
+                entry["prods2cs_listeners"] = listeners
+                # Include remote listeners for transparency to user
+            start_time = time.time()
+            self.get_s2ds(entry).update_listeners(
+                listeners, entry["s2ds_proc"], request.uid, request.role
+            )
+            self.metrics.s2ds_duration.observe(time.time() - start_time, type=self.type, stage="update")
+            self.persist(request.uid, entry)
+            self.events.publish(request.uid, State.PROXY_UP, listeners=entry["listeners"])
+            self.events.publish(
+                request.uid, State.UPDATED, listeners=entry["listeners"], prod_listeners=listeners
+            )
+            self.logger.debug(
+                f"Updated : '{request.uid}' with entry: {entry}"
+            )
+            response = scistream_pb2.Response(
+                listeners=entry["listeners"], prod_listeners=listeners
+            )
         return response
 
     @request_decorator
@@ -140,8 +333,18 @@ class S2CS(scistream_pb2_grpc.ControlServicer):
 
     # Release all resources used by a particular request
     def release_request(self, uid):
-        removed_item = self.resource_map.pop(uid, None)
-        self.s2ds.release(removed_item)
+        with self.resource_map.lock(uid):
+            removed_item = self.resource_map.pop(uid, None)
+            if removed_item is None:
+                self.logger.debug(f"Key '{uid}' was already released")
+                return
+            if "expiry" in removed_item:
+                removed_item["expiry"].cancel()
+            self.get_s2ds(removed_item).release(removed_item)
+            self.port_pool.release(removed_item.get("ports", []))
+            if self.store is not None:
+                self.store.delete(uid)
+            self.events.publish(uid, State.RELEASED)
         self.logger.debug(f"Removed key: '{uid}' with entry: {removed_item}")
 
     def release_all(self):
@@ -153,60 +356,203 @@ class S2CS(scistream_pb2_grpc.ControlServicer):
     @authenticated
     @request_decorator
     def hello(self, request, context=None):
-        ## Possible race condition here between REQ and HELLO
-        entry = self.resource_map[request.uid]
-        if request.role == "PROD":
-            ## Producer equals INBOUND proxy
-            ## entry listeners equals INBOUND ports
-            ## prod_listeners are the INTERNAL destination ports
-            ## resource map data structure is not very inteligible
-            entry["prod_listeners"] = request.prod_listeners
-            self.response = scistream_pb2.Response(
-                listeners=entry["listeners"], prod_listeners=entry["prod_listeners"]
-            )
-            AppResponse = scistream_pb2.AppResponse(message="Sending Prod listeners...")
-            print("receiving ports")
-            print(entry["listeners"])
-            print("target ports")
-            print(entry["prod_listeners"])
-            print("DEBUG HERE")
-            print(self.response)
-        else:
-            ## Consumer equals OUTBOUND proxy
-            ## entry listeners equals OUTBOUND ports
-            ## Missing destination ports in this case
-            self.response = scistream_pb2.Response(listeners=entry["listeners"])
-            print(entry["listeners"])
-            print("DEBUG HERE")
-            AppResponse = scistream_pb2.AppResponse(
-                message="Sending listeners...", listeners=entry["listeners"]
+        return self.receive_hello(request)
+
+    def receive_hello(self, request):
+        ## The uid lock orders HELLO after REQ has started S2DS
+        with self.resource_map.lock(request.uid):
+            entry = self.resource_map[request.uid]
+            if request.role == "PROD":
+                ## Producer equals INBOUND proxy
+                ## entry listeners equals INBOUND ports
+                ## prod_listeners are the INTERNAL destination ports
+                ## resource map data structure is not very inteligible
+                entry["prod_listeners"] = request.prod_listeners
+                entry["response"] = scistream_pb2.Response(
+                    listeners=entry["listeners"], prod_listeners=entry["prod_listeners"]
+                )
+                AppResponse = scistream_pb2.AppResponse(message="Sending Prod listeners...")
+                print("receiving ports")
+                print(entry["listeners"])
+                print("target ports")
+                print(entry["prod_listeners"])
+                print("DEBUG HERE")
+                print(entry["response"])
+            else:
+                ## Consumer equals OUTBOUND proxy
+                ## entry listeners equals OUTBOUND ports
+                ## Missing destination ports in this case
+                entry["response"] = scistream_pb2.Response(listeners=entry["listeners"])
+                print(entry["listeners"])
+                print("DEBUG HERE")
+                AppResponse = scistream_pb2.AppResponse(
+                    message="Sending listeners...", listeners=entry["listeners"]
+                )
+            self.persist(request.uid, entry)
+            entry["hello_received"].set()
+            if "expiry" in entry:
+                entry["expiry"].cancel()
+            self.events.publish(
+                request.uid,
+                State.HELLO_RECEIVED,
+                listeners=entry["listeners"],
+                prod_listeners=entry.get("prod_listeners", []),
             )
-        entry["hello_received"].set()
         return AppResponse
 
+    @authenticated
+    def watch(self, request, context=None):
+        ## Not timed by request_decorator, a uid may be watched before its REQ
+        if self.watch_slots is not None and not self.watch_slots.acquire(blocking=False):
+            message = "Too many watch calls, the workers are kept for the other RPCs"
+            if context is None:
+                raise S2CSException(message)
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, message)
+        try:
+            if context is None:
+                yield from self.events.watch(request.uid)
+            else:
+                yield from self.events.watch(request.uid, context.is_active, add_callback=context.add_callback)
+        finally:
+            if self.watch_slots is not None:
+                self.watch_slots.release()
+
     def validate_creds(self, access_token):
+        ## req, hello and update of a stream carry the same token, introspect it once
+        valid = self.token_cache.get(access_token)
+        if valid is not None:
+            return valid
         auth_state = self.checker.check_token(access_token)
-        return len(auth_state.identities) > 0
+        valid = len(auth_state.identities) > 0
+        exp = None
+        if valid:
+            ## already introspected by identities, AuthState caches the response
+            exp = auth_state.introspect_token().get("exp")
+        self.token_cache.put(access_token, valid, exp)
+        return valid
         # return False
 
     def get_available_ports(self, num_conn):
-        ## Given port range tuple, given used ports set
-        ## returns the first n ports available using sequential allocation strategy.
-        ## until num_connections
-        available = []
+        ## Allocates num_conn ports from the pool, they return to it on release_request
         self.logger.debug(
-                f"Port_range: {self.start_port, self.end_port}"
+                f"Port_range: {self.start_port, self.end_port}, free ports: {self.port_pool.available()}, "
+                f"cooling down: {len(self.port_pool.cooling)}"
             )
-        self.logger.debug(
-                f"Used_ports: {self.start_port, self.end_port}"
+        return self.port_pool.allocate(num_conn)
+
+
+class LoopEvent(asyncio.Event):
+    """asyncio.Event that can be set from the executor threads"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.get_running_loop()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(super().set)
+
+
+class AsyncS2CS(S2CS):
+    """
+    S2CS servicer for a grpc.aio server.
+
+    REQ awaits an asyncio.Event until HELLO arrives, so pending negotiations
+    don't hold a worker thread. Blocking S2DS calls, and anything that takes a
+    uid lock, run on the default executor.
+    """
+
+    @request_decorator
+    @authenticated
+    async def req(self, request: scistream_pb2.Request, context=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.setup_request, request, LoopEvent())
+        entry = self.resource_map[request.uid]
+        if request.detach:
+            return scistream_pb2.Response(listeners=entry["listeners"])
+        try:
+            await asyncio.wait_for(entry["hello_received"].wait(), S2CS.TIMEOUT)
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(
+                None, self.fail_request, request.uid, "Hello not received within the timeout period"
             )
-        for port in range(self.start_port, self.end_port +1):
-            if port not in self.used_ports:
-                available.append(port)
-                if len(available) == num_conn:
-                    break
-        self.used_ports.update(available)
-        return available
+            raise S2CSException(f"Hello not received within the timeout period")
+
+        return entry["response"]
+
+    @request_decorator
+    @authenticated
+    async def batch_req(self, request: scistream_pb2.BatchRequest, context=None):
+        loop = asyncio.get_running_loop()
+        response = scistream_pb2.BatchResponse()
+        streams = list(request.requests)
+        setups = await asyncio.gather(
+            *(loop.run_in_executor(None, self.setup_request, stream, LoopEvent()) for stream in streams),
+            return_exceptions=True,
+        )
+        started = []
+        for stream, result in zip(streams, setups):
+            if isinstance(result, Exception):
+                response.errors[stream.uid] = str(result)
+            else:
+                started.append(stream.uid)
+
+        async def wait_hello(uid):
+            entry = self.resource_map.get(uid)
+            if entry is None:
+                response.errors[uid] = "Released before HELLO was received"
+                return
+            try:
+                await asyncio.wait_for(entry["hello_received"].wait(), S2CS.TIMEOUT)
+                response.responses[uid].CopyFrom(entry["response"])
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(
+                    None, self.fail_request, uid, "Hello not received within the timeout period"
+                )
+                response.errors[uid] = "Hello not received within the timeout period"
+
+        await asyncio.gather(*(wait_hello(uid) for uid in started))
+        return response
+
+    @request_decorator
+    @authenticated
+    async def update(self, request, context=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.update_s2ds, request)
+
+    @request_decorator
+    @authenticated
+    async def release(self, request, context=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.release_request, request.uid)
+        return scistream_pb2.Response()
+
+    @authenticated
+    @request_decorator
+    async def hello(self, request, context=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.receive_hello, request)
+
+    @authenticated
+    async def watch(self, request, context=None):
+        async for event in self.events.watch_async(request.uid):
+            yield event
+
+
+def add_port(server, listener_ip, port, server_credentials):
+    if server_credentials:
+        server.add_secure_port(f"[::]:{port}", server_credentials)  # Start secure server
+        print(f"🔒 Secure gRPC Server started on {listener_ip}:{port}")
+    else:
+        server.add_insecure_port(f"[::]:{port}")  # Start unsecure server
+        print(f"⚠️  Starting INSECURE gRPC server on {listener_ip}:{port}")
+
+
+async def serve_aio(servicer, listener_ip, port, server_credentials):
+    server = grpc.aio.server(options=SERVER_OPTIONS)
+    scistream_pb2_grpc.add_ControlServicer_to_server(servicer, server)
+    add_port(server, listener_ip, port, server_credentials)
+    await server.start()
+    await server.wait_for_termination()
 
 
 def start(
@@ -222,6 +568,16 @@ def start(
     server_crt=default_server_crt,
     server_key=default_server_key,
     ssl=True,
+    aio=False,
+    port_cooldown=0,
+    state_db=None,
+    metrics_port=0,
+    token_ttl=300,
+    max_watchers=None,
+    warm_containers=0,
+    warm_procs=0,
+    template_reload=False,
+    workers=10,
 ):
     """
     Starts a gRPC implementation of Scistream server.
@@ -230,7 +586,9 @@ def start(
         listener_ip (str): IP address on which the control server listens. Defaults to '0.0.0.0'.
         port (int): Control Channel port number on which the gRPC server listens. Defaults to 5000.
         port_range: Hyphenated string specifying the port range for S2DS. Defaults to "5100-5200"
-        type (str): Specifies the type of server to start. Options are 'S2DS', 'Nginx', 'Haproxy', 'StunnelSubprocess'.
+        type (str): Specifies the type of server to start. Options are 'S2DS', 'Nginx', 'Haproxy', 'StunnelSubprocess',
+                    'HaproxySubprocess', 'NginxSubprocess', 'SharedHaproxySubprocess', 'AsyncioRelay', 'StripedRelay',
+                    'SpliceRelay', or a type installed under the 'scistream.s2ds' entry point group.
                     'Haproxy' is the default type.
         v or verbose (bool): Enables detailed logging and debug output . Defaults to False.
         client_id (str): Client ID for Globus Auth. Defaults to value of 'default_cid'.
@@ -240,6 +598,23 @@ def start(
         server_key (str): Path to the server key file. Defaults to 'server.key'.
         ssl (bool): if False, starts an **unsecured** gRPC server (noSSL). Defaults to True.
             SECURITY WARNING: Disabling SSL exposes control plane traffic. Only use in secure networks or for testing.
+        aio (bool): if True, serves the control plane with grpc.aio so pending requests don't hold a thread each. Defaults to False.
+        port_cooldown (float): Seconds a released port waits before it is reused, lets TIME_WAIT sockets drain. Defaults to 0.
+        state_db (str): Path to a SQLite file where sessions are recorded. When set, proxies are left running on
+            shutdown and re-adopted on the next start. Defaults to None (sessions are released on shutdown).
+        metrics_port (int): Port of the Prometheus /metrics HTTP endpoint, served on listener_ip. Defaults to 0 (disabled).
+        token_ttl (float): Longest time in seconds a validated access token is trusted without introspecting it again,
+            tokens are never trusted past their expiry. Defaults to 300, 0 disables the cache.
+        max_watchers (int): Watch calls served at once when aio is False, each one holds a worker thread until it
+            ends, the calls past it fail with RESOURCE_EXHAUSTED and s2uc falls back to a fixed delay before HELLO.
+            Defaults to half of workers, 0 removes the limit. The aio server watches without holding threads.
+        warm_containers (int): Idle proxy containers kept ready for new streams by the 'Haproxy', 'Nginx' and 'Stunnel'
+            types, whose image is pulled at startup either way. Defaults to 0 (disabled), each stream creates its
+            container.
+        warm_procs (int): Most idle proxy processes kept ready for new streams by the 'HaproxySubprocess' and
+            'NginxSubprocess' types, the pool follows the rate at which streams arrive. Defaults to 0 (disabled).
+        template_reload (bool): if True, proxy configuration templates are recompiled when their file changes. Defaults to False.
+        workers (int): Threads serving RPCs when aio is False. A pending REQ holds one until HELLO arrives. Defaults to 10.
     """
 
     ## Better input validation will provide better error messages
@@ -258,30 +633,52 @@ def start(
     if int(start_port) > int(end_port):
         raise ValueError("Start port must be less than or equal to end port")
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    servicer = S2CS(
+    servicer_class = AsyncS2CS if aio else S2CS
+    servicer = servicer_class(
         listener_ip = listener_ip,
         verbose = (v or verbose),
         type = type,
         client_id = client_id,
         client_secret = client_secret,
         start_port = int(start_port),
-        end_port = int(end_port)
+        end_port = int(end_port),
+        port_cooldown = port_cooldown,
+        state_db = state_db,
+        token_ttl = token_ttl,
+        max_watchers = 0 if aio else (workers // 2 if max_watchers is None else max_watchers),
     )
-    scistream_pb2_grpc.add_ControlServicer_to_server(servicer, server)
 
+    configure_templates(auto_reload=template_reload)
+    backend = create_instance(type, servicer.logger)
+    if hasattr(backend, "image_name"):
+        warming = f" and warming {warm_containers} container(s)" if warm_containers else ""
+        print(f"Pulling {backend.image_name}{warming}")
+        backend.prepare(warm_containers)
+    elif getattr(backend, "reload_signal", None) is not None and warm_procs:
+        print(f"Warming up to {warm_procs} idle {backend.command[0]} process(es)")
+        backend.prepare(warm_procs)
+
+    if metrics_port:
+        start_metrics_server(servicer.metrics, metrics_port, listener_ip)
+        print(f"Metrics available on http://{listener_ip}:{metrics_port}/metrics")
+
+    server_credentials = None
     if ssl:
         server_credentials = grpc.ssl_server_credentials([(private_key, certificate_chain)])
-        server.add_secure_port(f"[::]:{port}", server_credentials)  # Start secure server
-        print(f"🔒 Secure gRPC Server started on {listener_ip}:{port}")
-    else:
-        server.add_insecure_port(f"[::]:{port}")  # Start unsecure server
-        print(f"⚠️  Starting INSECURE gRPC server on {listener_ip}:{port}")
     try:
-        server.start()
-        server.wait_for_termination()
+        if aio:
+            asyncio.run(serve_aio(servicer, listener_ip, port, server_credentials))
+        else:
+            server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers), options=SERVER_OPTIONS)
+            scistream_pb2_grpc.add_ControlServicer_to_server(servicer, server)
+            add_port(server, listener_ip, port, server_credentials)
+            server.start()
+            server.wait_for_termination()
     except KeyboardInterrupt:
-        servicer.release_all()
+        if servicer.store is not None:
+            print(f"\nKeeping {len(servicer.resource_map)} session(s) in {state_db} for the next start")
+        else:
+            servicer.release_all()
         print("\nTerminating server")
         sys.exit(0)
 
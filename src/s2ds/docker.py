@@ -1,132 +1,330 @@
-
+import atexit
+import collections
+import logging
+import shutil
+import threading
+import uuid
+from concurrent import futures
 from pathlib import Path
+
 import docker
-from jinja2 import Environment, FileSystemLoader
-from src.s2ds.utils import get_config_path
+from src.s2ds.templates import template_registry
+from src.s2ds.tuning import resolve_tuning
+from src.s2ds.utils import get_config_path, connection_rate
+
+POOL_SIZE = 2  # idle containers kept per proxy type by prepare()
+MAX_POOL_CONNECTIONS = 32  # HTTP connections to the Docker daemon, shared by every stream
+
+_client_lock = threading.Lock()
+_pool_lock = threading.Lock()
+
+
+def docker_client():
+    """Returns the process-wide Docker client"""
+    with _client_lock:
+        if not hasattr(docker_client, "_instance"):
+            docker_client._instance = docker.from_env(max_pool_size=MAX_POOL_CONNECTIONS)
+    return docker_client._instance
+
+
+def pull_images(images, client=None):
+    """Pulls, in parallel, the images that are not available locally yet"""
+    client = client or docker_client()
+
+    def pull(image):
+        try:
+            client.images.get(image)
+        except docker.errors.ImageNotFound:
+            client.images.pull(image)
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        list(executor.map(pull, images))
+
+
+def container_pool(proxy, size=0):
+    """
+    Returns the pool of idle containers of the proxy type, shared by its
+    instances. size applies to a new pool, 0 keeps no idle containers.
+    """
+    with _pool_lock:
+        if not hasattr(container_pool, "_instances"):
+            container_pool._instances = {}
+        name = type(proxy).__name__
+        if name not in container_pool._instances:
+            pool = ContainerPool(proxy, docker_client(), size, proxy.logger)
+            atexit.register(pool.drain)
+            container_pool._instances[name] = pool
+    return container_pool._instances[name]
+
+
+class ProxyHandle:
+    """
+    A proxy container with its bind mounted config and key files. Exposes
+    terminate() and pid so it can live in s2ds_proc next to the subprocess
+    handles of the other backends.
+    """
+
+    def __init__(self, container, directory, cfg_path, key_path, running):
+        self.container = container
+        self.directory = directory
+        self.cfg_path = cfg_path
+        self.key_path = key_path
+        self.running = running
+
+    @property
+    def pid(self):
+        return self.container.short_id
+
+    def terminate(self):
+        try:
+            self.container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ContainerPool:
+    """
+    Idle proxy containers created ahead of the streams that will use them.
+
+    A stream takes a container that already exists, and is running when
+    the proxy can idle on a placeholder config, so setting it up only
+    writes the config and signals a reload. The pool is refilled in the
+    background, creating containers concurrently.
+    """
+
+    def __init__(self, proxy, client, size=POOL_SIZE, logger=None):
+        self.proxy = proxy
+        self.client = client
+        self.size = size
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.idle = collections.deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=max(1, size), thread_name_prefix="s2ds-container-pool"
+        )
+
+    def fill(self):
+        with self.lock:
+            missing = max(0, self.size - len(self.idle) - self.pending)
+            self.pending += missing
+        for _ in range(missing):
+            self.executor.submit(self.add)
+
+    def add(self):
+        try:
+            handle = self.proxy.create_container(self.client)
+        except Exception as e:
+            self.logger.error(f"Could not create a {self.proxy.image_name} container: {e}")
+            return
+        finally:
+            with self.lock:
+                self.pending -= 1
+        with self.lock:
+            self.idle.append(handle)
+
+    def acquire(self):
+        with self.lock:
+            handle = self.idle.popleft() if self.idle else None
+        self.fill()
+        if handle is None:
+            ## pool exhausted, fall back to a cold container
+            handle = self.proxy.create_container(self.client)
+        return handle
+
+    def drain(self):
+        with self.lock:
+            idle, self.idle = list(self.idle), collections.deque()
+        for handle in idle:
+            handle.terminate()
 
 
 class ProxyContainer:
-    def __init__(self, service_plugin_type="docker"):
+    reload_signal = None  # makes a running proxy re-read its config
+    idle_config = None  # config pooled containers run until assigned, None keeps them stopped
+    supports_rate = True  # False when the proxy has no way to cap bandwidth
+    reserves_ports = True  # start() takes ports from the S2CS port range
+
+    def __init__(self, service_plugin_type="docker", logger=None):
         self.service_plugin_type = service_plugin_type
-        pass
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.local_ports = None
+        self.conn_rate = 0
+        self.tuning_request = None
+        self.bdp_rate = 0
+
+    def prepare(self, pool_size=POOL_SIZE):
+        """
+        Called once at S2CS startup, pulls the image and, with a pool_size,
+        warms the pool. Without a reachable Docker daemon S2CS still starts,
+        streams then fail in UPDATE.
+        """
+        try:
+            pull_images([self.image_name])
+        except docker.errors.DockerException as e:
+            self.logger.error(f"Could not pull {self.image_name}: {e}")
+            return
+        if not pool_size:
+            return
+        try:
+            pool = container_pool(self, pool_size)
+            pool.size = pool_size
+            pool.fill()
+        except docker.errors.DockerException as e:
+            self.logger.error(f"Could not warm {self.image_name} containers: {e}")
 
     def release(self, entry):
-        pass
+        for i, handle in enumerate(entry["s2ds_proc"]):
+            handle.terminate()
+            entry["s2ds_proc"][i] = handle.pid
+        self.logger.info(f"Removed {len(entry['s2ds_proc'])} {self.image_name} container(s)")
 
-    def start(self, num_conn, listener_ip):
-        ##STOP hardcoding port 5001
-        # self.local_ports = [5064 + i for i in range(num_conn)]
-        self.local_ports = [5074, 5075, 5076, 6000, 6001]
+    def start(self, num_conn, listener_ip, ports, rate=0, tuning=None):
+        ## each stream has its own container, so each needs its own ports
+        self.local_ports = ports
+        self.tuning_request = tuning
+        self.bdp_rate = connection_rate(rate, num_conn)
+        if rate > 0 and not self.supports_rate:
+            self.logger.warning(f"{self.container_name} cannot limit bandwidth, rate {rate} kB/s is not enforced")
+        elif rate > 0:
+            self.conn_rate = connection_rate(rate, num_conn)
         entry = {
             "s2ds_proc": [],
-            "listeners": [f"{listener_ip}:{port}" for port in self.local_ports],
+            "listeners": [f"{listener_ip}:{port}" for port in ports[:num_conn]],
         }
         return entry
 
-    def update_listeners(self, listeners, s2ds_proc, uid, role="PROD"):
-        if self.service_plugin_type == "docker":
-            docker_client = DockerPlugin()
-        """
-        if self.service_plugin_type == "janus":
-            docker_client = JanusPlugin()
-        if self.service_plugin_type == "dockersock":
-            docker_client = DockerSockPlugin()
-        """
-        vars = {
-            "local_ports": self.local_ports,
-            "dest_array": listeners,
-            "client": "yes" if role == "CONS" else "no",
-        }
-        # Load the Jinja2 environment and get the template
-        env = Environment(loader=FileSystemLoader(f"{Path(__file__).parent}"))
-        template = env.get_template(f"{self.cfg_filename}.j2")
-        # Render the template to create the configuration file
-        # renders file to a slightly different location
-
-        config_path = get_config_path()
-
-        with open(f"{config_path}/{self.cfg_filename}", "w") as f:
-            f.write(template.render(vars))
-        with open(f"{config_path}/{self.key_filename}", "w") as f:
-            f.write("client1:" + uid.replace("-", ""))
-        # Define the container configuration
+    def create_container(self, client):
+        name = f"scistream-{self.container_name}-{uuid.uuid4().hex[:12]}"
+        directory = Path(get_config_path()) / "containers" / name
+        directory.mkdir(parents=True)
+        cfg_path = directory / Path(self.cfg_filename).name
+        key_path = directory / "key"
+        cfg_path.write_text(self.idle_config or "")
+        key_path.write_text("")
         container_config = {
             "image": self.image_name,
-            "name": self.container_name,
-            "detach": True,
+            "name": name,
             "volumes": {
-                f"{config_path}/{self.cfg_filename}": {
-                    "bind": self.cfg_location,
-                    "mode": "ro",
-                },
-                f"{config_path}/{self.key_filename}": {
-                    "bind": self.key_location,
-                    "mode": "ro",
-                },
+                str(cfg_path): {"bind": self.cfg_location, "mode": "ro"},
+                str(key_path): {"bind": self.key_location, "mode": "ro"},
             },
             "network_mode": "host",
+            "labels": {"scistream.proxy": self.container_name},
         }
-        # Start the proxy container
-        name = self.container_name
 
-        docker_client.start(name, container_config)
+        def launch():
+            if self.idle_config is None:
+                return client.containers.create(**container_config)
+            return client.containers.run(detach=True, **container_config)
+
+        try:
+            container = launch()
+        except docker.errors.ImageNotFound:
+            ## create does not pull, an image the startup pull missed is pulled by the first stream
+            pull_images([self.image_name], client)
+            container = launch()
+        return ProxyHandle(container, directory, cfg_path, key_path, self.idle_config is not None)
+
+    def update_listeners(self, listeners, s2ds_proc, uid, role="PROD"):
+        ## a second update reconfigures the container of the stream
+        handle = s2ds_proc[0] if s2ds_proc else container_pool(self).acquire()
+        remote = listeners[0] if role == "CONS" and listeners else None
+        tuning = resolve_tuning(self.tuning_request, self.bdp_rate, remote, self.logger)
+        template = template_registry().get(f"{Path(self.cfg_filename).name}.j2")
+        config = template.render(
+            local_ports=self.local_ports,
+            dest_array=listeners,
+            client="yes" if role == "CONS" else "no",
+            key_filename=self.key_location,
+            pid_filename="/tmp/scistream.pid",
+            conn_rate=self.conn_rate,
+            tuning=tuning,
+        )
+        try:
+            self.serve(handle, config, uid)
+        except docker.errors.NotFound:
+            ## the container was removed behind our back, the stream gets a new one
+            self.logger.warning(f"Container {handle.container.name} is gone, creating another one for {uid}")
+            handle.terminate()
+            handle = self.create_container(docker_client())
+            self.serve(handle, config, uid)
+            if s2ds_proc:
+                s2ds_proc[0] = handle
+        if not s2ds_proc:
+            s2ds_proc.append(handle)
+        self.logger.info(f"Container {handle.container.name} serving {uid} on {self.local_ports}")
+
+    def serve(self, handle, config, uid):
+        """Writes the stream files and reloads the container, starting it if needed"""
+        ## files are rewritten in place, the bind mounts follow the inode
+        handle.key_path.write_text("client1:" + uid.replace("-", ""))
+        handle.cfg_path.write_text(config)
+        if handle.running:
+            try:
+                handle.container.kill(signal=self.reload_signal)
+                return
+            except docker.errors.NotFound:
+                raise
+            except docker.errors.APIError as e:
+                ## a crashed container cannot be signalled, starting it loads the new config
+                self.logger.warning(f"Could not reload {handle.container.name}, restarting it: {e}")
+        handle.container.start()
+        handle.running = True
 
 
 class Haproxy(ProxyContainer):
-    def __init__(self, service_plugin_type="docker"):
-        self.service_plugin_type = service_plugin_type
+    ## the image runs haproxy in master-worker mode, SIGUSR2 reloads it
+    reload_signal = "SIGUSR2"
+    idle_config = (
+        "defaults\n"
+        "    mode tcp\n"
+        "    timeout connect 5000\n"
+        "    timeout client 50000\n"
+        "    timeout server 50000\n"
+        "\n"
+        "listen idle\n"
+        "    bind /tmp/scistream-idle.sock\n"
+    )
+
+    def __init__(self, service_plugin_type="docker", logger=None):
+        super().__init__(service_plugin_type, logger)
         self.cfg_location = "/usr/local/etc/haproxy/haproxy.cfg"
         self.key_location = "/usr/local/etc/haproxy/haproxy.key"
         self.image_name = "haproxy:latest"
-        self.container_name = "myhaproxy"
+        self.container_name = "haproxy"
         self.cfg_filename = "haproxy.cfg"
-        self.key_filename = "haproxy.cfg.j2"
         if self.service_plugin_type == "dockersock":
             self.cfg_filename = "/data/scistream-demo/configs/haproxy.cfg"
-        pass
 
 
 class Nginx(ProxyContainer):
-    def __init__(self, service_plugin_type="docker"):
-        self.service_plugin_type = service_plugin_type
+    reload_signal = "SIGHUP"
+    idle_config = "events { }\n"
+
+    def __init__(self, service_plugin_type="docker", logger=None):
+        super().__init__(service_plugin_type, logger)
         self.cfg_location = "/etc/nginx/nginx.conf"
         self.key_location = "/etc/nginx/nginx.key"
         self.image_name = "nginx:latest"
-        self.container_name = "mynginx"
-        self.cfg_filename = f"nginx.conf"
-        self.key_filename = "nginx.conf.j2"
+        self.container_name = "nginx"
+        self.cfg_filename = "nginx.conf"
         if self.service_plugin_type == "dockersock":
             self.cfg_filename = "/data/scistream-demo/configs/nginx.conf"
-        pass
 
 
 class Stunnel(ProxyContainer):
-    def __init__(self, service_plugin_type="docker"):
-        self.service_plugin_type = service_plugin_type
+    ## stunnel refuses to run without a service, pooled containers wait stopped
+    reload_signal = "SIGHUP"
+    supports_rate = False
+
+    def __init__(self, service_plugin_type="docker", logger=None):
+        super().__init__(service_plugin_type, logger)
         self.cfg_location = "/etc/stunnel/stunnel.conf"
         self.key_location = "/etc/stunnel/stunnel.key"
         self.image_name = "stunnel:latest"
-        self.container_name = "mystunnel"
+        self.container_name = "stunnel"
         self.cfg_filename = "stunnel.conf"
-        self.key_filename = "stunnel.key"
-
         if self.service_plugin_type == "dockersock":
             self.cfg_filename = "/data/scistream-demo/configs/stunnel.conf"
-            self.key_filename = "/data/scistream-demo/configs/stunnel.key"
-        pass
-
-
-
-class DockerPlugin:
-    def __init__(self):
-        self.client = docker.from_env()
-
-    def start(self, name, container_config):
-        try:
-            container = self.client.containers.get(name)
-            print(f"Container {name} already exists")
-            container.restart()
-        except docker.errors.NotFound:
-            print(f"Creating container {name}")
-            container = self.client.containers.run(**container_config)
-        print(f"Started container with ID {container.id}")
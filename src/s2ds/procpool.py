@@ -0,0 +1,197 @@
+import atexit
+import collections
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent import futures
+from pathlib import Path
+
+from src.s2ds.supervisor import READY_TIMEOUT, SupervisedProcess, last_line, supervisor
+from src.s2ds.utils import get_config_path
+
+ARRIVAL_WINDOW = 30.0  # seconds, the pool holds about as many workers as streams arrived in one window
+
+_pool_lock = threading.Lock()
+
+
+def process_pool(proxy, create=True):
+    """
+    Returns the pool of idle processes of the proxy type, shared by its
+    instances. Without create, None until prepare() made one.
+    """
+    with _pool_lock:
+        if not hasattr(process_pool, "_instances"):
+            process_pool._instances = {}
+        name = type(proxy).__name__
+        if name not in process_pool._instances:
+            if not create:
+                return None
+            pool = ProcessPool(proxy, logger=proxy.logger)
+            atexit.register(pool.drain)
+            process_pool._instances[name] = pool
+    return process_pool._instances[name]
+
+
+def wait_pidfile(worker, path, timeout=READY_TIMEOUT):
+    """
+    Returns once the worker wrote its pid to path, the proxies do that after
+    setting their signal handlers. Raises an OSError when the worker exits
+    first or does not get there in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if worker.poll() is not None:
+            raise OSError(f"exited with {worker.poll()}: {last_line(worker.log_path)}")
+        try:
+            if int(Path(path).read_text().split()[0]) == worker.pid:
+                return
+        except (OSError, ValueError, IndexError):
+            pass
+        if time.monotonic() >= deadline:
+            raise OSError(f"did not write {path} within {timeout}s")
+        time.sleep(0.02)
+
+
+class ArrivalRate:
+    """Exponentially weighted arrival rate, an arrival counts less the older it is"""
+
+    def __init__(self, window=ARRIVAL_WINDOW):
+        self.window = window
+        self.count = 0.0
+        self.last = None
+
+    def decayed(self, now):
+        if self.last is None:
+            return 0.0
+        return self.count * math.exp(-(now - self.last) / self.window)
+
+    def observe(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.count = self.decayed(now) + 1
+        self.last = now
+
+    def rate(self, now=None):
+        """Arrivals per second"""
+        return self.decayed(time.monotonic() if now is None else now) / self.window
+
+
+class PooledProcess(SupervisedProcess):
+    """Proxy started by the pool on an idle config, through the cfg_link symlink"""
+
+    def __init__(self, prefix, command, logger=None):
+        self.prefix = prefix
+        self.cfg_link = Path(f"{prefix}.conf")
+        super().__init__(command + [str(self.cfg_link)], f"{prefix}.log", logger)
+
+    def terminate(self):
+        super().terminate()
+        for suffix in (".idle", ".conf", ".sock", ".pid"):
+            Path(f"{self.prefix}{suffix}").unlink(missing_ok=True)
+        if self.log_path == f"{self.prefix}.log":
+            ## never handed to a stream
+            Path(self.log_path).unlink(missing_ok=True)
+
+
+class ProcessPool:
+    """
+    Idle proxy processes started ahead of the streams that will use them.
+
+    A worker runs the proxy on an idle config through a symlink, it is
+    handed out once it wrote the pidfile of its idle config. A stream
+    points the symlink at its own config and signals a reload, so setting
+    it up skips the fork, exec and startup of a new proxy. The pool is
+    sized from the arrival rate of streams, between 1 and max_size
+    workers, and refilled in the background. max_size 0 disables it.
+    """
+
+    def __init__(self, proxy, max_size=0, window=ARRIVAL_WINDOW, logger=None):
+        self.proxy = proxy
+        self.max_size = max_size
+        self.arrivals = ArrivalRate(window)
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.idle = collections.deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="s2ds-process-pool"
+        )
+
+    def target(self):
+        if not self.max_size:
+            return 0
+        expected = math.ceil(self.arrivals.rate() * self.arrivals.window)
+        return min(self.max_size, max(1, expected))
+
+    def fill(self):
+        """Starts the missing workers, stops the ones the arrival rate no longer calls for"""
+        with self.lock:
+            target = self.target()
+            missing = max(0, target - len(self.idle) - self.pending)
+            self.pending += missing
+            excess = [self.idle.pop() for _ in range(max(0, len(self.idle) - target))]
+        for worker in excess:
+            worker.terminate()
+        for _ in range(missing):
+            self.executor.submit(self.add)
+
+    def spawn(self):
+        directory = Path(get_config_path()) / "pool"
+        directory.mkdir(parents=True, exist_ok=True)
+        prefix = directory / f"{type(self.proxy).__name__.lower()}-{uuid.uuid4().hex[:12]}"
+        idle_path = Path(f"{prefix}.idle")
+        idle_path.write_text(self.proxy.idle_config(prefix))
+        Path(f"{prefix}.conf").symlink_to(idle_path)
+        return PooledProcess(prefix, self.proxy.command, self.logger)
+
+    def add(self):
+        worker = None
+        try:
+            worker = self.spawn()
+            wait_pidfile(worker, f"{worker.prefix}.pid", self.proxy.ready_timeout)
+        except Exception as e:
+            self.logger.error(f"Could not start an idle {self.proxy.command[0]}: {e}")
+            if worker is not None:
+                worker.terminate()
+            return
+        finally:
+            with self.lock:
+                self.pending -= 1
+        supervisor(self.logger).watch(worker)
+        with self.lock:
+            self.idle.append(worker)
+
+    def acquire(self):
+        """Returns an idle worker, None when there is none and the proxy has to be started cold"""
+        with self.lock:
+            self.arrivals.observe()
+            worker = None
+            while self.idle and worker is None:
+                worker = self.idle.popleft()
+                if worker.poll() is not None:
+                    worker.terminate()
+                    worker = None
+        self.fill()
+        return worker
+
+    def drain(self):
+        with self.lock:
+            idle, self.idle = list(self.idle), collections.deque()
+        for worker in idle:
+            worker.terminate()
+
+
+def activate(worker, config_path, log_path, reload_signal):
+    """Hands a stream's config and log file to a pooled worker"""
+    with worker.lock:
+        ## the symlink is swapped atomically, a restart reads one config or the other
+        tmp = Path(f"{worker.cfg_link}.tmp")
+        tmp.unlink(missing_ok=True)
+        tmp.symlink_to(config_path)
+        os.replace(tmp, worker.cfg_link)
+        ## the worker keeps writing to the renamed file
+        os.replace(worker.log_path, log_path)
+        worker.log_path = str(log_path)
+        worker.send_signal(reload_signal)
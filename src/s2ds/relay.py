@@ -0,0 +1,635 @@
+import asyncio
+import errno
+import fcntl
+import os
+import socket
+import struct
+import threading
+import uuid
+
+from src.s2ds.subproc import AbstractSubprocess
+from src.s2ds.utils import connection_rate
+from src.s2ds.tuning import tune_socket
+
+DEFAULT_BUFSIZE = 256 * 1024
+BURST_SECONDS = 0.05  # bytes a rate limited pipe may send at once, in seconds of its rate
+
+## Striping: every stripe connection starts with a STRIPE_HELLO (magic, session
+## id, stripe index, stripe count), then carries CHUNK_HEADER (sequence number,
+## length) framed chunks of either direction. A zero length chunk ends a direction.
+STRIPE_HELLO = struct.Struct("!4s16sHH")
+STRIPE_MAGIC = b"S2ST"
+CHUNK_HEADER = struct.Struct("!QI")
+CHUNK_SIZE = 64 * 1024
+STRIPE_QUEUE = 4  # chunks waiting to be sent on each stripe
+STRIPE_WINDOW = 256  # chunks a direction may hold out of order
+STRIPE_TIMEOUT = 10  # seconds for every stripe of a session to arrive
+
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+## errors of a kernel or socket type that cannot splice, nothing was moved yet
+SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+_loop_lock = threading.Lock()
+
+
+def relay_loop():
+    """
+    Returns the process-wide event loop used by every relay listener.
+
+    The loop runs in a daemon thread so that the (threaded) gRPC servicer can
+    hand work to it without blocking on I/O itself.
+    """
+    with _loop_lock:
+        if not hasattr(relay_loop, "_instance"):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="s2ds-relay", daemon=True
+            )
+            thread.start()
+            relay_loop._instance = loop
+    return relay_loop._instance
+
+
+def run_coroutine(coro, timeout=None):
+    return asyncio.run_coroutine_threadsafe(coro, relay_loop()).result(timeout)
+
+
+def split_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class BufferPool:
+    """Recycles fixed size receive buffers between connections"""
+
+    def __init__(self, bufsize=DEFAULT_BUFSIZE):
+        self.bufsize = bufsize
+        self.free = []
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        return memoryview(bytearray(self.bufsize))
+
+    def put(self, buf):
+        self.free.append(buf)
+
+
+class TokenBucket:
+    """
+    Caps the bytes per second of every pipe drawing from it. Data already
+    read is always sent, the bucket goes into debt and the pipe waits until
+    it is repaid, so reads are capped to the burst size.
+    """
+
+    def __init__(self, rate, burst_seconds=BURST_SECONDS):
+        self.rate = rate
+        self.capacity = max(1, int(rate * burst_seconds))
+        self.tokens = self.capacity
+        self.stamp = None
+
+    async def consume(self, nbytes):
+        now = asyncio.get_running_loop().time()
+        if self.stamp is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class RelayListener:
+    """
+    Accepts connections on a local port and forwards each of them to a single
+    destination. Exposes terminate() and pid so it can live in s2ds_proc next
+    to the subprocess handles of the other backends.
+    """
+
+    def __init__(self, port, dest, buffers, logger, rate=0, tuning=None):
+        self.port = port
+        self.dest = split_address(dest)
+        self.buffers = buffers
+        self.logger = logger
+        self.tuning = tuning or {}
+        ## each direction has its own bucket, shared by the connections of the port
+        self.buckets = {}
+        if rate:
+            self.buckets = {"bytes_in": TokenBucket(rate), "bytes_out": TokenBucket(rate)}
+        self.pid = os.getpid()
+        self.sock = None
+        self.task = None
+        self.connections = set()
+        self.stats = {"bytes_in": 0, "bytes_out": 0, "connections": 0}
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        try:
+            ## accepted connections inherit the buffer sizes
+            tune_socket(sock, self.tuning)
+            sock.bind(("", self.port))
+            sock.listen(socket.SOMAXCONN)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.task = loop.create_task(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            client, _ = await loop.sock_accept(self.sock)
+            self.stats["connections"] += 1
+            task = loop.create_task(self.handle(client))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+
+    async def connect(self, dest=None):
+        loop = asyncio.get_running_loop()
+        family, type_, proto, _, address = (
+            await loop.getaddrinfo(*(dest or self.dest), type=socket.SOCK_STREAM)
+        )[0]
+        upstream = socket.socket(family, type_, proto)
+        upstream.setblocking(False)
+        try:
+            tune_socket(upstream, self.tuning)
+            await loop.sock_connect(upstream, address)
+        except BaseException:
+            ## also when cancelled while connecting
+            upstream.close()
+            raise
+        return upstream
+
+    async def handle(self, client):
+        client.setblocking(False)
+        try:
+            tune_socket(client, self.tuning)
+        except OSError as e:
+            self.logger.error(f"Relay {self.port} could not tune a connection: {e}")
+            client.close()
+            return
+        try:
+            upstream = await self.connect()
+        except OSError as e:
+            self.logger.error(f"Relay {self.port} could not reach {self.dest}: {e}")
+            client.close()
+            return
+        except BaseException:
+            ## close() cancels the connections still waiting for their destination
+            client.close()
+            raise
+        try:
+            await asyncio.gather(
+                self.pipe(client, upstream, "bytes_in"),
+                self.pipe(upstream, client, "bytes_out"),
+            )
+        finally:
+            client.close()
+            upstream.close()
+
+    async def pipe(self, src, dst, counter):
+        loop = asyncio.get_running_loop()
+        buf = self.buffers.get()
+        bucket = self.buckets.get(counter)
+        view = buf[:bucket.capacity] if bucket else buf
+        try:
+            while True:
+                nbytes = await loop.sock_recv_into(src, view)
+                if not nbytes:
+                    break
+                await loop.sock_sendall(dst, buf[:nbytes])
+                self.stats[counter] += nbytes
+                if bucket:
+                    await bucket.consume(nbytes)
+        except OSError:
+            pass
+        finally:
+            self.buffers.put(buf)
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    async def close(self):
+        tasks = [self.task, *self.connections]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.sock.close()
+
+    def terminate(self):
+        run_coroutine(self.close())
+
+
+async def wait_fd(fd, writable=False):
+    """Waits until fd is readable, or writable"""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    if writable:
+        loop.add_writer(fd, ready.set_result, None)
+    else:
+        loop.add_reader(fd, ready.set_result, None)
+    try:
+        await ready
+    finally:
+        if writable:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+class SpliceListener(RelayListener):
+    """
+    Relay listener that moves data between the sockets with splice(2)
+    through a pipe, so it never enters the S2CS process. Falls back to
+    the buffered copy of RelayListener where the kernel cannot splice.
+    """
+
+    async def pipe(self, src, dst, counter):
+        if not hasattr(os, "splice") or not self.tuning.get("splice", True):
+            return await super().pipe(src, dst, counter)
+        bucket = self.buckets.get(counter)
+        chunk = bucket.capacity if bucket else self.buffers.bufsize
+        read_end, write_end = os.pipe()
+        try:
+            ## sized like the copy buffers, capped by /proc/sys/fs/pipe-max-size
+            fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, min(chunk, 1024 * 1024))
+        except OSError:
+            pass
+        spliced = False
+        try:
+            while True:
+                try:
+                    nbytes = os.splice(src.fileno(), write_end, chunk, flags=SPLICE_FLAGS)
+                except BlockingIOError:
+                    await wait_fd(src.fileno())
+                    continue
+                except OSError as e:
+                    if spliced or e.errno not in SPLICE_UNSUPPORTED:
+                        raise
+                    self.logger.info(f"Relay {self.port} cannot splice ({e}), copying instead")
+                    return await super().pipe(src, dst, counter)
+                spliced = True
+                if not nbytes:
+                    break
+                pending = nbytes
+                while pending:
+                    try:
+                        pending -= os.splice(read_end, dst.fileno(), pending, flags=SPLICE_FLAGS)
+                    except BlockingIOError:
+                        await wait_fd(dst.fileno(), writable=True)
+                self.stats[counter] += nbytes
+                if bucket:
+                    await bucket.consume(nbytes)
+        except OSError:
+            pass
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+
+async def recv_exactly(sock, nbytes):
+    """Returns nbytes read from sock, or b"" when it is closed before the first byte"""
+    loop = asyncio.get_running_loop()
+    data = bytearray(nbytes)
+    view = memoryview(data)
+    received = 0
+    while received < nbytes:
+        count = await loop.sock_recv_into(sock, view[received:])
+        if not count:
+            if received:
+                raise ConnectionError("Stripe closed in the middle of a chunk")
+            return b""
+        received += count
+    return data
+
+
+class StripedSession:
+    """
+    One application connection carried by several stripe connections.
+
+    Data read from the application is cut into sequence numbered chunks,
+    each queued on the stripe with the fewest chunks waiting, so a slow
+    stripe does not hold back the others. Chunks read from the stripes are
+    put back in order before they are written to the application.
+    """
+
+    def __init__(self, plain, stripes, listener, plain_in, plain_out):
+        self.plain = plain
+        self.stripes = stripes
+        self.listener = listener
+        self.plain_in = plain_in  # stats counter of the data read from the application
+        self.plain_out = plain_out
+        self.pending = {}
+        self.next_seq = 0
+        self.window = asyncio.Condition()
+        self.ended = asyncio.Event()
+        self.tasks = []
+        self.error = None
+
+    async def run(self):
+        self.tasks = [asyncio.ensure_future(self.split()), asyncio.ensure_future(self.join())]
+        try:
+            done, _ = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    self.error = task.exception()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            for sock in [self.plain, *self.stripes]:
+                sock.close()
+        if self.error is not None:
+            self.listener.logger.error(f"Striped session on {self.listener.port} aborted: {self.error}")
+
+    def abort(self, error):
+        ## a stripe that cannot be written would leave split() waiting on its queue
+        self.error = error
+        for task in self.tasks:
+            task.cancel()
+
+    async def split(self):
+        loop = asyncio.get_running_loop()
+        queues = [asyncio.Queue(STRIPE_QUEUE) for _ in self.stripes]
+        writers = [
+            asyncio.ensure_future(self.write(sock, queue))
+            for sock, queue in zip(self.stripes, queues)
+        ]
+        bucket = self.listener.buckets.get(self.plain_in)
+        seq = 0
+        try:
+            while True:
+                data = await loop.sock_recv(self.plain, CHUNK_SIZE)
+                ## round robin between the stripes that are keeping up
+                first = seq % len(queues)
+                queue = min(queues[first:] + queues[:first], key=asyncio.Queue.qsize)
+                await queue.put(CHUNK_HEADER.pack(seq, len(data)) + data)
+                seq += 1
+                if not data:
+                    break
+                self.listener.stats[self.plain_in] += len(data)
+                if bucket:
+                    await bucket.consume(len(data))
+            for queue in queues:
+                await queue.put(None)
+            await asyncio.gather(*writers)
+        finally:
+            for writer in writers:
+                writer.cancel()
+
+    async def write(self, sock, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            try:
+                await loop.sock_sendall(sock, chunk)
+            except OSError as e:
+                self.abort(e)
+                return
+
+    async def join(self):
+        readers = [asyncio.ensure_future(self.read(sock)) for sock in self.stripes]
+        try:
+            ## done when the end of the stream was written, or every stripe closed
+            for reader in asyncio.as_completed(readers):
+                await reader
+                if self.ended.is_set():
+                    break
+            if not self.ended.is_set():
+                self.plain.shutdown(socket.SHUT_WR)
+        finally:
+            for reader in readers:
+                reader.cancel()
+
+    async def read(self, sock):
+        loop = asyncio.get_running_loop()
+        bucket = self.listener.buckets.get(self.plain_out)
+        while True:
+            header = await recv_exactly(sock, CHUNK_HEADER.size)
+            if not header:
+                return
+            seq, length = CHUNK_HEADER.unpack(header)
+            data = await recv_exactly(sock, length) if length else b""
+            if length and not data:
+                raise ConnectionError("Stripe closed in the middle of a chunk")
+            async with self.window:
+                ## the stripe holding next_seq never waits, so this cannot deadlock
+                await self.window.wait_for(lambda: seq < self.next_seq + STRIPE_WINDOW)
+                self.pending[seq] = data
+                while self.next_seq in self.pending:
+                    chunk = self.pending.pop(self.next_seq)
+                    self.next_seq += 1
+                    if not chunk:
+                        self.plain.shutdown(socket.SHUT_WR)
+                        self.ended.set()
+                        self.window.notify_all()
+                        return
+                    await loop.sock_sendall(self.plain, chunk)
+                    self.listener.stats[self.plain_out] += len(chunk)
+                    if bucket:
+                        await bucket.consume(len(chunk))
+                self.window.notify_all()
+
+
+class StripeClient(RelayListener):
+    """
+    Outbound side of a striped stream: each application connection accepted
+    on the port is carried by one stripe connection to every remote listener.
+    """
+
+    def __init__(self, port, remotes, buffers, logger, rate=0, tuning=None):
+        super().__init__(port, remotes[0], buffers, logger, rate, tuning)
+        self.remotes = [split_address(remote) for remote in remotes]
+
+    async def handle(self, client):
+        client.setblocking(False)
+        try:
+            tune_socket(client, self.tuning)
+        except OSError as e:
+            self.logger.error(f"Relay {self.port} could not tune a connection: {e}")
+            client.close()
+            return
+        session_id = uuid.uuid4().bytes
+        try:
+            opened = await asyncio.gather(
+                *[self.open_stripe(session_id, index) for index in range(len(self.remotes))],
+                return_exceptions=True,
+            )
+        except BaseException:
+            client.close()
+            raise
+        stripes = [sock for sock in opened if isinstance(sock, socket.socket)]
+        if len(stripes) < len(self.remotes):
+            error = next(e for e in opened if not isinstance(e, socket.socket))
+            self.logger.error(f"Relay {self.port} could not open the stripes of a session: {error}")
+            for sock in [client, *stripes]:
+                sock.close()
+            return
+        await StripedSession(client, stripes, self, "bytes_in", "bytes_out").run()
+
+    async def open_stripe(self, session_id, index):
+        upstream = await self.connect(self.remotes[index])
+        try:
+            await asyncio.get_running_loop().sock_sendall(
+                upstream, STRIPE_HELLO.pack(STRIPE_MAGIC, session_id, index, len(self.remotes))
+            )
+        except BaseException:
+            upstream.close()
+            raise
+        return upstream
+
+
+class StripeServer(RelayListener):
+    """
+    Inbound side of a striped stream: stripes accepted on any port of the
+    stream are grouped by session, once all of them arrived a single
+    connection to the destination is opened. The hello is not
+    authenticated, a session has at most max_stripes stripes and every
+    stripe must agree with the first one.
+    """
+
+    def __init__(self, port, dest, buffers, logger, sessions, max_stripes, rate=0, tuning=None):
+        super().__init__(port, dest, buffers, logger, rate, tuning)
+        self.sessions = sessions  # shared by the listeners of the stream
+        self.max_stripes = max_stripes
+
+    async def handle(self, client):
+        client.setblocking(False)
+        try:
+            tune_socket(client, self.tuning)
+            hello = await asyncio.wait_for(recv_exactly(client, STRIPE_HELLO.size), STRIPE_TIMEOUT)
+            magic, session_id, index, count = STRIPE_HELLO.unpack(hello) if hello else (b"", b"", 0, 0)
+        except (asyncio.TimeoutError, OSError, ConnectionError):
+            magic = b""
+        except BaseException:
+            client.close()
+            raise
+        if magic != STRIPE_MAGIC or not index < count <= self.max_stripes:
+            self.logger.error(f"Relay {self.port} dropped a connection without a valid stripe hello")
+            client.close()
+            return
+        stripes = self.sessions.get(session_id)
+        if stripes is None:
+            stripes = self.sessions[session_id] = [None] * count
+            asyncio.get_running_loop().call_later(STRIPE_TIMEOUT, self.expire, session_id)
+        elif len(stripes) != count or stripes[index] is not None:
+            self.logger.error(f"Relay {self.port} dropped a stripe that does not match its session")
+            client.close()
+            return
+        stripes[index] = client
+        if any(stripe is None for stripe in stripes):
+            return
+        del self.sessions[session_id]
+        try:
+            upstream = await self.connect()
+        except BaseException as e:
+            for sock in stripes:
+                sock.close()
+            if not isinstance(e, OSError):
+                raise
+            self.logger.error(f"Relay {self.port} could not reach {self.dest}: {e}")
+            return
+        await StripedSession(upstream, stripes, self, "bytes_out", "bytes_in").run()
+
+    def expire(self, session_id):
+        stripes = self.sessions.pop(session_id, None)
+        if stripes is not None:
+            self.logger.error(f"Relay {self.port} dropped an incomplete striped session")
+            for sock in stripes:
+                if sock is not None:
+                    sock.close()
+
+
+class AsyncioRelay(AbstractSubprocess):
+    """
+    Built-in data plane, it forwards every local port to its destination from
+    an event loop inside the S2CS process instead of spawning a proxy.
+    """
+
+    listener_class = RelayListener
+
+    def __init__(self, logger=None, bufsize=DEFAULT_BUFSIZE):
+        super().__init__(logger)
+        self.command = ["asyncio-relay"]
+        self.buffers = BufferPool(bufsize)
+
+    def tune(self, listeners, role):
+        super().tune(listeners, role)
+        if self.tuning.get("bufsize"):
+            self.buffers = BufferPool(self.tuning["bufsize"])
+
+    def update_listeners(self, listeners, s2ds_proc, uid, role):
+        self.logger.info(listeners)
+        self.tune(listeners, role)
+        for port, dest in zip(self.local_ports, listeners):
+            listener = self.listener_class(port, dest, self.buffers, self.logger, self.conn_rate, self.tuning)
+            run_coroutine(listener.open())
+            s2ds_proc.append(listener)
+        self.logger.info(f"Relaying {uid} ports {self.local_ports} to {listeners}")
+
+    def stats(self, uid, entry):
+        stats = {"bytes_in": 0, "bytes_out": 0, "connections": 0}
+        for listener in entry["s2ds_proc"]:
+            if isinstance(listener, RelayListener):
+                for name, value in listener.stats.items():
+                    stats[name] += value
+        return stats
+
+
+class SpliceRelay(AsyncioRelay):
+    """
+    Plaintext relay for trusted networks that forwards with splice(2), the
+    data stays in the kernel. Same port layout as AsyncioRelay.
+    """
+
+    listener_class = SpliceListener
+
+    def __init__(self, logger=None, bufsize=DEFAULT_BUFSIZE):
+        super().__init__(logger, bufsize)
+        self.command = ["splice-relay"]
+
+
+class StripedRelay(AsyncioRelay):
+    """
+    Relay that carries each application connection over num_conn parallel
+    stripe connections between the two S2DS, so a single flow is not capped
+    by the throughput of one TCP connection over the WAN. Both sides must
+    run it. The consumer connects to the first listener of the CONS side.
+    """
+
+    def start(self, num_conn, listener_ip, ports, rate=0, tuning=None):
+        entry = super().start(num_conn, listener_ip, ports, rate, tuning)
+        ## a single application connection carries the whole rate of the stream
+        self.conn_rate = connection_rate(rate, 1)
+        self.num_conn = num_conn
+        return entry
+
+    def update_listeners(self, listeners, s2ds_proc, uid, role):
+        self.logger.info(listeners)
+        self.tune(listeners, role)
+        if role == "CONS":
+            ## listeners are the stripe ports of the PROD side
+            relays = [
+                StripeClient(self.local_ports[0], listeners, self.buffers, self.logger, self.conn_rate, self.tuning)
+            ]
+        else:
+            sessions = {}
+            relays = [
+                StripeServer(
+                    port, listeners[0], self.buffers, self.logger, sessions, self.num_conn, self.conn_rate, self.tuning
+                )
+                for port in self.local_ports[:len(listeners)]
+            ]
+        for relay in relays:
+            run_coroutine(relay.open())
+            s2ds_proc.append(relay)
+        self.logger.info(f"Striping {uid} over {len(listeners)} connection(s) from ports {self.local_ports}")
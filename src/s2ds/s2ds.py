@@ -1,12 +1,37 @@
-from src.s2ds.docker import Haproxy, Nginx, Stunnel
-from src.s2ds.subproc import StunnelSubprocess, HaproxySubprocess
-from unittest import mock
+import importlib
+import importlib.metadata
+import threading
+
+## Packages can ship their own backends under this entry point group, e.g.
+## [tool.poetry.plugins."scistream.s2ds"] MyRelay = "mypackage.relay:MyRelay"
+ENTRY_POINT_GROUP = "scistream.s2ds"
+
+## Built-in backends, their module (and its dependencies, docker for the
+## container types) is only imported when the type is used
+BACKENDS = {
+    "Haproxy": "src.s2ds.docker:Haproxy",
+    "Nginx": "src.s2ds.docker:Nginx",
+    "Stunnel": "src.s2ds.docker:Stunnel",
+    "StunnelSubprocess": "src.s2ds.subproc:StunnelSubprocess",
+    "HaproxySubprocess": "src.s2ds.subproc:HaproxySubprocess",
+    "NginxSubprocess": "src.s2ds.subproc:NginxSubprocess",
+    "SharedHaproxySubprocess": "src.s2ds.subproc:SharedHaproxySubprocess",
+    "AsyncioRelay": "src.s2ds.relay:AsyncioRelay",
+    "StripedRelay": "src.s2ds.relay:StripedRelay",
+    "SpliceRelay": "src.s2ds.relay:SpliceRelay",
+}
+
+_registry_lock = threading.Lock()
+_entry_points_loaded = False
+
 
 class MockS2DS():
     def __init__(self, *args, **kwargs):
         pass
 
     def start(self, num_conn, listener_ip):
+        from unittest import mock
+
         return {
             "s2ds_proc": [mock.MagicMock() for _ in range(num_conn)],
             "listeners": [f"{listener_ip}:500{i}" for i in range(num_conn)],
@@ -18,18 +43,57 @@ class MockS2DS():
     def update_listeners(self, listeners, s2ds_proc, uid, role):
         pass
 
-def create_instance(instance_type, logger=None):
-    if instance_type == "Haproxy":
-        return Haproxy()
-    elif instance_type == "Nginx":
-        return Nginx()
-    elif instance_type == "Stunnel":
-        return Stunnel()
-    elif instance_type == "StunnelSubprocess":
-        return StunnelSubprocess(logger)
-    elif instance_type == "HaproxySubprocess":
-        return HaproxySubprocess(logger)
+
+def register_backend(name, backend):
+    """
+    Registers an S2DS type. backend is a class, or any callable taking a
+    logger keyword, or a "module:attribute" string imported on first use.
+    """
+    with _registry_lock:
+        BACKENDS[name] = backend
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    entry_points = importlib.metadata.entry_points()
+    ## Python 3.9 returns a dict of groups
+    if hasattr(entry_points, "select"):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
     else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in entry_points:
+        ## built-in types win over a plugin of the same name
+        BACKENDS.setdefault(entry_point.name, entry_point)
+    _entry_points_loaded = True
+
+
+def load_backend(name):
+    """Returns the backend class of an S2DS type, raises KeyError for unknown types"""
+    with _registry_lock:
+        if name not in BACKENDS:
+            _load_entry_points()
+        backend = BACKENDS[name]
+        if isinstance(backend, str):
+            module, _, attribute = backend.partition(":")
+            backend = getattr(importlib.import_module(module), attribute)
+        elif isinstance(backend, importlib.metadata.EntryPoint):
+            backend = backend.load()
+        BACKENDS[name] = backend
+    return backend
+
+
+def backend_names():
+    with _registry_lock:
+        _load_entry_points()
+        return sorted(BACKENDS)
+
+
+def create_instance(instance_type, logger=None):
+    try:
+        backend = load_backend(instance_type)
+    except KeyError:
         print(f"Unsupported instance type: {instance_type}")
         return MockS2DS()
-
+    return backend(logger=logger)
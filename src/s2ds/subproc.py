@@ -1,24 +1,109 @@
+import csv
 import logging
+import os
+import signal
+import socket
 import subprocess
+import threading
+import time
 from pathlib import Path
-from src.s2ds.utils import get_config_path
-from jinja2 import Environment, FileSystemLoader
+from src.s2ds.utils import S2DSException, get_config_path, connection_rate
+from src.s2ds.templates import template_registry
+from src.s2ds.tuning import resolve_tuning
+from src.s2ds.supervisor import READY_TIMEOUT, SupervisedProcess, supervisor, wait_ready
+from src.s2ds.procpool import activate, process_pool
+
+def haproxy_stats(socket_path, prefix):
+    """Sums the counters of the HAProxy frontends whose name starts with prefix"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        sock.connect(str(socket_path))
+        sock.sendall(b"show stat\n")
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    lines = data.decode().splitlines()
+    stats = {"bytes_in": 0, "bytes_out": 0, "connections": 0}
+    ## a reloading haproxy may close the socket without a reply
+    if not lines:
+        return stats
+    header = lines[0].lstrip("# ").split(",")
+    for row in csv.DictReader(lines[1:], fieldnames=header):
+        if row["svname"] == "FRONTEND" and row["pxname"].startswith(prefix):
+            stats["bytes_in"] += int(row["bin"] or 0)
+            stats["bytes_out"] += int(row["bout"] or 0)
+            stats["connections"] += int(row["stot"] or 0)
+    return stats
+
+def haproxy_worker_pid(socket_path):
+    """Pid of the HAProxy worker serving the stats socket, None when it does not answer"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(str(socket_path))
+            sock.sendall(b"show info\n")
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+    except OSError:
+        return None
+    for line in data.decode(errors="replace").splitlines():
+        if line.startswith("Pid:"):
+            return int(line.split(":", 1)[1])
+    return None
+
+def check_haproxy_config(path):
+    """Raises an S2DSException when haproxy rejects the configuration file"""
+    result = subprocess.run(
+        ["haproxy", "-c", "-q", "-f", str(path)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        timeout=READY_TIMEOUT,
+    )
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        raise S2DSException(f"Invalid HAProxy configuration {path}: {lines[-1] if lines else result.returncode}")
 
 class AbstractSubprocess():
+    supports_rate = True  # False when the proxy has no way to cap bandwidth
+    reserves_ports = True  # start() takes ports from the S2CS port range
+    ready_timeout = READY_TIMEOUT
+    reload_signal = None  # makes a running proxy re-read its config, None when it cannot be pooled
+
     def __init__(self, logger=None):
         self.logger = logger if logger else logging.getLogger(__name__)
         # These need to be defined by child classes
         self.cfg_filename = None
         self.command = None
         self.local_ports = None
+        self.listeners = []
+        self.conn_rate = 0
+        self.tuning_request = None
+        self.bdp_rate = 0
+        self.tuning = {}
     
-    def start(self, num_conn, listener_ip, ports):
+    def start(self, num_conn, listener_ip, ports, rate=0, tuning=None):
         self.logger.info(f"Reserving {self.command} ports: {ports}")
         self.local_ports = ports
+        self.tuning_request = tuning
+        self.bdp_rate = connection_rate(rate, num_conn)
+        if rate > 0 and not self.supports_rate:
+            self.logger.warning(f"{self.command} cannot limit bandwidth, rate {rate} kB/s is not enforced")
+        elif rate > 0:
+            self.conn_rate = connection_rate(rate, num_conn)
+            self.logger.info(f"Limiting each connection to {self.conn_rate} B/s")
         entry = {
             "s2ds_proc": [],
             "listeners": [f"{listener_ip}:{port}" for port in ports[:num_conn]],
         }
+        self.listeners = entry["listeners"]
         return entry
     
     def release(self, entry):
@@ -37,24 +122,42 @@ class AbstractSubprocess():
         
         if not error_occurred:
             self.logger.info(f"Terminated {self.command} subprocess(es)")
+        pool = process_pool(self, create=False) if self.reload_signal is not None else None
+        if pool is not None and pool.max_size:
+            ## lets the pool shrink when streams stop arriving
+            pool.fill()
+
+    def prepare(self, pool_size):
+        """Called once at S2CS startup, keeps up to pool_size idle proxies ready"""
+        pool = process_pool(self)
+        pool.max_size = pool_size
+        pool.fill()
     
+    def tune(self, listeners, role):
+        ## the CONS side connects to the PROD S2DS across the WAN, the auto profile sizes for that RTT
+        remote = listeners[0] if role == "CONS" and listeners else None
+        self.tuning = resolve_tuning(self.tuning_request, self.bdp_rate, remote, self.logger)
+
     def update_listeners(self, listeners, s2ds_proc, uid, role):
         self.logger.info(listeners)
+        self.tune(listeners, role)
         config_path = self.generate_config(uid, listeners, role)
-        self.command.append(config_path)
-        new_proc = subprocess.Popen(
-            self.command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-        )
+        log_path = Path(get_config_path()) / f"{uid}.log"
+        pool = process_pool(self, create=False) if self.reload_signal is not None else None
+        new_proc = pool.acquire() if pool is not None else None
+        if new_proc is not None:
+            activate(new_proc, config_path, log_path, self.reload_signal)
+            self.logger.info(f"Handed {uid} to idle {self.command[0]} {new_proc.pid}")
+        else:
+            new_proc = SupervisedProcess(self.command + [config_path], log_path, self.logger)
+            supervisor(self.logger).watch(new_proc)
         s2ds_proc.append(new_proc)
-        self.logger.info(f"Updating {self.command} destination (no action required)")
+        ## only return once the proxy accepts connections, release() cleans up on failure
+        wait_ready(self.listeners, new_proc, self.ready_timeout)
+        self.logger.info(f"{self.command[0]} {new_proc.pid} is listening on {self.listeners}")
     
     def generate_config(self, uid, dest_array, role):
-        env = Environment(loader=FileSystemLoader(Path(__file__).parent))
-        template = env.get_template(f"{self.cfg_filename}.j2")
+        template = template_registry().get(f"{self.cfg_filename}.j2")
         key_filename = Path(get_config_path()) / f"{uid}.key"
         pid_filename = Path(get_config_path()) / f"{uid}.pid"
         
@@ -64,6 +167,9 @@ class AbstractSubprocess():
             client="yes" if role == "CONS" else "no",
             key_filename=str(key_filename),
             pid_filename=str(pid_filename),
+            stats_socket=str(self.stats_socket(uid)),
+            conn_rate=self.conn_rate,
+            tuning=self.tuning,
         )
         config_path = Path(get_config_path()) / f"{uid}.conf"
         config_path.write_text(config_content)
@@ -73,14 +179,249 @@ class AbstractSubprocess():
     def write_key_file(self, key_filename, uid):
         key_filename.write_text("client1:" + uid.replace("-", ""))
 
+    def stats_socket(self, uid):
+        return Path(get_config_path()) / f"{uid}.sock"
+
+class AdoptedProcess():
+    """
+    Proxy process started by a previous S2CS run, it mimics the parts of
+    Popen that release() and the supervisors rely on.
+    """
+
+    def __init__(self, pid, args):
+        self.pid = pid
+        self.args = args
+
+    def poll(self):
+        ## Guard against pid reuse by comparing the command line when /proc is available
+        try:
+            os.kill(self.pid, 0)
+            with open(f"/proc/{self.pid}/cmdline", "rb") as f:
+                cmdline = f.read().split(b"\0")[:-1]
+            if cmdline != [str(arg).encode() for arg in self.args]:
+                return 0
+        except FileNotFoundError:
+            pass
+        except (ProcessLookupError, PermissionError):
+            return 0
+        return None
+
+    def terminate(self):
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGTERM)
+
 class StunnelSubprocess(AbstractSubprocess):
+    supports_rate = False
+
     def __init__(self, logger=None):
         super().__init__(logger)
         self.cfg_filename = "stunnel.conf"
         self.command = ["stunnel"]
 
+class NginxSubprocess(AbstractSubprocess):
+    reload_signal = signal.SIGHUP
+
+    def __init__(self, logger=None):
+        super().__init__(logger)
+        self.cfg_filename = "nginx.conf"
+        self.command = ["nginx", "-g", "daemon off;", "-c"]
+
+    def idle_config(self, prefix):
+        return f"pid {prefix}.pid;\nerror_log stderr;\nevents {{ }}\n"
+
 class HaproxySubprocess(AbstractSubprocess):
+    ## in master-worker mode (-W) SIGUSR2 reloads the config
+    reload_signal = signal.SIGUSR2
+
     def __init__(self, logger=None):
         super().__init__(logger)
         self.cfg_filename = "haproxy.cfg"
-        self.command = ["haproxy", "-f"]
\ No newline at end of file
+        ## -db keeps haproxy in the foreground despite "daemon" in haproxy.cfg.j2,
+        ## the supervisor would otherwise see it exit right away
+        self.command = ["haproxy", "-W", "-db", "-f"]
+
+    def idle_config(self, prefix):
+        return (
+            "global\n"
+            f"    pidfile {prefix}.pid\n"
+            "\n"
+            "defaults\n"
+            "    mode tcp\n"
+            "    timeout connect 5000\n"
+            "    timeout client 50000\n"
+            "    timeout server 50000\n"
+            "\n"
+            "listen idle\n"
+            f"    bind {prefix}.sock\n"
+        )
+
+    def stats(self, uid, entry):
+        return haproxy_stats(self.stats_socket(uid), "my_frontend_")
+
+
+class HaproxyMaster():
+    """
+    One long lived HAProxy master process shared by every stream of an S2CS.
+
+    All active streams are rendered into a single configuration file. Adding or
+    removing a stream rewrites that file and signals the master (SIGUSR2), which
+    starts new workers and hands over the listening sockets seamlessly, instead
+    of forking a new haproxy per request.
+
+    The configuration is checked before the master sees it, and a stream that
+    is rejected or whose reload fails is taken out again so the other streams
+    keep reloading.
+    """
+
+    def __init__(self, logger=None, name="haproxy-master"):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.cfg_filename = "haproxy_shared.cfg"
+        self.config_path = Path(get_config_path()) / f"{name}.cfg"
+        self.pid_filename = Path(get_config_path()) / f"{name}.pid"
+        self.stats_socket = Path(get_config_path()) / f"{name}.sock"
+        self.streams = {}
+        self.proc = None
+        self.lock = threading.Lock()
+        self.ready_timeout = READY_TIMEOUT
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def add(self, uid, local_ports, dest_array, conn_rate=0, tuning=None):
+        with self.lock:
+            previous = self.streams.get(uid)
+            self.streams[uid] = {
+                "local_ports": local_ports,
+                "dest_array": dest_array,
+                "conn_rate": conn_rate,
+                "tuning": tuning or {},
+            }
+            try:
+                self.apply()
+            except Exception:
+                ## the next reload must not trip over this stream again
+                if previous is None:
+                    del self.streams[uid]
+                else:
+                    self.streams[uid] = previous
+                self.write_config()
+                raise
+
+    def remove(self, uid):
+        with self.lock:
+            if self.streams.pop(uid, None) is None:
+                return
+            if self.streams:
+                self.apply()
+            else:
+                self.stop()
+
+    def apply(self):
+        self.write_config()
+        check_haproxy_config(self.config_path)
+        if self.proc is None or self.proc.poll() is not None:
+            self.logger.info(f"Starting HAProxy master with {self.config_path}")
+            self.pid_filename.unlink(missing_ok=True)
+            self.proc = subprocess.Popen(
+                ["haproxy", "-W", "-f", str(self.config_path)],
+                ## The master outlives many requests, an unread PIPE would eventually fill up
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                ## outlives a Ctrl-C of S2CS, like the supervised proxies
+                start_new_session=True,
+            )
+            self.wait_worker(None)
+        else:
+            ## the worker pid changes once the master has loaded the new config
+            previous = haproxy_worker_pid(self.stats_socket)
+            self.logger.info(f"Reloading HAProxy master {self.proc.pid}")
+            self.proc.send_signal(signal.SIGUSR2)
+            self.wait_worker(previous)
+
+    def wait_worker(self, previous):
+        """
+        Returns once the master wrote its pidfile and a worker other than
+        previous answers on the stats socket. Until then the master may not
+        handle SIGUSR2 yet, whose default action would kill it.
+        """
+        deadline = time.monotonic() + self.ready_timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise S2DSException(f"HAProxy master exited with {self.proc.poll()}")
+            try:
+                master_pid = int(self.pid_filename.read_text().split()[0])
+            except (OSError, ValueError, IndexError):
+                master_pid = None
+            if master_pid == self.proc.pid:
+                worker = haproxy_worker_pid(self.stats_socket)
+                if worker is not None and worker != previous:
+                    return
+            if time.monotonic() >= deadline:
+                raise S2DSException(f"HAProxy master {self.proc.pid} did not load {self.config_path} in time")
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.logger.info(f"Stopping HAProxy master {self.proc.pid}")
+            self.proc.terminate()
+            self.proc.wait()
+        self.proc = None
+
+    def write_config(self):
+        ## buffer sizes are global, the largest requested by a stream wins
+        tuning = {}
+        for stream in self.streams.values():
+            for name in ("sndbuf", "rcvbuf", "bufsize"):
+                if stream["tuning"].get(name):
+                    tuning[name] = max(tuning.get(name, 0), stream["tuning"][name])
+        template = template_registry().get(f"{self.cfg_filename}.j2")
+        self.config_path.write_text(
+            template.render(
+                streams=self.streams,
+                pid_filename=str(self.pid_filename),
+                stats_socket=str(self.stats_socket),
+                tuning=tuning,
+            )
+        )
+
+
+_master_lock = threading.Lock()
+
+
+def haproxy_master(logger=None):
+    with _master_lock:
+        if not hasattr(haproxy_master, "_instance"):
+            haproxy_master._instance = HaproxyMaster(logger)
+    return haproxy_master._instance
+
+
+class SharedStream():
+    """Handle stored in s2ds_proc for a stream served by the shared master"""
+
+    def __init__(self, master, uid):
+        self.master = master
+        self.uid = uid
+        self.pid = master.pid
+
+    def terminate(self):
+        self.master.remove(self.uid)
+
+
+class SharedHaproxySubprocess(AbstractSubprocess):
+    def __init__(self, logger=None, master=None):
+        super().__init__(logger)
+        self.cfg_filename = "haproxy_shared.cfg"
+        self.command = ["haproxy", "-W", "-f"]
+        self.master = master if master else haproxy_master(self.logger)
+
+    def update_listeners(self, listeners, s2ds_proc, uid, role):
+        self.logger.info(listeners)
+        self.tune(listeners, role)
+        self.master.add(uid, self.local_ports, listeners, self.conn_rate, self.tuning)
+        s2ds_proc.append(SharedStream(self.master, uid))
+        wait_ready(self.listeners, timeout=self.ready_timeout)
+        self.logger.info(f"Added {uid} to HAProxy master {self.master.pid}")
+
+    def stats(self, uid, entry):
+        return haproxy_stats(self.master.stats_socket, f"{uid}_frontend_")
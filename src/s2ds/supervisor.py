@@ -0,0 +1,211 @@
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from src.s2ds.utils import S2DSException
+
+CHECK_INTERVAL = 0.5  # seconds between two checks of the supervised proxies
+READY_TIMEOUT = 10.0  # seconds a proxy gets to bind its listeners
+MIN_BACKOFF = 0.5  # first restart delay, doubled after every crash
+MAX_BACKOFF = 30.0
+STABLE_AFTER = 10.0  # seconds of uptime after which the backoff is reset
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+
+
+def rotate_log(path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """
+    Copies a full log to path.1 (shifting older copies) and truncates it.
+    The proxy keeps writing to its descriptor, opened in append mode, so
+    it does not need to reopen the file.
+    """
+    try:
+        if os.path.getsize(path) < max_bytes:
+            return False
+    except OSError:
+        return False
+    for index in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{index}"):
+            os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+    shutil.copyfile(path, f"{path}.1")
+    os.truncate(path, 0)
+    return True
+
+
+def last_line(path):
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - 4096))
+            lines = f.read().decode(errors="replace").strip().splitlines()
+    except OSError:
+        return ""
+    return lines[-1] if lines else ""
+
+
+def probe_address(address):
+    host, port = address.rsplit(":", 1)
+    ## a proxy listening on every interface is reachable on loopback
+    if host in ("0.0.0.0", "", "*"):
+        host = "127.0.0.1"
+    return host, int(port)
+
+
+def wait_ready(listeners, process=None, timeout=READY_TIMEOUT):
+    """
+    Returns once every listener accepts a TCP connection. Raises an
+    S2DSException when process exits or the listeners are not up in time.
+    """
+    deadline = time.monotonic() + timeout
+    pending = [probe_address(address) for address in listeners]
+    while pending:
+        if process is not None and process.poll() is not None:
+            raise S2DSException(
+                f"{process.args[0]} exited with {process.poll()} before binding its listeners: "
+                f"{last_line(process.log_path)}"
+            )
+        try:
+            with socket.create_connection(pending[0], timeout=0.2):
+                pass
+            pending.pop(0)
+            continue
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            raise S2DSException(f"Listener {pending[0][0]}:{pending[0][1]} not ready after {timeout}s")
+        time.sleep(0.05)
+
+
+class SupervisedProcess():
+    """
+    Proxy process restarted by the supervisor when it exits, it mimics the
+    parts of Popen that release() and the session store rely on. Its output
+    goes to log_path instead of a pipe nobody reads.
+    """
+
+    def __init__(self, args, log_path, logger=None, backoff=MIN_BACKOFF):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.args = args
+        self.log_path = str(log_path)
+        self.min_backoff = backoff
+        self.backoff = backoff
+        self.restarts = 0
+        self.restart_at = None
+        self.stopped = False
+        self.on_restart = None  # called with the process after every restart, from the supervisor thread
+        self.lock = threading.Lock()
+        self.launch()
+
+    def launch(self):
+        rotate_log(self.log_path)
+        with open(self.log_path, "ab") as log:
+            ## a session of its own keeps the proxy out of the SIGINT a terminal sends
+            ## to S2CS's process group, so a --state_db restart can adopt it
+            self.proc = subprocess.Popen(
+                self.args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+        self.started_at = time.monotonic()
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def poll(self):
+        return self.proc.poll()
+
+    def wait(self, timeout=None):
+        return self.proc.wait(timeout)
+
+    def send_signal(self, sig):
+        self.proc.send_signal(sig)
+
+    def terminate(self):
+        with self.lock:
+            self.stopped = True
+            if self.proc.poll() is None:
+                self.proc.terminate()
+
+    def check(self, now):
+        """Called by the supervisor, restarts the proxy once its backoff has passed"""
+        if self.restart(now) and self.on_restart is not None:
+            self.on_restart(self)
+
+    def restart(self, now):
+        with self.lock:
+            if self.stopped:
+                return False
+            rotate_log(self.log_path)
+            code = self.proc.poll()
+            if code is None:
+                if now - self.started_at >= STABLE_AFTER:
+                    self.backoff = self.min_backoff
+                return False
+            if self.restart_at is None:
+                self.restart_at = now + self.backoff
+                self.logger.warning(
+                    f"{self.args[0]} {self.proc.pid} exited with {code}: {last_line(self.log_path)}, "
+                    f"restarting in {self.backoff:.1f}s"
+                )
+                self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+            elif now >= self.restart_at:
+                self.restart_at = None
+                try:
+                    self.launch()
+                except OSError as e:
+                    self.logger.error(f"Could not restart {self.args[0]}: {e}")
+                    return False
+                self.restarts += 1
+                self.logger.info(f"Restarted {self.args[0]} as {self.proc.pid}")
+                return True
+            return False
+
+
+class Supervisor():
+    """Checks every supervised proxy from one daemon thread"""
+
+    def __init__(self, logger=None, interval=CHECK_INTERVAL):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.interval = interval
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, process):
+        with self.lock:
+            self.processes.add(process)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="s2ds-supervisor", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        with self.lock:
+            ## released proxies are not restarted, forget them
+            self.processes = {process for process in self.processes if not process.stopped}
+            processes = list(self.processes)
+        now = time.monotonic()
+        for process in processes:
+            try:
+                process.check(now)
+            except Exception as e:
+                self.logger.error(f"Error supervising {process.args[0]}: {e}")
+
+
+_supervisor_lock = threading.Lock()
+
+
+def supervisor(logger=None):
+    with _supervisor_lock:
+        if not hasattr(supervisor, "_instance"):
+            supervisor._instance = Supervisor(logger)
+    return supervisor._instance
@@ -0,0 +1,72 @@
+import threading
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from src.s2ds.utils import get_config_path
+
+TEMPLATE_DIR = Path(__file__).parent
+TEMPLATES = ["haproxy.cfg.j2", "haproxy_shared.cfg.j2", "nginx.conf.j2", "stunnel.conf.j2"]
+
+
+class TemplateRegistry:
+    """
+    Compiled proxy configuration templates, shared by every S2DS backend.
+
+    Templates are compiled once and rendering never touches the disk.
+    The compiled bytecode is cached on disk, so later processes skip
+    compilation. With auto_reload, a template is recompiled when its file
+    changes, at the cost of a stat() per render.
+    """
+
+    def __init__(self, searchpath=TEMPLATE_DIR, auto_reload=False, bytecode_dir=None):
+        bytecode_cache = None
+        if bytecode_dir is not None:
+            Path(bytecode_dir).mkdir(parents=True, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(str(bytecode_dir))
+        self.auto_reload = auto_reload
+        self.env = Environment(
+            loader=FileSystemLoader(searchpath),
+            auto_reload=auto_reload,
+            bytecode_cache=bytecode_cache,
+        )
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        template = self.templates.get(name)
+        if template is None or (self.auto_reload and not template.is_up_to_date):
+            with self.lock:
+                template = self.env.get_template(name)
+                self.templates[name] = template
+        return template
+
+    def render(self, name, **context):
+        return self.get(name).render(**context)
+
+    def preload(self, names=TEMPLATES):
+        for name in names:
+            self.get(name)
+
+
+_registry_lock = threading.Lock()
+
+
+def template_registry():
+    """Returns the process-wide registry, its templates are compiled on first use"""
+    with _registry_lock:
+        if not hasattr(template_registry, "_instance"):
+            template_registry._instance = TemplateRegistry(
+                bytecode_dir=Path(get_config_path()) / "jinja-cache"
+            )
+    return template_registry._instance
+
+
+def configure_templates(auto_reload=False):
+    """Called once at S2CS startup, replaces the registry and compiles every template"""
+    registry = TemplateRegistry(
+        auto_reload=auto_reload, bytecode_dir=Path(get_config_path()) / "jinja-cache"
+    )
+    registry.preload()
+    with _registry_lock:
+        template_registry._instance = registry
+    return registry
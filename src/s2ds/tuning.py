@@ -0,0 +1,131 @@
+import logging
+import os
+import re
+import socket
+import subprocess
+
+MIN_BUFFER = 64 * 1024
+MAX_BUFFER = 64 * 1024 * 1024
+MIN_BUFSIZE = 16 * 1024  # proxy buffers, tune.bufsize for HAProxy
+MAX_BUFSIZE = 1024 * 1024
+DEFAULT_RTT = 0.1  # seconds, used by the auto profile when the RTT is not known
+RTT_UNITS = {"us": 1e-6, "ms": 1e-3, "s": 1.0}
+
+PROFILES = {
+    "lan": {"nodelay": True},
+    "wan": {
+        "sndbuf": 16 * 1024 * 1024,
+        "rcvbuf": 16 * 1024 * 1024,
+        "bufsize": 256 * 1024,
+        "congestion": "bbr",
+        "splice": True,
+    },
+}
+
+
+def tuning_error(tuning):
+    """Returns what is wrong with a Tuning message, or None"""
+    if tuning.profile and tuning.profile != "auto" and tuning.profile not in PROFILES:
+        return f"Unknown tuning profile '{tuning.profile}', expected auto, {', '.join(PROFILES)}"
+    for name in ("sndbuf", "rcvbuf", "bufsize", "rtt_ms"):
+        if getattr(tuning, name) < 0:
+            return f"Tuning {name} must not be negative"
+    return None
+
+
+def available_congestion_controls():
+    """Algorithms this process can set, without privileges only the allowed ones"""
+    name = "available" if os.geteuid() == 0 else "allowed"
+    try:
+        with open(f"/proc/sys/net/ipv4/tcp_{name}_congestion_control") as f:
+            return set(f.read().split())
+    except OSError:
+        return set()
+
+
+def kernel_rtt(address, timeout=1.0):
+    """
+    RTT in seconds the kernel recorded for the host of address from earlier
+    TCP connections (ip tcp_metrics), None when it has none. Only local
+    state is read, connecting to the address would open a connection to
+    the application behind it.
+    """
+    host = address.rsplit(":", 1)[0].strip("[]")
+    try:
+        host = socket.getaddrinfo(host, None)[0][4][0]
+        output = subprocess.run(
+            ["ip", "tcp_metrics", "show", host], capture_output=True, text=True, timeout=timeout
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r"\brtt (\d+)(us|ms|s)\b", output)
+    return int(match.group(1)) * RTT_UNITS[match.group(2)] if match else None
+
+
+def bdp_profile(rate, rtt):
+    """Buffers for a connection carrying rate bytes per second over rtt seconds"""
+    bdp = rate * rtt
+    buffer = int(min(MAX_BUFFER, max(MIN_BUFFER, 2 * bdp)))
+    return {
+        "sndbuf": buffer,
+        "rcvbuf": buffer,
+        "bufsize": int(min(MAX_BUFSIZE, max(MIN_BUFSIZE, bdp))),
+        "congestion": "bbr",
+        "splice": True,
+    }
+
+
+def resolve_tuning(tuning, rate=0, remote=None, logger=None):
+    """
+    Turns a Tuning message into the settings rendered into the proxy
+    configs: sndbuf, rcvbuf, nodelay, congestion, bufsize and splice, only
+    the ones that are set. rate is the bytes per second of one connection,
+    remote is the address whose RTT the auto profile takes from the kernel
+    when rtt_ms is not set.
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    if tuning is None:
+        return {}
+    settings = {}
+    if tuning.profile == "auto":
+        rtt = tuning.rtt_ms / 1000 if tuning.rtt_ms else None
+        if rtt is None and remote is not None:
+            rtt = kernel_rtt(remote)
+        if rtt is None:
+            logger.warning(f"RTT unknown, sizing buffers for {DEFAULT_RTT * 1000:.0f} ms")
+            rtt = DEFAULT_RTT
+        if rate:
+            settings.update(bdp_profile(rate, rtt))
+            logger.info(f"BDP of {rate} B/s over {rtt * 1000:.1f} ms is {int(rate * rtt)} bytes")
+        else:
+            ## without a rate there is no BDP to size for
+            settings.update(PROFILES["wan"])
+    elif tuning.profile:
+        settings.update(PROFILES[tuning.profile])
+    for name in ("sndbuf", "rcvbuf", "bufsize", "congestion"):
+        if getattr(tuning, name):
+            settings[name] = getattr(tuning, name)
+    for name in ("nodelay", "splice"):
+        if tuning.HasField(name):
+            settings[name] = getattr(tuning, name)
+    congestion = settings.get("congestion")
+    if congestion and congestion not in available_congestion_controls():
+        logger.warning(f"Congestion control '{congestion}' is not available, keeping the system default")
+        del settings["congestion"]
+    return settings
+
+
+def tune_socket(sock, settings):
+    """Applies the socket level settings, set the buffers before listen() or connect()"""
+    if settings.get("sndbuf"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings["sndbuf"])
+    if settings.get("rcvbuf"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, settings["rcvbuf"])
+    if "nodelay" in settings:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(settings["nodelay"]))
+    if settings.get("congestion") and hasattr(socket, "TCP_CONGESTION"):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, settings["congestion"].encode())
+        except OSError as e:
+            ## EPERM when the process lacks CAP_NET_ADMIN, the connection keeps the system default
+            logging.getLogger(__name__).debug(f"Could not set congestion control {settings['congestion']}: {e}")
@@ -28,6 +28,16 @@ def get_config_path():
         return default_path
 
 
+def connection_rate(rate, num_conn):
+    """
+    Bytes per second allowed on each connection of a stream, the stream's
+    rate (Request.rate, in kB/s) is split evenly. 0 means unlimited.
+    """
+    if rate <= 0 or num_conn <= 0:
+        return 0
+    return max(1, rate * 1000 // num_conn)
+
+
 class S2DS:
     ## TODO Cleanup
     def __init__(self):
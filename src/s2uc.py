@@ -1,32 +1,71 @@
+## grpc, the protos and globus_sdk are imported by the commands that use
+## them, s2uc runs once per command and most commands need only some of them
 import click
-import grpc
 import uuid
-import time
 import sys
-from concurrent import futures
-from globus_sdk import NativeAppAuthClient
-from globus_sdk.scopes import ScopeBuilder
-from .proto import scistream_pb2
-from .proto import scistream_pb2_grpc
+import shlex
 from . import utils
-import importlib.metadata
 
-__version__ = importlib.metadata.version("scistream-proto")
+
+def __getattr__(name):
+    ## the version lookup scans the installed distributions
+    if name == "__version__":
+        import importlib.metadata
+
+        return importlib.metadata.version("scistream-proto")
+    raise AttributeError(name)
 
 
 @click.group()
-@click.version_option(__version__, "--version", "-v", help="Show the version and exit")
+@click.version_option(
+    None, "--version", "-v", package_name="scistream-proto", help="Show the version and exit"
+)
 def cli():
     pass
 
 
 linkprompt = "Please authenticate with Globus here"
+## seconds waited before HELLO when S2CS cannot serve watch, what s2uc slept before watch existed
+HELLO_DELAY = 0.5
 
 
 def get_client():
+    from globus_sdk import NativeAppAuthClient
     return NativeAppAuthClient("4787c84e-9c55-4881-b941-cb6720cea11c")
 
 
+def parse_tuning(ctx, param, value):
+    """--tuning wan or --tuning profile=auto,rtt_ms=80,nodelay=true into a Tuning message"""
+    from .proto import scistream_pb2
+    if not value:
+        return None
+    fields = {}
+    for item in value.split(","):
+        name, _, setting = item.partition("=")
+        if not setting:
+            name, setting = "profile", name
+        field = scistream_pb2.Tuning.DESCRIPTOR.fields_by_name.get(name)
+        if field is None:
+            raise click.BadParameter(f"unknown tuning setting '{name}'")
+        if field.type == field.TYPE_BOOL:
+            fields[name] = setting.lower() in ("1", "true", "yes", "on")
+        elif field.type == field.TYPE_INT32:
+            if not setting.isdigit():
+                raise click.BadParameter(f"{name} must be a non-negative integer")
+            fields[name] = int(setting)
+        else:
+            fields[name] = setting
+    return scistream_pb2.Tuning(**fields)
+
+
+tuning_option = click.option(
+    "--tuning",
+    default="",
+    callback=parse_tuning,
+    help="Tuning profile (lan, wan, auto) and/or settings, e.g. profile=auto,rtt_ms=80",
+)
+
+
 @cli.command()
 @click.option("--scope", default="c42c0dac-0a52-408e-a04f-5d31bfe0aef8")
 def login(scope):
@@ -40,6 +79,7 @@ def login(scope):
     authorization page. After consenting you will then need to copy and paste the
     given access code from the web to the CLI.
     """
+    from globus_sdk.scopes import ScopeBuilder
     adapter = utils.storage_adapter()
     try:
         tokens = utils.get_access_token(scope)
@@ -120,22 +160,20 @@ def logout():
 )
 @utils.authorize
 def release(uid, s2cs, server_cert, metadata=None):
+    from .proto import scistream_pb2
+    from .channel import control_stub
     try:
-        with open(server_cert, "rb") as f:
-            trusted_certs = f.read()
-        credentials = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
-        with grpc.secure_channel(s2cs, credentials) as channel:
-            stub = scistream_pb2_grpc.ControlStub(channel)
-            msg = scistream_pb2.Release(uid=uid)
-            resp = stub.release(msg, metadata=metadata)
-            print("Release completed")
+        stub = control_stub(s2cs, server_cert)
+        msg = scistream_pb2.Release(uid=uid)
+        resp = stub.release(msg, metadata=metadata)
+        print("Release completed")
     except Exception as e:
         print(f"Error during release: {e}")
 
 
 @cli.command()
 @click.option("--num_conn", type=int, default=5)
-@click.option("--rate", type=int, default=10000)
+@click.option("--rate", type=int, default=0, help="Maximum rate of the stream in kB/s, 0 for unlimited")
 @click.option("--s2cs", default="localhost:5000")
 @click.option(
     "--server_cert", default="server.crt", help="Path to the server certificate file"
@@ -148,87 +186,172 @@ def release(uid, s2cs, server_cert, metadata=None):
     default="5074,5075,5076,37000,47000",
     help="Comma-separated list of receiver ports",
 )
+@tuning_option
 def inbound_request(
-    num_conn, rate, s2cs, server_cert, mock, scope, remote_ip, receiver_ports
+    num_conn, rate, s2cs, server_cert, mock, scope, remote_ip, receiver_ports, tuning
 ):
+    from concurrent import futures
+    from .proto import scistream_pb2
+    from .channel import control_stub
     try:
-        trusted_certs = open(server_cert, "rb").read()
-        channel = grpc.secure_channel(
-            s2cs,
-            grpc.ssl_channel_credentials(root_certificates=trusted_certs)
-        )
-        with channel:
-            prod_stub = scistream_pb2_grpc.ControlStub(channel)
+        prod_stub = control_stub(s2cs, server_cert)
+
+        scope = utils.get_scope_id(s2cs) if scope == "" else scope
+        uid = "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3" if mock else str(uuid.uuid1())
 
-            scope = utils.get_scope_id(s2cs) if scope == "" else scope
-            uid = "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3" if mock else str(uuid.uuid1())
+        click.echo("uid; s2cs; access_token; role")
+        click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} PROD")
 
-            click.echo("uid; s2cs; access_token; role")
+        with futures.ThreadPoolExecutor(max_workers=3) as executor:
+            receivers = [f"{remote_ip}:{port}" for port in receiver_ports.split(",")]
+            click.echo("sending client request message")
+            prod_resp_future = executor.submit(
+                client_request,
+                prod_stub,
+                uid,
+                "PROD",
+                num_conn,
+                rate,
+                scope_id=scope,
+                tuning=tuning,
+            )
+            click.echo("waiting for the ports to be reserved")
+            wait_for_reservation(prod_stub, [uid], scope_id=scope)
+            click.echo("sending for hello message")
+            hello_response_future = executor.submit(
+                hello_request, prod_stub, uid, "PROD", receivers, scope_id=scope
+            )
+            prod_resp = prod_resp_future.result(timeout=5)
+            hello_response = hello_response_future.result(timeout=5)
+        if hello_response is None:
+            click.echo("Request Failed, no Hello response")
+            return  # Exit if hello message failed
+
+        update(prod_stub, uid, prod_resp.prod_listeners, "PROD", scope_id=scope)
+        click.echo(f"Listeners: {prod_resp.listeners}")
+    except Exception as e:
+        click.echo(f"Error: {e}", err=True)
+
+
+@cli.command()
+@click.option("--num_streams", type=int, default=2, help="Number of streams requested in one call")
+@click.option("--num_conn", type=int, default=5)
+@click.option("--rate", type=int, default=0, help="Maximum rate of the stream in kB/s, 0 for unlimited")
+@click.option("--s2cs", default="localhost:5000")
+@click.option(
+    "--server_cert", default="server.crt", help="Path to the server certificate file"
+)
+@click.option("--scope", default="")
+@click.option("--remote_ip", default="localhost")
+@click.option(
+    "--receiver_ports",
+    default="5074,5075,5076,37000,47000",
+    help="Comma-separated list of receiver ports, shared by every stream",
+)
+@tuning_option
+def batch_request(
+    num_streams, num_conn, rate, s2cs, server_cert, scope, remote_ip, receiver_ports, tuning
+):
+    """
+    Inbound request for several streams over a single channel.
+
+    S2CS reserves the ports of every stream in one call, then the HELLOs
+    and the UPDATEs, which launch the proxies, are sent for all of them
+    concurrently.
+    """
+    from concurrent import futures
+    from .proto import scistream_pb2
+    from .channel import control_stub
+    try:
+        prod_stub = control_stub(s2cs, server_cert)
+
+        scope = utils.get_scope_id(s2cs) if scope == "" else scope
+        uids = [str(uuid.uuid1()) for _ in range(num_streams)]
+        receivers = [f"{remote_ip}:{port}" for port in receiver_ports.split(",")]
+
+        click.echo("uid; s2cs; access_token; role")
+        for uid in uids:
             click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} PROD")
 
-            with futures.ThreadPoolExecutor(max_workers=3) as executor:
-                receivers = [f"{remote_ip}:{port}" for port in receiver_ports.split(",")]
-                click.echo("sending client request message")
-                prod_resp_future = executor.submit(
-                    client_request, prod_stub, uid, "PROD", num_conn, rate, scope_id=scope
-                )
-                click.echo("waiting for hello message")
-                time.sleep(0.5)
-                click.echo("sending for hello message")
-                hello_response_future = executor.submit(
-                    hello_request, prod_stub, uid, "PROD", receivers, scope_id=scope
+        with futures.ThreadPoolExecutor(max_workers=num_streams + 1) as executor:
+            click.echo("sending batch request message")
+            batch_resp_future = executor.submit(
+                client_batch_request,
+                prod_stub,
+                uids,
+                "PROD",
+                num_conn,
+                rate,
+                scope_id=scope,
+                tuning=tuning,
+            )
+            wait_for_reservation(prod_stub, uids, scope_id=scope)
+            click.echo("sending hello messages")
+            hello_futures = [
+                executor.submit(hello_request, prod_stub, uid, "PROD", receivers, scope_id=scope)
+                for uid in uids
+            ]
+            batch_resp = batch_resp_future.result(timeout=5)
+            for hello_future in hello_futures:
+                hello_future.result(timeout=5)
+            if batch_resp is None:
+                click.echo("Batch request failed")
+                return
+
+            for uid, error in batch_resp.errors.items():
+                click.echo(f"{uid} failed: {error}", err=True)
+            ## each UPDATE starts the proxy of its stream, S2CS serves them in parallel
+            update_futures = {
+                uid: executor.submit(
+                    update, prod_stub, uid, prod_resp.prod_listeners, "PROD", scope_id=scope
                 )
-                prod_resp = prod_resp_future.result(timeout=5)
-                hello_response = hello_response_future.result(timeout=5)
-            if hello_response is None:
-                click.echo("Request Failed, no Hello response")
-                return  # Exit if hello message failed
-
-            update(prod_stub, uid, prod_resp.prod_listeners, "PROD", scope_id=scope)
-            click.echo(f"Listeners: {prod_resp.listeners}")
+                for uid, prod_resp in batch_resp.responses.items()
+            }
+            for uid, update_future in update_futures.items():
+                update_future.result()
+                click.echo(f"{uid} Listeners: {batch_resp.responses[uid].listeners}")
     except Exception as e:
         click.echo(f"Error: {e}", err=True)
 
 
 @cli.command()
 @click.option("--num_conn", type=int, default=5)
-@click.option("--rate", type=int, default=10000)
+@click.option("--rate", type=int, default=0, help="Maximum rate of the stream in kB/s, 0 for unlimited")
 @click.option("--s2cs", default="localhost:5000")
 @click.option(
     "--server_cert", default="server.crt", help="Path to the server certificate file"
 )
 @click.option("--mock", default=False)
 @click.option("--scope", default="")
-def prod_req(num_conn, rate, s2cs, server_cert, mock, scope):
-    with open(server_cert, "rb") as f:
-        trusted_certs = f.read()
-        credentials = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
-    with grpc.secure_channel(s2cs, credentials) as channel:
-        prod_stub = scistream_pb2_grpc.ControlStub(channel)
-
-        uid = str(uuid.uuid1()) if not mock else "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3"
-        click.echo("uid; s2cs; access_token; role")
-        if scope == "":
-            scope = utils.get_scope_id(s2cs)
-        click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} PROD")
-        with futures.ThreadPoolExecutor(max_workers=2) as executor:
-            click.echo("waiting for hello message")
-            prod_resp_future = executor.submit(
-                client_request, prod_stub, uid, "PROD", num_conn, rate, scope_id=scope
-            )
-            prod_resp = prod_resp_future.result()
+@tuning_option
+def prod_req(num_conn, rate, s2cs, server_cert, mock, scope, tuning):
+    from concurrent import futures
+    from .channel import control_stub
+    prod_stub = control_stub(s2cs, server_cert)
+
+    uid = str(uuid.uuid1()) if not mock else "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3"
+    click.echo("uid; s2cs; access_token; role")
+    if scope == "":
+        scope = utils.get_scope_id(s2cs)
+    click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} PROD")
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        click.echo("waiting for hello message")
+        prod_resp_future = executor.submit(
+            client_request, prod_stub, uid, "PROD", num_conn, rate, scope_id=scope, tuning=tuning
+        )
+        prod_resp = prod_resp_future.result()
 
-        print(prod_resp)  # Should this be printed?
-        # Extracting listeners
-        prod_lstn = prod_resp.listeners
-        destination_ports = prod_resp.prod_listeners
-        update(prod_stub, uid, destination_ports, "PROD", scope_id=scope)
-        print(prod_resp.listeners)
+    print(prod_resp)  # Should this be printed?
+    # Extracting listeners
+    prod_lstn = prod_resp.listeners
+    destination_ports = prod_resp.prod_listeners
+    update(prod_stub, uid, destination_ports, "PROD", scope_id=scope)
+    print(prod_resp.listeners)
 
 
 @cli.command()
 @click.option("--num_conn", type=int, default=5)
-@click.option("--rate", type=int, default=10000)
+@click.option("--rate", type=int, default=0, help="Maximum rate of the stream in kB/s, 0 for unlimited")
 @click.option("--s2cs", default="localhost:6000")
 @click.option("--scope", default="")
 @click.option(
@@ -242,53 +365,161 @@ def prod_req(num_conn, rate, s2cs, server_cert, mock, scope):
 )
 @click.argument("uid")
 @click.argument("prod_lstn")
+@tuning_option
 def outbound_request(
-    num_conn, rate, s2cs, scope, server_cert, remote_ip, receiver_ports, uid, prod_lstn
+    num_conn, rate, s2cs, scope, server_cert, remote_ip, receiver_ports, uid, prod_lstn, tuning
 ):  # uid and prod_lstn are dependencies from PROD context
-    with open(server_cert, "rb") as f:
-        trusted_certs = f.read()
-    credentials = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
-    with grpc.secure_channel(s2cs, credentials) as channel:
-        cons_stub = scistream_pb2_grpc.ControlStub(channel)
+    from concurrent import futures
+    from .proto import scistream_pb2
+    from .channel import control_stub
+    cons_stub = control_stub(s2cs, server_cert)
 
-        scope = utils.get_scope_id(s2cs) if scope == "" else scope
+    scope = utils.get_scope_id(s2cs) if scope == "" else scope
 
-        click.echo("uid; s2cs; access_token; role")
-        click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} CONS")
+    click.echo("uid; s2cs; access_token; role")
+    click.echo(f"{uid} {s2cs} {utils.get_access_token(scope)} CONS")
 
-        with futures.ThreadPoolExecutor(max_workers=3) as executor:
-            receivers = [f"{remote_ip}:{port}" for port in receiver_ports.split(",")]
-            cons_future = executor.submit(
-                client_request, cons_stub, uid, "CONS", num_conn, rate, scope_id=scope
-            )
-            click.echo("waiting for hello message")
-            time.sleep(0.5)
+    with futures.ThreadPoolExecutor(max_workers=3) as executor:
+        receivers = [f"{remote_ip}:{port}" for port in receiver_ports.split(",")]
+        cons_future = executor.submit(
+            client_request, cons_stub, uid, "CONS", num_conn, rate, scope_id=scope, tuning=tuning
+        )
+        click.echo("waiting for the ports to be reserved")
+        wait_for_reservation(cons_stub, [uid], scope_id=scope)
 
-            hello_response_future = executor.submit(
-                hello_request, cons_stub, uid, "PROD", receivers, scope_id=scope
+        hello_response_future = executor.submit(
+            hello_request, cons_stub, uid, "PROD", receivers, scope_id=scope
+        )
+
+        cons_resp = cons_future.result(timeout=5)
+    if not cons_resp:
+        click.echo("Request failed", err=True)
+        return
+    click.echo(f"Listeners: {cons_resp.listeners}")
+    listener_array = prod_lstn.split(",") if "," in prod_lstn else [prod_lstn]
+    update(cons_stub, uid, listener_array, "CONS", scope_id=scope)
+
+
+@cli.command()
+@click.argument("uid", default="")
+@click.option("--s2cs", default="localhost:5000")
+@click.option(
+    "--server_cert", default="server.crt", help="Path to the server certificate file"
+)
+@utils.authorize
+def watch(uid, s2cs, server_cert, metadata=None):
+    """
+    Prints the state transitions of a session as S2CS reports them,
+    or of every session when no uid is given.
+    """
+    import grpc
+    from .proto import scistream_pb2
+    from .channel import control_stub
+    try:
+        stub = control_stub(s2cs, server_cert)
+        for event in stub.watch(scistream_pb2.WatchRequest(uid=uid), metadata=metadata):
+            state = scistream_pb2.SessionEvent.State.Name(event.state)
+            click.echo(
+                f"{event.uid} {state} listeners={list(event.listeners)} "
+                f"prod_listeners={list(event.prod_listeners)} {event.message}".rstrip()
             )
+    except KeyboardInterrupt:
+        pass
+    except grpc.RpcError as e:
+        click.echo(f"Error during watch: {e.details()}", err=True)
 
-            cons_resp = cons_future.result(timeout=5)
-        if not cons_resp:
-            click.echo("Request failed", err=True)
-            return
-        click.echo(f"Listeners: {cons_resp.listeners}")
-        listener_array = prod_lstn.split(",") if "," in prod_lstn else [prod_lstn]
-        update(cons_stub, uid, listener_array, "CONS", scope_id=scope)
+
+@cli.command()
+def session():
+    """
+    Runs s2uc commands read from stdin, one per line, in a single process.
+
+    Commands reuse the gRPC channels opened by the previous ones, so scripts
+    that drive many streams against the same S2CS only pay the TLS handshake
+    once. The session ends with its input or with "exit".
+    """
+    interactive = sys.stdin.isatty()
+    while True:
+        if interactive:
+            click.echo("s2uc> ", nl=False)
+        line = sys.stdin.readline()
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            ## e.g. unbalanced quotes, reported like a failed command
+            click.ClickException(f"Could not parse {line.strip()!r}: {e}").show()
+            continue
+        if not line or args[:1] == ["exit"]:
+            break
+        if not args or args[0] == "session":
+            continue
+        try:
+            cli.main(args, prog_name="s2uc", standalone_mode=False)
+        except click.ClickException as e:
+            e.show()
+        except (click.Abort, SystemExit):
+            ## a failed command does not end the session
+            pass
+
+
+@utils.authorize
+def wait_for(stub, uids, states, timeout=30, scope_id="", metadata=None):
+    """
+    Blocks until every uid has reached one of states, returns the uids that
+    failed or were released instead. Replaces sleeping until S2CS is ready
+    for HELLO, unless S2CS predates watch or has no worker to spare for it.
+    """
+    import grpc
+    import time
+    from .proto import scistream_pb2
+    pending = set(uids)
+    failed = set()
+    ## a single uid stream ends by itself, otherwise every session is watched
+    watch_uid = uids[0] if len(uids) == 1 else ""
+    events = stub.watch(scistream_pb2.WatchRequest(uid=watch_uid), metadata=metadata, timeout=timeout)
+    try:
+        for event in events:
+            if event.uid not in pending:
+                continue
+            if event.state in states:
+                pending.discard(event.uid)
+            elif event.state in (scistream_pb2.SessionEvent.FAILED, scistream_pb2.SessionEvent.RELEASED):
+                click.echo(f"{event.uid} failed: {event.message}", err=True)
+                pending.discard(event.uid)
+                failed.add(event.uid)
+            if not pending:
+                break
+    except grpc.RpcError as e:
+        if e.code() not in (grpc.StatusCode.UNIMPLEMENTED, grpc.StatusCode.RESOURCE_EXHAUSTED):
+            raise
+        time.sleep(HELLO_DELAY)
+    finally:
+        events.cancel()
+    return failed
+
+
+def wait_for_reservation(stub, uids, timeout=30, scope_id=""):
+    """Blocks until S2CS has reserved the ports of every uid and accepts their HELLO"""
+    from .proto import scistream_pb2
+    ## S2CS before PORTS_RESERVED reported PROXY_UP once the ports were reserved
+    states = (scistream_pb2.SessionEvent.PORTS_RESERVED, scistream_pb2.SessionEvent.PROXY_UP)
+    return wait_for(stub, uids, states, timeout=timeout, scope_id=scope_id)
 
 
 @utils.authorize
-def client_request(stub, uid, role, num_conn, rate, scope_id="", metadata=None):
+def client_request(stub, uid, role, num_conn, rate, scope_id="", metadata=None, tuning=None):
     """
     This behaves slightly different than release,
     release gets an IP:port tuple as input
     This receives the grpc stub
     Not sure what are the implications
     """
+    import grpc
+    from .proto import scistream_pb2
     try:
         print("started client request")
         request = scistream_pb2.Request(
-            uid=uid, role=role, num_conn=num_conn, rate=rate
+            uid=uid, role=role, num_conn=num_conn, rate=rate, tuning=tuning
         )
         response = stub.req(request, metadata=metadata)
         return response
@@ -300,8 +531,33 @@ def client_request(stub, uid, role, num_conn, rate, scope_id="", metadata=None):
             click.echo(f"Another GRPC error occurred: {e.details()}")
 
 
+@utils.authorize
+def client_batch_request(stub, uids, role, num_conn, rate, scope_id="", metadata=None, tuning=None):
+    """Same as client_request for every uid, in a single batch_req call"""
+    import grpc
+    from .proto import scistream_pb2
+    try:
+        request = scistream_pb2.BatchRequest(
+            requests=[
+                scistream_pb2.Request(
+                    uid=uid, role=role, num_conn=num_conn, rate=rate, tuning=tuning
+                )
+                for uid in uids
+            ]
+        )
+        return stub.batch_req(request, metadata=metadata)
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.UNAUTHENTICATED:
+            click.echo(f"Please obtain new credentials: {e.details()}")
+            sys.exit(1)
+        else:
+            click.echo(f"Another GRPC error occurred: {e.details()}")
+
+
 @utils.authorize
 def hello_request(stub, uid, role, listeners, scope_id="", metadata=None):
+    import grpc
+    from .proto import scistream_pb2
     hello_req = scistream_pb2.Hello(uid=uid, role=role)
     hello_req.prod_listeners.extend(listeners)
     try:
@@ -320,6 +576,7 @@ def hello_request(stub, uid, role, listeners, scope_id="", metadata=None):
 @utils.authorize
 def update(stub, uid, remote_listeners, role="PROD", scope_id="", metadata=None):
     """This behaves very similar to client_request"""
+    from .proto import scistream_pb2
     try:
         update_request = scistream_pb2.UpdateTargets(
             uid=uid, remote_listeners=remote_listeners, role=role
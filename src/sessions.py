@@ -0,0 +1,115 @@
+import collections.abc
+import threading
+
+
+class UidLock:
+    """
+    Reentrant lock of one uid. users counts the threads holding or waiting
+    for it, guarded by the shard lock, the table forgets the lock once it
+    drops to zero so a later lock(uid) cannot get a second lock while this
+    one is held.
+    """
+
+    def __init__(self, table, uid):
+        self.table = table
+        self.uid = uid
+        self.rlock = threading.RLock()
+        self.users = 0
+
+    def __enter__(self):
+        self.rlock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.rlock.release()
+        self.table.unlock(self.uid, self)
+
+
+class SessionTable(collections.abc.MutableMapping):
+    """
+    Thread safe uid -> entry mapping used as the S2CS resource_map.
+
+    Entries are spread over shards, each guarded by its own lock, so
+    concurrent stream setups only contend when their uids share a shard.
+    lock(uid) returns a per-uid reentrant lock that serializes REQ, HELLO,
+    UPDATE and RELEASE for the same stream without blocking other streams,
+    it is used as a context manager.
+    """
+
+    def __init__(self, num_shards=16):
+        self.entries = [{} for _ in range(num_shards)]
+        self.uid_locks = [{} for _ in range(num_shards)]
+        self.shard_locks = [threading.Lock() for _ in range(num_shards)]
+
+    def shard(self, uid):
+        return hash(uid) % len(self.entries)
+
+    def lock(self, uid):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            if uid not in self.uid_locks[index]:
+                self.uid_locks[index][uid] = UidLock(self, uid)
+            lock = self.uid_locks[index][uid]
+            lock.users += 1
+            return lock
+
+    def unlock(self, uid, lock):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            lock.users -= 1
+            if lock.users == 0 and self.uid_locks[index].get(uid) is lock:
+                del self.uid_locks[index][uid]
+
+    def add(self, uid, entry):
+        """Inserts entry unless uid is already present, returns whether it did"""
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            if uid in self.entries[index]:
+                return False
+            self.entries[index][uid] = entry
+            return True
+
+    def pop(self, uid, *default):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            return self.entries[index].pop(uid, *default)
+
+    def __getitem__(self, uid):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            return self.entries[index][uid]
+
+    def __setitem__(self, uid, entry):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            self.entries[index][uid] = entry
+
+    def __delitem__(self, uid):
+        self.pop(uid)
+
+    def __contains__(self, uid):
+        index = self.shard(uid)
+        with self.shard_locks[index]:
+            return uid in self.entries[index]
+
+    def __iter__(self):
+        ## iterate over a snapshot, entries may come and go meanwhile
+        uids = []
+        for index, entries in enumerate(self.entries):
+            with self.shard_locks[index]:
+                uids.extend(entries)
+        return iter(uids)
+
+    def __len__(self):
+        count = 0
+        for index, entries in enumerate(self.entries):
+            with self.shard_locks[index]:
+                count += len(entries)
+        return count
+
+    def __repr__(self):
+        snapshot = {}
+        for index, entries in enumerate(self.entries):
+            with self.shard_locks[index]:
+                snapshot.update(entries)
+        return repr(snapshot)
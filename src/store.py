@@ -0,0 +1,59 @@
+import json
+import sqlite3
+import subprocess
+import threading
+
+from .s2ds.subproc import AdoptedProcess
+from .s2ds.supervisor import SupervisedProcess
+
+
+class SessionStore:
+    """
+    SQLite record of the live S2CS sessions.
+
+    Every change to a session is written before the RPC returns, so a
+    restarted S2CS can re-adopt the proxy processes that outlived it.
+    Only sessions served by separate processes can be re-adopted, in-process
+    data planes die with S2CS.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (uid TEXT PRIMARY KEY, type TEXT, record TEXT)"
+        )
+        self.lock = threading.Lock()
+
+    def save(self, uid, type, entry):
+        processes = entry.get("s2ds_proc", [])
+        record = {
+            "role": entry["role"],
+            "num_conn": entry["num_conn"],
+            "rate": entry["rate"],
+            "ports": entry.get("ports", []),
+            "listeners": list(entry.get("listeners", [])),
+            "prod_listeners": list(entry.get("prod_listeners", [])),
+            "prods2cs_listeners": list(entry.get("prods2cs_listeners", [])),
+            "processes": [
+                {"pid": proc.pid, "args": [str(arg) for arg in proc.args]}
+                for proc in processes
+                if isinstance(proc, (subprocess.Popen, AdoptedProcess, SupervisedProcess))
+            ],
+        }
+        record["adoptable"] = bool(processes) and len(record["processes"]) == len(processes)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (uid, type, json.dumps(record)),
+            )
+
+    def delete(self, uid):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE uid = ?", (uid,))
+
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT uid, type, record FROM sessions").fetchall()
+        return [(uid, type, json.loads(record)) for uid, type, record in rows]
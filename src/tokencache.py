@@ -0,0 +1,70 @@
+import collections
+import hashlib
+import threading
+import time
+
+
+class TokenCache:
+    """
+    Bounded LRU of token validation results, keyed by the SHA-256 of the token.
+
+    A valid token is kept until it expires or for max_ttl seconds, whichever
+    comes first, an invalid one for negative_ttl seconds so that a client
+    retrying with a bad token does not reach Globus on every attempt.
+    Tokens themselves are never stored.
+    """
+
+    def __init__(self, maxsize=1024, max_ttl=300, negative_ttl=10, metrics=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.metrics = metrics
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        """Returns the cached validity of token, None when it has to be checked"""
+        key = self.key(token)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                valid, expires_at = cached
+                if expires_at > self.clock():
+                    self.entries.move_to_end(key)
+                    self.count("lookups", result="hit" if valid else "negative_hit")
+                    return valid
+                del self.entries[key]
+                self.count("evictions", reason="expired")
+        self.count("lookups", result="miss")
+        return None
+
+    def put(self, token, valid, exp=None):
+        """exp is the token expiry as a Unix timestamp, as returned by introspection"""
+        ttl = self.max_ttl if valid else min(self.negative_ttl, self.max_ttl)
+        if valid and exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl <= 0:
+            return
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = (valid, self.clock() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.count("evictions", reason="capacity")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def count(self, name, **labels):
+        if self.metrics is not None:
+            getattr(self.metrics, f"token_cache_{name}").inc(**labels)
@@ -1,3 +1,4 @@
+import contextlib
 import functools
 import time
 import logging
@@ -5,9 +6,8 @@ import sys
 import traceback
 from pathlib import Path
 
-from globus_sdk.tokenstorage import SQLiteAdapter
-
-from grpc import StatusCode, RpcError
+## s2uc imports this module for every command, asyncio, grpc and inspect are
+## only imported by the server side helpers that use them
 
 class ValidationException(Exception):
     ##
@@ -25,53 +25,103 @@ class ForbiddenError(Exception):
     ##
     pass
 
+@contextlib.contextmanager
+def log_request(self, name, request):
+    if name =="req":
+        if self.resource_map.get(request.uid):
+            raise ValidationException("Entry already found for uid")
+    ## the streams of a batch_req are validated on their own, failures are reported per uid
+    elif name != "batch_req" and request.uid not in self.resource_map:
+            raise ValidationException(f"{name} request invalid, entry not found for uid '{request.uid}'")
+    start_time = time.time()
+    error = False
+    try:
+        self.logger.debug(f"{name} started, with request {request}")
+        yield
+        self.logger.info(f"{name} completed")
+    except Exception as e:
+        error = True
+        self.logger.error(f"Error in function '{name}': {str(e)}")
+        print(traceback.format_exc())
+        raise e
+    finally:
+        end_time = time.time()
+        duration = end_time - start_time
+        self.logger.debug(f"{name} took {duration:.4f} seconds")
+        self.metrics.observe_rpc(name, duration, error)
+
 def request_decorator(func):
-    #assumes function has a self.logger
+    #assumes function has a self.logger and self.metrics
+    import inspect
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with log_request(args[0], func.__name__, args[1]):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = None
-        self, request= args[0], args[1]
-
-        if func.__name__ =="req":
-            if self.resource_map.get(request.uid):
-                raise ValidationException("Entry already found for uid")
-        elif request.uid not in self.resource_map:
-                raise ValidationException(f"{func.__name__} request invalid, entry not found for uid '{request.uid}'")
-        try:
-            self.logger.debug(f"{func.__name__} started, with request {request}")
-            result = func(*args, **kwargs)
-            self.logger.info(f"{func.__name__} completed")
-        except Exception as e:
-            self.logger.error(f"Error in function '{func.__name__}': {str(e)}")
-            print(traceback.format_exc())
-            raise e
-        finally:
-            end_time = time.time()
-            duration = end_time - start_time
-            self.logger.debug(f"{func.__name__} took {duration:.4f} seconds")
-        return result
+        with log_request(args[0], func.__name__, args[1]):
+            return func(*args, **kwargs)
 
     return wrapper
 
+def auth_failure(self, context):
+    """ Returns the reason a request is not authenticated, None if it is """
+    metadata = dict(context.invocation_metadata())
+    auth_token = metadata.get('authorization')
+    if not auth_token:
+        return f'Authentication token is missing for scope {self.client_id}'
+    if not self.validate_creds(auth_token):
+        return f'Authentication token is invalid for scope {self.client_id}'
+    return None
+
 def authenticated(func):
     """ Mark a route as requiring authentication """
+    ## if client _secret has not been defined then we turn off credential validation
+    import asyncio
+    import inspect
+    from grpc import StatusCode
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_decorated_function(*args, **kwargs):
+            self, context = args[0], args[2]
+            if self.client_secret != "":
+                ## token validation blocks on the network, keep it off the event loop
+                message = await asyncio.to_thread(auth_failure, self, context)
+                if message:
+                    print(message)
+                    await context.abort(StatusCode.UNAUTHENTICATED, message)
+            return await func(*args, **kwargs)
+        return async_decorated_function
+
+    if inspect.isasyncgenfunction(func):
+        ## server-streaming RPCs of the aio server
+        @functools.wraps(func)
+        async def async_decorated_generator(*args, **kwargs):
+            self, context = args[0], args[2]
+            if self.client_secret != "":
+                message = await asyncio.to_thread(auth_failure, self, context)
+                if message:
+                    print(message)
+                    await context.abort(StatusCode.UNAUTHENTICATED, message)
+            async for item in func(*args, **kwargs):
+                yield item
+        return async_decorated_generator
+
     @functools.wraps(func)
     def decorated_function(*args, **kwargs):
-        ## if client _secret has not been defined then we turn off credential validation
         self = args[0]
         if self.client_secret == "":
             return func(*args, **kwargs)
         context = args[2]
-        metadata = dict(context.invocation_metadata())
-        auth_token = metadata.get('authorization')
-        error_message = f'scope_id {self.client_id}'
-        if not auth_token:
-            print(f'Authentication token is missing for scope_id {self.client_id}')
-            context.abort(StatusCode.UNAUTHENTICATED, f'Authentication token is missing for scope {self.client_id}')
-        if not self.validate_creds(auth_token):
-            print(f'Authentication token is invalid for scope_id {self.client_id}')
-            context.abort(StatusCode.UNAUTHENTICATED, f'Authentication token is invalid for scope {self.client_id}')
+        message = auth_failure(self, context)
+        if message:
+            print(message)
+            context.abort(StatusCode.UNAUTHENTICATED, message)
         return func(*args, **kwargs)
     return decorated_function
 
@@ -97,6 +147,8 @@ def authorize(func):
     return wrapper
 
 def handle_grpc_errors(func):
+    from grpc import StatusCode, RpcError
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
@@ -0,0 +1,185 @@
+import importlib.metadata
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent import futures
+from pathlib import Path
+
+import grpc
+import pytest
+from click.testing import CliRunner
+from unittest import mock
+
+from src.channel import ChannelCache, SERVER_OPTIONS
+from src.proto import scistream_pb2, scistream_pb2_grpc
+from src.s2cs import S2CS, S2CSException
+from src import s2uc
+from src.s2uc import cli
+
+## seconds, importing the CLI took about 0.4s when it loaded grpc and globus_sdk up front
+IMPORT_BUDGET = float(os.environ.get("S2UC_IMPORT_BUDGET", "0.25"))
+
+
+@pytest.fixture
+def server_cert(tmp_path):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not installed")
+    crt, key = tmp_path / "server.crt", tmp_path / "server.key"
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+            "-keyout", str(key), "-out", str(crt),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return crt, key
+
+
+@pytest.fixture
+def secure_server(server_cert):
+    crt, key = server_cert
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock", client_secret="")
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), options=SERVER_OPTIONS)
+    scistream_pb2_grpc.add_ControlServicer_to_server(servicer, server)
+    credentials = grpc.ssl_server_credentials([(key.read_bytes(), crt.read_bytes())])
+    port = server.add_secure_port("localhost:0", credentials)
+    server.start()
+    yield f"localhost:{port}", str(crt)
+    server.stop(0)
+
+
+@pytest.mark.timeout(10)
+def test_channel_is_reused(secure_server):
+    target, cert = secure_server
+    cache = ChannelCache()
+    stub = cache.stub(target, cert)
+    for i in range(3):
+        response = cache.stub(target, cert).req(
+            scistream_pb2.Request(uid=f"uid_{i}", role="PROD", num_conn=1, rate=1, detach=True)
+        )
+        assert len(response.listeners) == 1
+    assert cache.stub(target, cert) is stub
+    assert len(cache.channels) == 1
+    cache.close()
+    assert not cache.channels
+
+
+def test_channel_key_includes_cert(tmp_path):
+    first, second = tmp_path / "first.crt", tmp_path / "second.crt"
+    first.write_bytes(b"")
+    second.write_bytes(b"")
+    cache = ChannelCache()
+    channel = cache.channel("localhost:5000", str(first))
+    assert cache.channel("localhost:5000", str(first)) is channel
+    assert cache.channel("localhost:5000", str(second)) is not channel
+    assert cache.channel("localhost:5001", str(first)) is not channel
+    cache.close()
+
+
+def test_session_survives_failed_commands():
+    result = CliRunner().invoke(
+        cli, ["session"], input="no-such-command\n# comment\nrelease 'unbalanced\nexit\nlogout\n"
+    )
+    assert result.exit_code == 0
+    assert "No such command" in result.output
+    assert "No closing quotation" in result.output
+    assert "logged out" not in result.output
+
+
+def test_s2uc_import_is_lazy():
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import src.s2uc\n"
+        "elapsed = time.perf_counter() - start\n"
+        "loaded = [m for m in ('grpc', 'globus_sdk', 'asyncio', 'src.proto.scistream_pb2') if m in sys.modules]\n"
+        "print(elapsed, *loaded)\n"
+    )
+    ## best of three, the first run also warms the disk cache
+    runs = [
+        subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True,
+            cwd=Path(__file__).resolve().parent.parent,
+        ).stdout.split()
+        for _ in range(3)
+    ]
+    assert all(len(run) == 1 for run in runs), f"imported eagerly: {runs[0][1:]}"
+    assert min(float(run[0]) for run in runs) < IMPORT_BUDGET
+
+
+def test_s2uc_help_and_version():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    assert "inbound-request" in result.output
+    result = CliRunner().invoke(cli, ["--version"])
+    assert result.exit_code == 0
+    assert result.output.strip().endswith(importlib.metadata.version("scistream-proto"))
+
+
+def test_rate_is_unlimited_by_default():
+    for name in ("inbound-request", "batch-request", "prod-req", "outbound-request"):
+        rate = next(param for param in cli.commands[name].params if param.name == "rate")
+        assert rate.default == 0
+
+
+@pytest.mark.timeout(20)
+def test_batch_request_updates_streams_concurrently(secure_server, monkeypatch):
+    target, cert = secure_server
+    active, overlap = [], []
+    lock = threading.Lock()
+    update_s2ds = S2CS.update_s2ds
+
+    def slow_update(self, request):
+        with lock:
+            active.append(request.uid)
+            overlap.append(len(active))
+        time.sleep(0.3)
+        with lock:
+            active.remove(request.uid)
+        return update_s2ds(self, request)
+
+    monkeypatch.setattr(S2CS, "update_s2ds", slow_update)
+    result = CliRunner().invoke(
+        cli, ["batch-request", "--num_streams", "3", "--num_conn", "1", "--s2cs", target, "--server_cert", cert]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.count("Listeners:") == 3
+    assert max(overlap) > 1
+
+
+class UnimplementedWatch:
+    """Watch call of an S2CS that predates the watch RPC"""
+
+    def __iter__(self):
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.UNIMPLEMENTED
+        raise error
+
+    def cancel(self):
+        pass
+
+
+def test_wait_for_falls_back_without_watch(monkeypatch):
+    monkeypatch.setattr(s2uc, "HELLO_DELAY", 0)
+    stub = mock.Mock()
+    stub.watch.return_value = UnimplementedWatch()
+    assert s2uc.wait_for_reservation(stub, ["uid"], scope_id="") == set()
+
+
+def test_sync_watch_is_limited():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock", client_secret="", max_watchers=1)
+    first = servicer.watch(scistream_pb2.WatchRequest(uid="uid"), None)
+    servicer.events.publish("uid", scistream_pb2.SessionEvent.REQUESTED)
+    assert next(first).state == scistream_pb2.SessionEvent.REQUESTED
+    with pytest.raises(S2CSException):
+        next(servicer.watch(scistream_pb2.WatchRequest(uid="uid"), None))
+    ## the slot comes back once the first watch ends
+    first.close()
+    second = servicer.watch(scistream_pb2.WatchRequest(uid="uid"), None)
+    assert next(second).state == scistream_pb2.SessionEvent.REQUESTED
+    second.close()
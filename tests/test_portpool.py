@@ -0,0 +1,78 @@
+import sys
+import time
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.portpool import PortPool, PortPoolException
+
+
+def test_allocate_sequential():
+    pool = PortPool(5100, 5200)
+    assert pool.allocate(3) == [5100, 5101, 5102]
+    assert pool.allocate(2) == [5103, 5104]
+    assert pool.in_use == 5
+
+
+def test_exhausted():
+    pool = PortPool(5100, 5101)
+    pool.allocate(2)
+    with pytest.raises(PortPoolException):
+        pool.allocate(1)
+
+
+def test_release_and_reuse():
+    pool = PortPool(5100, 5101)
+    ports = pool.allocate(2)
+    pool.release(ports)
+    assert pool.in_use == 0
+    assert sorted(pool.allocate(2)) == [5100, 5101]
+
+
+def test_double_release_ignored():
+    pool = PortPool(5100, 5101)
+    ports = pool.allocate(1)
+    pool.release(ports)
+    pool.release(ports)
+    pool.release([6000])
+    assert pool.available() == 2
+    assert pool.in_use == 0
+
+
+def test_cooldown():
+    pool = PortPool(5100, 5100, cooldown=0.2)
+    pool.release(pool.allocate(1))
+    assert pool.available() == 0
+    with pytest.raises(PortPoolException):
+        pool.allocate(1)
+    time.sleep(0.25)
+    assert pool.available() == 1
+    assert pool.allocate(1) == [5100]
+
+
+def test_concurrent_allocations_are_unique():
+    pool = PortPool(5100, 65000)
+    results = []
+
+    def worker():
+        for _ in range(100):
+            ports = pool.allocate(5)
+            results.extend(ports)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == len(set(results)) == 8 * 100 * 5
+
+
+@pytest.mark.timeout(2)
+def test_wide_range_churn():
+    pool = PortPool(5100, 65000)
+    for _ in range(10000):
+        pool.release(pool.allocate(5))
+    assert pool.in_use == 0
@@ -1,4 +1,9 @@
+import os
 import sys
+import signal
+import asyncio
+import subprocess
+import urllib.request
 import pytest
 import threading
 import time
@@ -9,10 +14,16 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
 from concurrent import futures
-from src.proto.scistream_pb2 import Request, AppResponse, Response, UpdateTargets, Hello
-from src.s2cs import S2CS, S2CSException
+from src.proto.scistream_pb2 import (
+    Request, AppResponse, Response, UpdateTargets, Hello, BatchRequest, WatchRequest, SessionEvent, Release
+)
+from src.s2cs import S2CS, AsyncS2CS, S2CSException
 from src.s2ds.utils import S2DS
 from src.s2ds.s2ds import MockS2DS
+from src.sessions import SessionTable
+from src.s2ds.subproc import AdoptedProcess
+from src.s2ds.supervisor import SupervisedProcess
+from src.metrics import start_metrics_server
 from src.utils import ValidationException
 
 
@@ -104,6 +115,396 @@ def test_req_and_hello(servicer):
     assert servicer.resource_map["test_uid"]
 
 
+@pytest.mark.timeout(1)
+def test_release_returns_ports():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="AsyncioRelay", start_port=5100, end_port=5101)
+    for uid in ["uid_1", "uid_2"]:
+        request = Request(uid=uid, role="PROD", num_conn=2, rate=1)
+        servicer.create_entry(request, threading.Event())
+        servicer.start_s2ds(request)
+        assert servicer.resource_map[uid]["ports"] == [5100, 5101]
+        servicer.release_request(uid)
+    assert servicer.port_pool.in_use == 0
+
+
+def test_session_table_add_is_exclusive():
+    table = SessionTable(num_shards=4)
+    assert table.add("uid", {"role": "PROD"})
+    assert not table.add("uid", {"role": "CONS"})
+    assert table["uid"]["role"] == "PROD"
+    assert list(table) == ["uid"] and len(table) == 1
+    assert table.pop("uid")["role"] == "PROD"
+    assert table.pop("uid", None) is None
+
+
+@pytest.mark.timeout(5)
+def test_session_table_keeps_held_uid_lock():
+    table = SessionTable(num_shards=4)
+    table.add("uid", {"role": "PROD"})
+    waiting = threading.Event()
+    holders = []
+
+    def contend():
+        waiting.set()
+        with table.lock("uid"):
+            holders.append("waiter")
+
+    with table.lock("uid"):
+        ## a release pops the entry while holding the lock, with a thread waiting on it
+        table.pop("uid")
+        waiter = threading.Thread(target=contend)
+        waiter.start()
+        waiting.wait()
+        time.sleep(0.05)
+        late = threading.Thread(target=contend)
+        late.start()
+        time.sleep(0.05)
+        assert holders == []
+    waiter.join()
+    late.join()
+    assert holders == ["waiter", "waiter"]
+    ## the lock is forgotten once nobody holds it
+    assert all(not locks for locks in table.uid_locks)
+    assert len(table) == 0
+
+
+@pytest.mark.timeout(1)
+def test_duplicate_req_rejected(servicer):
+    request = Request(uid="test_uid", role="PROD", num_conn=1, rate=1)
+    servicer.create_entry(request, threading.Event())
+    with pytest.raises(ValidationException):
+        servicer.create_entry(request, threading.Event())
+
+
+@pytest.mark.timeout(5)
+def test_concurrent_streams_keep_their_responses():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    uids = [f"uid_{i}" for i in range(50)]
+
+    def negotiate(uid):
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            req_future = executor.submit(
+                servicer.req, Request(uid=uid, role="PROD", num_conn=1, rate=1), context
+            )
+            ## HELLO may race ahead of REQ, retry until the entry exists
+            while True:
+                try:
+                    servicer.hello(Hello(uid=uid, role="PROD", prod_listeners=[f"10.0.0.1:{uid[4:]}"]), context)
+                    break
+                except ValidationException:
+                    time.sleep(0.01)
+            return uid, req_future.result(timeout=2)
+
+    with mock.patch.object(S2CS, "TIMEOUT", 2):
+        with futures.ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(negotiate, uids))
+    for uid, response in results:
+        assert list(response.prod_listeners) == [f"10.0.0.1:{uid[4:]}"]
+
+
+@pytest.mark.timeout(5)
+def test_batch_req():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    uids = [f"uid_{i}" for i in range(10)]
+    servicer.create_entry(Request(uid="uid_taken", role="PROD", num_conn=1, rate=1), threading.Event())
+    request = BatchRequest(
+        requests=[Request(uid=uid, role="PROD", num_conn=2, rate=1) for uid in uids + ["uid_taken"]]
+    )
+
+    def send_hellos():
+        for uid in uids[:-1]:
+            while True:
+                try:
+                    servicer.hello(Hello(uid=uid, role="PROD", prod_listeners=[f"10.0.0.1:{uid[4:]}"]), context)
+                    break
+                except ValidationException:
+                    time.sleep(0.01)
+
+    with mock.patch.object(S2CS, "TIMEOUT", 1):
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            hellos = executor.submit(send_hellos)
+            response = servicer.batch_req(request, context)
+            hellos.result()
+    assert sorted(response.responses) == sorted(uids[:-1])
+    for uid in uids[:-1]:
+        assert list(response.responses[uid].prod_listeners) == [f"10.0.0.1:{uid[4:]}"]
+        assert len(response.responses[uid].listeners) == 2
+    ## the stream that never got its HELLO is released, the duplicate is rejected
+    assert sorted(response.errors) == [uids[-1], "uid_taken"]
+    assert uids[-1] not in servicer.resource_map
+
+
+@pytest.mark.timeout(5)
+def test_watch_reports_transitions():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    response = servicer.req(Request(uid="test_uid", role="PROD", num_conn=1, rate=1, detach=True), context)
+    assert len(response.listeners) == 1
+    assert not response.prod_listeners
+
+    events = servicer.watch(WatchRequest(uid="test_uid"), None)
+    ## a late watcher starts from the current state
+    assert next(events).state == SessionEvent.PORTS_RESERVED
+    servicer.hello(Hello(uid="test_uid", role="PROD", prod_listeners=["10.0.0.1:5000"]), context)
+    servicer.update(UpdateTargets(uid="test_uid", remote_listeners=["10.0.0.1:5000"], role="PROD"), context)
+    servicer.release(Release(uid="test_uid"), context)
+    rest = list(events)
+    assert [event.state for event in rest] == [
+        SessionEvent.HELLO_RECEIVED, SessionEvent.PROXY_UP, SessionEvent.UPDATED, SessionEvent.RELEASED
+    ]
+    assert rest[0].prod_listeners == ["10.0.0.1:5000"]
+
+
+@pytest.mark.timeout(5)
+def test_detached_req_expires():
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    states = []
+    servicer.events.subscribe("", lambda event: states.append(event.state))
+    with mock.patch.object(S2CS, "TIMEOUT", 0.1):
+        servicer.req(Request(uid="test_uid", role="PROD", num_conn=1, rate=1, detach=True), context)
+    time.sleep(0.5)
+    assert "test_uid" not in servicer.resource_map
+    assert states == [
+        SessionEvent.REQUESTED, SessionEvent.PORTS_RESERVED, SessionEvent.FAILED, SessionEvent.RELEASED
+    ]
+
+
+@pytest.mark.timeout(5)
+def test_restart_readopts_sessions(tmp_path):
+    state_db = str(tmp_path / "state.db")
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    request = Request(uid="test_uid", role="PROD", num_conn=2, rate=1)
+    servicer.setup_request(request, threading.Event())
+    entry = servicer.resource_map["test_uid"]
+    ## Stand-in for the proxy process update_listeners would have started
+    entry["s2ds_proc"].append(subprocess.Popen(["sleep", "30"]))
+    servicer.persist("test_uid", entry)
+
+    restarted = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    restored = restarted.resource_map["test_uid"]
+    assert restored["listeners"] == entry["listeners"]
+    assert isinstance(restored["s2ds_proc"][0], AdoptedProcess)
+    assert restored["s2ds_proc"][0].poll() is None
+    assert restarted.port_pool.allocate(1) == [5102]
+
+    restarted.release_request("test_uid")
+    entry["s2ds_proc"][0].wait(timeout=2)
+    assert S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db).resource_map.get("test_uid") is None
+
+
+@pytest.mark.timeout(5)
+def test_supervisor_restart_is_persisted(tmp_path):
+    state_db = str(tmp_path / "state.db")
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    servicer.setup_request(Request(uid="test_uid", role="PROD", num_conn=1, rate=1), threading.Event())
+    entry = servicer.resource_map["test_uid"]
+    proc = SupervisedProcess(["sleep", "30"], tmp_path / "proxy.log")
+    entry["s2ds_proc"].append(proc)
+    servicer.persist("test_uid", entry)
+    first_pid = proc.pid
+    proc.send_signal(signal.SIGKILL)
+    proc.wait()
+    ## what the supervisor thread does, the backoff has passed by the second check
+    proc.check(time.monotonic())
+    proc.check(time.monotonic() + 60)
+    assert proc.pid != first_pid
+
+    try:
+        restarted = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+        assert restarted.resource_map["test_uid"]["s2ds_proc"][0].pid == proc.pid
+    finally:
+        proc.terminate()
+
+
+## S2CS with a supervised proxy in its state_db, waiting for Ctrl-C like start()
+S2CS_WITH_PROXY = """
+import sys, threading, time
+from src.s2cs import S2CS
+from src.s2ds.supervisor import SupervisedProcess
+from src.proto.scistream_pb2 import Request
+servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=sys.argv[1])
+servicer.setup_request(Request(uid="test_uid", role="PROD", num_conn=1, rate=1), threading.Event())
+entry = servicer.resource_map["test_uid"]
+entry["s2ds_proc"].append(SupervisedProcess(["sleep", "30"], sys.argv[2]))
+servicer.persist("test_uid", entry)
+try:
+    print("proxy", entry["s2ds_proc"][0].pid, flush=True)
+    time.sleep(30)
+except KeyboardInterrupt:
+    sys.exit(0)
+"""
+
+
+@pytest.mark.timeout(10)
+def test_proxy_survives_ctrl_c(tmp_path):
+    state_db = str(tmp_path / "state.db")
+    ## in a group of its own, the SIGINT must not reach pytest
+    s2cs = subprocess.Popen(
+        [sys.executable, "-c", S2CS_WITH_PROXY, state_db, str(tmp_path / "proxy.log")],
+        cwd=Path(__file__).resolve().parent.parent,
+        stdout=subprocess.PIPE,
+        start_new_session=True,
+    )
+    line = s2cs.stdout.readline()
+    while not line.startswith(b"proxy "):
+        line = s2cs.stdout.readline()
+    proxy_pid = int(line.split()[1])
+    os.killpg(s2cs.pid, signal.SIGINT)
+    assert s2cs.wait(timeout=5) == 0
+    os.kill(proxy_pid, 0)
+
+    restarted = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    adopted = restarted.resource_map["test_uid"]["s2ds_proc"][0]
+    assert isinstance(adopted, AdoptedProcess)
+    assert adopted.pid == proxy_pid
+    assert adopted.poll() is None
+    restarted.release_request("test_uid")
+
+
+@pytest.mark.timeout(5)
+def test_restart_drops_dead_sessions(tmp_path):
+    state_db = str(tmp_path / "state.db")
+    servicer = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    servicer.setup_request(Request(uid="test_uid", role="PROD", num_conn=1, rate=1), threading.Event())
+    entry = servicer.resource_map["test_uid"]
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    entry["s2ds_proc"].append(proc)
+    servicer.persist("test_uid", entry)
+
+    restarted = S2CS(listener_ip="127.0.0.1", verbose=False, type="StunnelSubprocess", state_db=state_db)
+    assert "test_uid" not in restarted.resource_map
+    assert restarted.port_pool.in_use == 0
+
+
+@pytest.mark.timeout(2)
+def test_metrics_endpoint(servicer):
+    servicer.resource_map["test_uid"] = {
+        "role": "PROD",
+        "num_conn": 1,
+        "rate": 1,
+        "hello_received": threading.Event(),
+        "s2ds_proc": mock.MagicMock(),
+        "listeners": ["127.0.0.1:5001"],
+    }
+    servicer.hello(Hello(uid="test_uid", prod_listeners=["127.0.0.1:7000"]), context)
+    with pytest.raises(ValidationException):
+        servicer.hello(Hello(uid="other_uid"), context)
+    server = start_metrics_server(servicer.metrics, 0, "127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url, timeout=1).read().decode()
+    finally:
+        server.shutdown()
+    assert 's2cs_rpc_duration_seconds_count{rpc="hello"} 1' in body
+    assert 's2cs_rpc_duration_seconds_bucket{rpc="hello",le="+Inf"} 1' in body
+    assert "s2cs_sessions 1" in body
+    assert "s2cs_ports_total 101" in body
+
+
+def test_stream_stats_skips_broken_backend(servicer):
+    working, broken = mock.Mock(), mock.Mock()
+    working.stats.return_value = {"bytes_in": 1, "bytes_out": 2, "connections": 1}
+    broken.stats.side_effect = IndexError("list index out of range")
+    servicer.resource_map["working_uid"] = {"s2ds": working}
+    servicer.resource_map["broken_uid"] = {"s2ds": broken}
+    assert dict(servicer.stream_stats()) == {"working_uid": working.stats.return_value}
+
+
+@pytest.mark.timeout(2)
+def test_async_req_and_hello():
+    servicer = AsyncS2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    hello_request = Hello(uid="test_uid", role="PROD", prod_listeners=["10.0.0.1:5000"])
+    req_request = Request(uid="test_uid", role="PROD", num_conn=1, rate=1)
+
+    async def negotiate():
+        req_task = asyncio.create_task(servicer.req(req_request, context))
+        await asyncio.sleep(0.1)
+        await servicer.hello(hello_request, context)
+        return await req_task
+
+    response = asyncio.run(negotiate())
+    assert response.prod_listeners == ["10.0.0.1:5000"]
+    assert servicer.resource_map["test_uid"]["hello_received"].is_set()
+
+
+@pytest.mark.timeout(2)
+def test_async_req_timeout():
+    servicer = AsyncS2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    request = Request(uid="test_uid", role="PROD", num_conn=1, rate=1)
+    with mock.patch.object(S2CS, "TIMEOUT", 0):
+        with pytest.raises(S2CSException):
+            asyncio.run(servicer.req(request, context))
+    assert "test_uid" not in servicer.resource_map
+
+
+@pytest.mark.timeout(5)
+def test_async_many_pending_requests():
+    ## more pending REQs than the threaded server has workers
+    servicer = AsyncS2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    uids = [f"uid_{i}" for i in range(200)]
+
+    async def negotiate():
+        reqs = [
+            asyncio.create_task(servicer.req(Request(uid=uid, role="CONS", num_conn=1, rate=1), context))
+            for uid in uids
+        ]
+        await asyncio.sleep(0.1)
+        for uid in uids:
+            await servicer.hello(Hello(uid=uid, role="CONS"), context)
+        return await asyncio.gather(*reqs)
+
+    responses = asyncio.run(negotiate())
+    assert len(responses) == len(uids)
+
+
+@pytest.mark.timeout(5)
+def test_async_batch_req():
+    servicer = AsyncS2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+    uids = [f"uid_{i}" for i in range(20)]
+    request = BatchRequest(requests=[Request(uid=uid, role="CONS", num_conn=1, rate=1) for uid in uids])
+
+    async def negotiate():
+        batch = asyncio.create_task(servicer.batch_req(request, context))
+        await asyncio.sleep(0.2)
+        for uid in uids:
+            await servicer.hello(Hello(uid=uid, role="CONS"), context)
+        return await batch
+
+    response = asyncio.run(negotiate())
+    assert sorted(response.responses) == sorted(uids)
+    assert not response.errors
+
+
+@pytest.mark.timeout(5)
+def test_async_watch_all():
+    servicer = AsyncS2CS(listener_ip="127.0.0.1", verbose=False, type="Mock")
+
+    async def negotiate():
+        events = []
+
+        async def collect():
+            async for event in servicer.watch(WatchRequest(), context):
+                events.append((event.uid, event.state))
+                if event.state == SessionEvent.HELLO_RECEIVED:
+                    return
+
+        watcher = asyncio.create_task(collect())
+        await asyncio.sleep(0.1)
+        req = asyncio.create_task(servicer.req(Request(uid="test_uid", role="CONS", num_conn=1, rate=1), context))
+        await asyncio.sleep(0.1)
+        await servicer.hello(Hello(uid="test_uid", role="CONS"), context)
+        await req
+        await watcher
+        return events
+
+    events = asyncio.run(negotiate())
+    assert events == [
+        ("test_uid", SessionEvent.REQUESTED),
+        ("test_uid", SessionEvent.PORTS_RESERVED),
+        ("test_uid", SessionEvent.HELLO_RECEIVED),
+    ]
+
+
 @pytest.mark.skip(reason="version 0.2.0 has not tested this yet")
 @pytest.mark.timeout(1)
 def test_full_request(servicer):
@@ -1,14 +1,36 @@
+import importlib.metadata
+import asyncio
+import itertools
+import logging
 import os
 import sys
 import time
+import signal
 import socket
+import threading
 import subprocess
 from pathlib import Path
 import pytest
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from src.s2ds.subproc import StunnelSubprocess, get_config_path, HaproxySubprocess
+from src.s2ds.subproc import StunnelSubprocess, get_config_path, HaproxySubprocess, HaproxyMaster, SharedHaproxySubprocess, NginxSubprocess
+from src.s2ds.relay import (
+    STRIPE_HELLO, STRIPE_MAGIC, AsyncioRelay, BufferPool, RelayListener, SpliceRelay, StripedRelay, StripeServer
+)
+from src.s2ds.subproc import haproxy_stats
+from src.s2ds import docker as s2ds_docker
+from src.s2ds import subproc as s2ds_subproc
+from src.s2ds import s2ds as s2ds_registry
+from src.s2ds.supervisor import SupervisedProcess, Supervisor, rotate_log, wait_ready
+from src.s2ds.procpool import ArrivalRate, ProcessPool, process_pool
+from src.s2ds.utils import S2DSException
+from src.s2ds.docker import Haproxy, Stunnel, container_pool
+from src.s2ds.templates import TemplateRegistry, template_registry
+from src.s2ds import tuning as s2ds_tuning
+from src.s2ds.tuning import MAX_BUFSIZE, resolve_tuning, tuning_error
+from src.proto import scistream_pb2
+from unittest import mock
 
 
 @pytest.fixture
@@ -41,6 +63,57 @@ def s2ds_fixture():
             return HaproxySubprocess()
     return _make_subprocess
 
+@pytest.fixture
+def fake_popen(monkeypatch):
+    """Records haproxy invocations instead of running the binary"""
+    calls = []
+
+    class FakePopen:
+        def __init__(self, args, **kwargs):
+            calls.append(args)
+            self.pid = 4242
+            self.signals = []
+            self.returncode = None
+
+        def poll(self):
+            return self.returncode
+
+        def send_signal(self, sig):
+            self.signals.append(sig)
+
+        def terminate(self):
+            self.returncode = 0
+
+        def wait(self):
+            return self.returncode
+
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+    ## nothing listens behind a fake proxy
+    monkeypatch.setattr(s2ds_subproc, "wait_ready", lambda *args, **kwargs: None)
+    return calls
+
+@pytest.fixture
+def fake_docker(monkeypatch, tmp_path):
+    """Docker client whose containers only record the calls made on them"""
+    monkeypatch.setenv("HAPROXY_CONFIG_PATH", str(tmp_path))
+    client = mock.MagicMock()
+    created = []
+
+    def new_container(**kwargs):
+        container = mock.MagicMock()
+        container.name = kwargs["name"]
+        container.short_id = kwargs["name"][-12:]
+        created.append(container)
+        return container
+
+    client.containers.run.side_effect = new_container
+    client.containers.create.side_effect = new_container
+    client.created = created
+    monkeypatch.setattr(s2ds_docker, "docker_client", lambda: client)
+    monkeypatch.setattr(container_pool, "_instances", {}, raising=False)
+    return client
+
+
 @pytest.fixture(autouse=True)
 def cleanup_processes():
     processes = []
@@ -120,6 +193,98 @@ def test_release_with_processes(stunnel_subprocess):
         assert isinstance(proc, int)
 
 
+def test_command_does_not_grow(stunnel_subprocess, fake_popen):
+    for uid in ["74c12996-92d6-11ef-a0df-8b998dbe1360", "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3"]:
+        entry = stunnel_subprocess.start(1, "127.0.0.1", [5074])
+        stunnel_subprocess.update_listeners(["127.0.0.1:8080"], entry["s2ds_proc"], uid, "CONS")
+    assert stunnel_subprocess.command == ["stunnel"]
+    assert [len(args) for args in fake_popen] == [2, 2]
+
+
+@pytest.fixture
+def fake_master(mock_home, fake_popen, monkeypatch):
+    """HaproxyMaster over fake_popen, whose worker changes on every reload"""
+    master = HaproxyMaster()
+    master.ready_timeout = 0.3
+    master.checked = []
+    master.bad_ports = set()
+    fake_popen_class = subprocess.Popen
+    workers = itertools.count(100)
+
+    def popen(args, **kwargs):
+        proc = fake_popen_class(args, **kwargs)
+        master.pid_filename.write_text(f"{proc.pid}\n")
+        return proc
+
+    def check(path):
+        master.checked.append(path)
+        if any(f"bind *:{port}" in path.read_text() for port in master.bad_ports):
+            raise S2DSException("bad config")
+
+    def worker_pid(socket_path):
+        ## a reload that fails keeps the old worker
+        if master.stuck:
+            return 99
+        return next(workers)
+
+    master.stuck = False
+    monkeypatch.setattr(subprocess, "Popen", popen)
+    monkeypatch.setattr(s2ds_subproc, "check_haproxy_config", check)
+    monkeypatch.setattr(s2ds_subproc, "haproxy_worker_pid", worker_pid)
+    return master
+
+
+def test_shared_haproxy_single_master(fake_master, fake_popen):
+    master = fake_master
+    entries = []
+    for uid, ports in [("uid1", [5001, 5002]), ("uid2", [5003])]:
+        s2ds = SharedHaproxySubprocess(master=master)
+        entry = s2ds.start(len(ports), "127.0.0.1", ports)
+        s2ds.update_listeners([f"127.0.0.1:{p + 1000}" for p in ports], entry["s2ds_proc"], uid, "PROD")
+        entries.append((s2ds, entry))
+    assert len(fake_popen) == 1
+    assert len(master.proc.signals) == 1
+    content = master.config_path.read_text()
+    assert content.count("frontend ") == 3
+    assert "bind *:5003" in content and "127.0.0.1:6003" in content
+
+    s2ds, entry = entries[0]
+    s2ds.release(entry)
+    content = master.config_path.read_text()
+    assert "uid1" not in content and "uid2" in content
+    assert len(master.proc.signals) == 2
+
+    s2ds, entry = entries[1]
+    s2ds.release(entry)
+    assert master.proc is None
+    assert entry["s2ds_proc"] == [4242]
+
+
+def test_shared_haproxy_bad_stream_is_isolated(fake_master, fake_popen):
+    master = fake_master
+    good = SharedHaproxySubprocess(master=master)
+    entry = good.start(1, "127.0.0.1", [5001])
+    good.update_listeners(["127.0.0.1:6001"], entry["s2ds_proc"], "uid1", "PROD")
+    ## a rejected config never reaches the master
+    master.bad_ports.add(5002)
+    bad = SharedHaproxySubprocess(master=master)
+    with pytest.raises(S2DSException):
+        bad.update_listeners(["127.0.0.1:6002"], bad.start(1, "127.0.0.1", [5002])["s2ds_proc"], "uid2", "PROD")
+    assert master.proc.signals == []
+    assert "uid2" not in master.config_path.read_text()
+    ## a reload that does not bring up a new worker is rolled back too
+    master.stuck = True
+    with pytest.raises(S2DSException):
+        bad.update_listeners(["127.0.0.1:6003"], bad.start(1, "127.0.0.1", [5003])["s2ds_proc"], "uid3", "PROD")
+    assert list(master.streams) == ["uid1"]
+    assert "uid3" not in master.config_path.read_text()
+    ## the other streams keep reloading
+    master.stuck = False
+    other = SharedHaproxySubprocess(master=master)
+    other.update_listeners(["127.0.0.1:6004"], other.start(1, "127.0.0.1", [5004])["s2ds_proc"], "uid4", "PROD")
+    assert list(master.streams) == ["uid1", "uid4"]
+
+
 def test_generate_stunnel_config_content(stunnel_subprocess):
     uid = "74c12996-92d6-11ef-a0df-8b998dbe1360"
     dest_array = ["192.168.1.1:443"]
@@ -135,6 +300,18 @@ def test_generate_stunnel_config_content(stunnel_subprocess):
     assert str(Path(f"{uid}.key")) in content
 
 
+def test_generate_nginx_config_content(mock_home):
+    uid = "74c12996-92d6-11ef-a0df-8b998dbe1360"
+    nginx_subprocess = NginxSubprocess()
+    nginx_subprocess.start(1, "127.0.0.1", [5100])
+    config_path = nginx_subprocess.generate_config(uid, ["192.168.1.1:443"], "PROD")
+
+    content = Path(config_path).read_text()
+    assert f"pid {Path(get_config_path()) / f'{uid}.pid'};" in content
+    assert "listen 5100" in content
+    assert "192.168.1.1:443" in content
+
+
 @pytest.mark.parametrize("role", ["CONS", "PROD"])
 def test_update_listeners(stunnel_subprocess, role):
     listeners = ["127.0.0.1:8080"]
@@ -241,3 +418,618 @@ def test_error_recovery(stunnel_subprocess, monkeypatch):
 
     assert len(result["listeners"]) == 1
     stunnel_subprocess.release(result)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("relay_class", [AsyncioRelay, SpliceRelay])
+def test_asyncio_relay_full_cycle(relay_class):
+    relay = relay_class()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = free_port()
+        entry = relay.start(1, "127.0.0.1", [port])
+        relay.update_listeners(
+            [f"127.0.0.1:{server.getsockname()[1]}"], entry["s2ds_proc"], "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3", "PROD"
+        )
+        payload = b"SciStream" * 100000
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as client:
+            conn, _ = server.accept()
+            with conn:
+                client.sendall(payload)
+                assert recv_exact(conn, len(payload)) == payload
+                conn.sendall(b"ACK")
+                assert recv_exact(client, 3) == b"ACK"
+        deadline = time.time() + 1
+        while relay.stats("uid", entry)["bytes_out"] < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert relay.stats("uid", entry) == {"bytes_in": len(payload), "bytes_out": 3, "connections": 1}
+        relay.release(entry)
+    assert isinstance(entry["s2ds_proc"][0], int)
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(("127.0.0.1", port), timeout=1)
+
+
+@pytest.mark.timeout(5)
+def test_asyncio_relay_enforces_rate():
+    relay = AsyncioRelay()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = free_port()
+        ## 400 kB/s split over 2 connections
+        entry = relay.start(2, "127.0.0.1", [port, free_port()], rate=400)
+        relay.update_listeners(
+            [f"127.0.0.1:{server.getsockname()[1]}"] * 2, entry["s2ds_proc"], "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3", "PROD"
+        )
+        payload = b"a" * 100000
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as client:
+            conn, _ = server.accept()
+            with conn:
+                start = time.time()
+                client.sendall(payload)
+                assert recv_exact(conn, len(payload)) == payload
+                elapsed = time.time() - start
+        relay.release(entry)
+    ## 200 kB/s with a 10 kB burst
+    assert 0.4 < elapsed < 1
+
+
+## in and out limits of 2 frontends, nginx also has a udp server per port
+@pytest.mark.parametrize("template, limits", [("haproxy.cfg.j2", 4), ("nginx.conf.j2", 8)])
+def test_rate_rendered_per_connection(mock_home, template, limits):
+    config = template_registry().render(
+        template, local_ports=[5100, 5101], dest_array=["10.0.0.1:7000", "10.0.0.1:7001"], conn_rate=5000000
+    )
+    assert config.count("5000000") == limits
+    assert "5000000" not in template_registry().render(
+        template, local_ports=[5100], dest_array=["10.0.0.1:7000"], conn_rate=0
+    )
+
+
+def test_stunnel_warns_about_rate(stunnel_subprocess, caplog):
+    stunnel_subprocess.start(2, "127.0.0.1", [5100, 5101], rate=1000)
+    assert stunnel_subprocess.conn_rate == 0
+    assert "not enforced" in caplog.text
+
+
+def test_relay_closes_client_cancelled_while_connecting():
+    listener = RelayListener(free_port(), "127.0.0.1:9", BufferPool(), logging.getLogger(__name__))
+
+    async def connect(dest=None):
+        await asyncio.sleep(60)
+
+    listener.connect = connect
+
+    async def cancel_handle():
+        client, peer = socket.socketpair()
+        task = asyncio.get_running_loop().create_task(listener.handle(client))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        peer.close()
+        return client
+
+    assert asyncio.run(cancel_handle()).fileno() == -1
+
+
+def test_stripe_server_rejects_mismatched_hellos():
+    listener = StripeServer(free_port(), "127.0.0.1:9", BufferPool(), logging.getLogger(__name__), {}, max_stripes=4)
+    session_id = os.urandom(16)
+
+    async def hello(index, count, session_id=session_id):
+        client, peer = socket.socketpair()
+        peer.sendall(STRIPE_HELLO.pack(STRIPE_MAGIC, session_id, index, count))
+        await listener.handle(client)
+        peer.close()
+        return client
+
+    async def hellos():
+        first = await hello(0, 2)
+        rejected = [
+            ## a larger count than the first stripe of the session
+            await hello(2, 3),
+            ## the same index twice
+            await hello(0, 2),
+            ## more stripes than the stream has connections
+            await hello(0, 5, os.urandom(16)),
+        ]
+        return first, rejected
+
+    first, rejected = asyncio.run(hellos())
+    assert all(sock.fileno() == -1 for sock in rejected)
+    assert listener.sessions == {session_id: [first, None]}
+    first.close()
+
+
+@pytest.mark.timeout(10)
+def test_striped_relay_reassembles_in_order():
+    uid = "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3"
+    prod, cons = StripedRelay(), StripedRelay()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        prod_entry = prod.start(3, "127.0.0.1", [free_port() for _ in range(3)])
+        prod.update_listeners([f"127.0.0.1:{server.getsockname()[1]}"] * 3, prod_entry["s2ds_proc"], uid, "PROD")
+        cons_entry = cons.start(3, "127.0.0.1", [free_port() for _ in range(3)])
+        cons.update_listeners(prod_entry["listeners"], cons_entry["s2ds_proc"], uid, "CONS")
+        upload = os.urandom(3 * 1024 * 1024)
+        download = os.urandom(1024 * 1024)
+        consumer_port = int(cons_entry["listeners"][0].rsplit(":", 1)[1])
+        with socket.create_connection(("127.0.0.1", consumer_port), timeout=5) as client:
+            conn, _ = server.accept()
+            with conn:
+                sender = threading.Thread(target=client.sendall, args=(upload,))
+                sender.start()
+                conn.sendall(download)
+                assert recv_exact(conn, len(upload)) == upload
+                assert recv_exact(client, len(download)) == download
+                sender.join()
+                client.shutdown(socket.SHUT_WR)
+                assert conn.recv(1) == b""
+        ## one producer connection for the three stripes
+        deadline = time.time() + 2
+        while prod.stats(uid, prod_entry)["bytes_out"] < len(download) and time.time() < deadline:
+            time.sleep(0.01)
+        assert prod.stats(uid, prod_entry)["bytes_in"] == len(upload)
+        assert sum(listener.stats["connections"] for listener in prod_entry["s2ds_proc"]) == 3
+        assert cons.stats(uid, cons_entry) == {"bytes_in": len(upload), "bytes_out": len(download), "connections": 1}
+        cons.release(cons_entry)
+        prod.release(prod_entry)
+
+
+@pytest.mark.parametrize(
+    "csv_reply, expected",
+    [
+        (
+            b"# pxname,svname,qcur,bin,bout,stot,\n"
+            b"uid1_frontend_1,FRONTEND,,100,10,2,\n"
+            b"uid1_frontend_2,FRONTEND,,50,5,1,\n"
+            b"uid1_backend_1,BACKEND,,100,10,2,\n"
+            b"uid2_frontend_1,FRONTEND,,7,7,7,\n\n",
+            {"bytes_in": 150, "bytes_out": 15, "connections": 3},
+        ),
+        ## haproxy closes the socket without a reply while it reloads
+        (b"", {"bytes_in": 0, "bytes_out": 0, "connections": 0}),
+    ],
+)
+def test_haproxy_stats(tmp_path, csv_reply, expected):
+    path = str(tmp_path / "haproxy.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+
+        def reply():
+            conn, _ = server.accept()
+            with conn:
+                assert conn.recv(64) == b"show stat\n"
+                conn.sendall(csv_reply)
+
+        thread = threading.Thread(target=reply)
+        thread.start()
+        stats = haproxy_stats(path, "uid1_frontend_")
+        thread.join()
+    assert stats == expected
+
+
+def wait_for_pool(pool, size, timeout=2):
+    deadline = time.time() + timeout
+    while len(pool.idle) < size and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_docker_prepare_pulls_and_warms(fake_docker):
+    fake_docker.images.get.side_effect = s2ds_docker.docker.errors.ImageNotFound("missing")
+    proxy = Haproxy()
+    proxy.prepare(pool_size=3)
+    pool = container_pool(proxy)
+    wait_for_pool(pool, 3)
+    fake_docker.images.pull.assert_called_once_with("haproxy:latest")
+    assert fake_docker.containers.run.call_count == 3
+    assert len(pool.idle) == 3
+
+
+def test_docker_streams_get_their_own_container(fake_docker):
+    Haproxy().prepare(pool_size=2)
+    wait_for_pool(container_pool(Haproxy()), 2)
+    entries = []
+    for i in range(3):
+        proxy = Haproxy()
+        entry = proxy.start(1, "127.0.0.1", [5100 + i])
+        proxy.update_listeners([f"10.0.0.1:{6000 + i}"], entry["s2ds_proc"], f"uid-{i}", "PROD")
+        entries.append((proxy, entry))
+    handles = [entry["s2ds_proc"][0] for _, entry in entries]
+    assert len({handle.container.name for handle in handles}) == 3
+    for i, handle in enumerate(handles):
+        config = handle.cfg_path.read_text()
+        assert f"bind *:{5100 + i}" in config
+        assert f"10.0.0.1:{6000 + i}" in config
+        ## warm containers are reloaded instead of created
+        handle.container.kill.assert_called_once_with(signal="SIGUSR2")
+    for proxy, entry in entries:
+        proxy.release(entry)
+    for handle in handles:
+        handle.container.remove.assert_called_once_with(force=True)
+        assert not handle.directory.exists()
+
+
+def test_docker_stopped_pool_starts_on_update(fake_docker):
+    proxy = Stunnel()
+    entry = proxy.start(1, "127.0.0.1", [5100])
+    proxy.update_listeners(["10.0.0.1:6000"], entry["s2ds_proc"], "uid-1", "CONS")
+    handle = entry["s2ds_proc"][0]
+    fake_docker.containers.create.assert_called()
+    handle.container.start.assert_called_once()
+    handle.container.kill.assert_not_called()
+    assert "client = yes" in handle.cfg_path.read_text()
+    ## a second update reloads the running container
+    proxy.update_listeners(["10.0.0.1:6001"], entry["s2ds_proc"], "uid-1", "CONS")
+    handle.container.kill.assert_called_once_with(signal="SIGHUP")
+    assert len(entry["s2ds_proc"]) == 1
+
+
+
+def test_docker_prepare_pulls_without_warming(fake_docker):
+    fake_docker.images.get.side_effect = s2ds_docker.docker.errors.ImageNotFound("missing")
+    Stunnel().prepare(pool_size=0)
+    fake_docker.images.pull.assert_called_once_with(Stunnel().image_name)
+    fake_docker.containers.create.assert_not_called()
+
+
+def test_docker_cold_container_pulls_missing_image(fake_docker):
+    errors = s2ds_docker.docker.errors
+    new_container = fake_docker.containers.create.side_effect
+    fake_docker.images.get.side_effect = errors.ImageNotFound("missing")
+
+    def create(**kwargs):
+        ## like the Docker API, create needs the image locally
+        if not fake_docker.images.pull.called:
+            raise errors.ImageNotFound("missing")
+        return new_container(**kwargs)
+
+    fake_docker.containers.create.side_effect = create
+    proxy = Stunnel()
+    entry = proxy.start(1, "127.0.0.1", [5100])
+    proxy.update_listeners(["10.0.0.1:6000"], entry["s2ds_proc"], "uid-1", "CONS")
+    fake_docker.images.pull.assert_called_once_with(proxy.image_name)
+    assert fake_docker.containers.create.call_count == 2
+    entry["s2ds_proc"][0].container.start.assert_called_once()
+
+
+def test_docker_prepare_without_docker(fake_docker):
+    fake_docker.images.get.side_effect = s2ds_docker.docker.errors.DockerException("no daemon")
+    Haproxy().prepare(pool_size=2)
+    fake_docker.containers.run.assert_not_called()
+
+
+def test_docker_reload_failure_restarts_container(fake_docker):
+    errors = s2ds_docker.docker.errors
+    proxy = Stunnel()
+    entry = proxy.start(1, "127.0.0.1", [5100])
+    proxy.update_listeners(["10.0.0.1:6000"], entry["s2ds_proc"], "uid-1", "CONS")
+    handle = entry["s2ds_proc"][0]
+    ## a crashed container refuses the reload signal and is started again
+    handle.container.kill.side_effect = errors.APIError("not running")
+    proxy.update_listeners(["10.0.0.1:6001"], entry["s2ds_proc"], "uid-1", "CONS")
+    assert handle.container.start.call_count == 2
+    ## a removed container is replaced
+    handle.container.kill.side_effect = errors.NotFound("gone")
+    proxy.update_listeners(["10.0.0.1:6002"], entry["s2ds_proc"], "uid-1", "CONS")
+    assert len(entry["s2ds_proc"]) == 1
+    replaced = entry["s2ds_proc"][0]
+    assert replaced.container is not handle.container
+    replaced.container.start.assert_called_once()
+    assert "10.0.0.1:6002" in replaced.cfg_path.read_text()
+
+
+def test_template_registry_compiles_once(tmp_path):
+    (tmp_path / "proxy.j2").write_text("{% for port in local_ports %}bind *:{{ port }}\n{% endfor %}")
+    registry = TemplateRegistry(searchpath=tmp_path, bytecode_dir=tmp_path / "cache")
+    template = registry.get("proxy.j2")
+    assert registry.render("proxy.j2", local_ports=[5100, 5101]) == "bind *:5100\nbind *:5101\n"
+    ## without auto_reload the compiled template is kept even if the file changes
+    (tmp_path / "proxy.j2").write_text("changed")
+    assert registry.get("proxy.j2") is template
+    assert list((tmp_path / "cache").iterdir())
+
+
+def test_template_registry_auto_reload(tmp_path):
+    (tmp_path / "proxy.j2").write_text("first")
+    registry = TemplateRegistry(searchpath=tmp_path, auto_reload=True)
+    assert registry.render("proxy.j2") == "first"
+    (tmp_path / "proxy.j2").write_text("second")
+    os.utime(tmp_path / "proxy.j2", (time.time() + 10, time.time() + 10))
+    assert registry.render("proxy.j2") == "second"
+
+
+def test_template_registry_preloads_proxy_templates():
+    registry = TemplateRegistry()
+    registry.preload()
+    assert set(registry.templates) == {
+        "haproxy.cfg.j2", "haproxy_shared.cfg.j2", "nginx.conf.j2", "stunnel.conf.j2"
+    }
+
+
+def test_auto_tuning_sizes_buffers_for_bdp():
+    ## 12.5 MB/s over 80 ms is a 1 MB BDP
+    settings = resolve_tuning(scistream_pb2.Tuning(profile="auto", rtt_ms=80), rate=12500000)
+    assert settings["sndbuf"] == settings["rcvbuf"] == 2000000
+    assert settings["bufsize"] == 1000000
+    assert resolve_tuning(scistream_pb2.Tuning(profile="auto", rtt_ms=1000), rate=12500000)["bufsize"] == MAX_BUFSIZE
+    assert settings["splice"]
+
+
+def test_auto_tuning_reads_rtt_from_the_kernel(monkeypatch):
+    calls = []
+
+    def fake_run(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, "10.0.0.1 age 3.1sec cwnd 10 rtt 80000us rttvar 500us\n", "")
+
+    monkeypatch.setattr(s2ds_tuning.subprocess, "run", fake_run)
+    ## nothing may connect to the remote, it is the producer's data listener
+    monkeypatch.setattr(s2ds_tuning.socket, "create_connection", mock.Mock(side_effect=AssertionError))
+    settings = resolve_tuning(scistream_pb2.Tuning(profile="auto"), rate=12500000, remote="10.0.0.1:5100")
+    assert calls == [["ip", "tcp_metrics", "show", "10.0.0.1"]]
+    assert settings["bufsize"] == 1000000
+    monkeypatch.setattr(s2ds_tuning.subprocess, "run", mock.Mock(side_effect=FileNotFoundError))
+    assert s2ds_tuning.kernel_rtt("10.0.0.1:5100") is None
+
+
+def test_congestion_control_needs_to_be_allowed(monkeypatch, tmp_path):
+    opened = []
+    real_open = open
+
+    def fake_open(path, *args, **kwargs):
+        opened.append(path)
+        return real_open(tmp_path / "congestion", *args, **kwargs)
+
+    (tmp_path / "congestion").write_text("reno cubic\n")
+    monkeypatch.setattr(s2ds_tuning.os, "geteuid", lambda: 1000)
+    monkeypatch.setattr(s2ds_tuning, "open", fake_open, raising=False)
+    assert "congestion" not in resolve_tuning(scistream_pb2.Tuning(profile="wan"))
+    assert opened == ["/proc/sys/net/ipv4/tcp_allowed_congestion_control"]
+
+    ## a refused setsockopt leaves the socket usable
+    def setsockopt(level, option, value):
+        if option == getattr(socket, "TCP_CONGESTION", None):
+            raise PermissionError(1, "Operation not permitted")
+
+    sock = mock.Mock()
+    sock.setsockopt.side_effect = setsockopt
+    s2ds_tuning.tune_socket(sock, {"nodelay": True, "congestion": "bbr"})
+    assert sock.setsockopt.call_count == 2
+
+
+def test_tuning_fields_override_profile():
+    settings = resolve_tuning(scistream_pb2.Tuning(profile="wan", sndbuf=1 << 20, splice=False))
+    assert settings["sndbuf"] == 1 << 20
+    assert settings["rcvbuf"] == 16 * 1024 * 1024
+    assert settings["splice"] is False
+    assert resolve_tuning(None) == {}
+
+
+def test_tuning_error_rejects_unknown_profile():
+    assert tuning_error(scistream_pb2.Tuning(profile="lan")) is None
+    assert "Unknown tuning profile" in tuning_error(scistream_pb2.Tuning(profile="fast"))
+
+
+def test_tuning_rendered_in_haproxy_config(mock_home):
+    config = template_registry().render(
+        "haproxy.cfg.j2",
+        local_ports=[5100],
+        dest_array=["10.0.0.1:7000"],
+        tuning={"sndbuf": 4194304, "rcvbuf": 4194304, "bufsize": 262144, "splice": True},
+    )
+    assert "tune.sndbuf.client 4194304" in config
+    assert "tune.bufsize 262144" in config
+    assert "option splice-auto" in config
+    assert "splice" not in template_registry().render(
+        "haproxy.cfg.j2", local_ports=[5100], dest_array=["10.0.0.1:7000"]
+    )
+
+
+def test_wait_ready_probes_listeners():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        wait_ready([f"0.0.0.0:{server.getsockname()[1]}"], timeout=1)
+    with pytest.raises(S2DSException, match="not ready"):
+        wait_ready([f"127.0.0.1:{free_port()}"], timeout=0.2)
+
+
+def test_wait_ready_reports_crashed_proxy(tmp_path):
+    proc = SupervisedProcess(
+        [sys.executable, "-c", "print('cannot bind'); raise SystemExit(1)"], tmp_path / "proxy.log"
+    )
+    with pytest.raises(S2DSException, match="cannot bind"):
+        wait_ready([f"127.0.0.1:{free_port()}"], proc, timeout=5)
+
+
+@pytest.mark.timeout(10)
+def test_supervisor_restarts_with_backoff(tmp_path):
+    log_path = tmp_path / "proxy.log"
+    proc = SupervisedProcess([sys.executable, "-c", "print('up')"], log_path, backoff=0.05)
+    supervisor = Supervisor(interval=0.01)
+    supervisor.watch(proc)
+    while proc.restarts < 3:
+        time.sleep(0.01)
+    ## 0.05, 0.1 then 0.2 seconds
+    assert proc.backoff == pytest.approx(0.4)
+    proc.terminate()
+    restarts = proc.restarts
+    time.sleep(0.3)
+    assert proc.restarts == restarts
+    assert log_path.read_text().count("up") >= 3
+
+
+def test_rotate_log(tmp_path):
+    log_path = tmp_path / "proxy.log"
+    log_path.write_text("a" * 100)
+    assert not rotate_log(log_path, max_bytes=200)
+    assert rotate_log(log_path, max_bytes=50, backups=2)
+    log_path.write_text("b" * 100)
+    assert rotate_log(log_path, max_bytes=50, backups=2)
+    assert log_path.stat().st_size == 0
+    assert (tmp_path / "proxy.log.1").read_text() == "b" * 100
+    assert (tmp_path / "proxy.log.2").read_text() == "a" * 100
+
+
+## binds the port written in its config, again on SIGHUP, like a proxy reloading,
+## an idle config names the pidfile written once the handler is set
+FAKE_PROXY = """
+import os, signal, socket, sys, time
+servers = []
+def load(*args):
+    config = open(sys.argv[-1]).read().strip()
+    if config.isdigit():
+        server = socket.socket()
+        server.bind(("127.0.0.1", int(config)))
+        server.listen()
+        servers.append(server)
+    elif config.startswith("pid "):
+        open(config[4:], "w").write(str(os.getpid()))
+signal.signal(signal.SIGHUP, load)
+load()
+while True:
+    time.sleep(1)
+"""
+
+
+class FakeReloadingProxy(s2ds_subproc.AbstractSubprocess):
+    reload_signal = signal.SIGHUP
+
+    def __init__(self, logger=None):
+        super().__init__(logger)
+        self.command = [sys.executable, "-c", FAKE_PROXY]
+
+    def idle_config(self, prefix):
+        return f"pid {prefix}.pid"
+
+    def generate_config(self, uid, dest_array, role):
+        config_path = Path(get_config_path()) / f"{uid}.conf"
+        config_path.write_text(str(self.local_ports[0]))
+        return str(config_path)
+
+
+@pytest.mark.timeout(10)
+def test_pooled_proxy_is_activated_by_reload(mock_home):
+    uid = "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3"
+    proxy = FakeReloadingProxy()
+    proxy.prepare(2)
+    pool = process_pool(proxy)
+    while not pool.idle:
+        time.sleep(0.05)
+    idle_pid = pool.idle[0].pid
+    entry = proxy.start(1, "127.0.0.1", [free_port()])
+    proxy.update_listeners(["127.0.0.1:8000"], entry["s2ds_proc"], uid, "PROD")
+    try:
+        assert entry["s2ds_proc"][0].pid == idle_pid
+        assert (mock_home / ".scistream" / f"{uid}.log").exists()
+    finally:
+        proxy.release(entry)
+        pool.max_size = 0
+        pool.drain()
+
+
+def test_pool_waits_for_the_pidfile(mock_home, monkeypatch, caplog):
+    proxy = FakeReloadingProxy()
+    ## a worker that never gets ready is not handed out
+    monkeypatch.setattr(proxy, "idle_config", lambda prefix: "idle")
+    proxy.ready_timeout = 0.3
+    pool = ProcessPool(proxy, max_size=1)
+    pool.pending = 1
+    pool.add()
+    assert not pool.idle and pool.pending == 0
+    assert "did not write" in caplog.text
+
+
+def test_release_without_pool(mock_home, fake_popen, monkeypatch):
+    monkeypatch.setattr(process_pool, "_instances", {}, raising=False)
+    proxy = HaproxySubprocess()
+    entry = proxy.start(1, "127.0.0.1", [5100])
+    proxy.update_listeners(["127.0.0.1:6000"], entry["s2ds_proc"], "uid1", "PROD")
+    proxy.release(entry)
+    assert process_pool._instances == {}
+
+
+def test_arrival_rate_sizes_pool():
+    arrivals = ArrivalRate(window=30)
+    for _ in range(10):
+        arrivals.observe(now=100.0)
+    assert arrivals.rate(now=100.0) == pytest.approx(10 / 30)
+    ## a burst is forgotten after a few windows
+    assert arrivals.rate(now=190.0) < 0.5 / 30
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("splice", [True, False])
+def test_splice_relay_maps_every_port(splice):
+    relay = SpliceRelay()
+    servers = [socket.create_server(("127.0.0.1", 0)) for _ in range(2)]
+    ports = [free_port(), free_port()]
+    entry = relay.start(2, "127.0.0.1", ports, tuning=scistream_pb2.Tuning(splice=splice))
+    relay.update_listeners(
+        [f"127.0.0.1:{server.getsockname()[1]}" for server in servers],
+        entry["s2ds_proc"], "4f8583bc-a4d3-11ee-9fd6-034d1fcbd7c3", "PROD"
+    )
+    try:
+        for port, server in zip(ports, servers):
+            with socket.create_connection(("127.0.0.1", port), timeout=2) as client:
+                conn, _ = server.accept()
+                with conn:
+                    client.sendall(str(port).encode())
+                    client.shutdown(socket.SHUT_WR)
+                    assert recv_exact(conn, 10) == str(port).encode()
+    finally:
+        relay.release(entry)
+        for server in servers:
+            server.close()
+
+
+def test_backends_are_imported_lazily():
+    code = (
+        "import sys, src.s2ds.s2ds as s2ds\n"
+        "assert 'docker' not in sys.modules and 'unittest.mock' not in sys.modules\n"
+        "s2ds.create_instance('AsyncioRelay')\n"
+        "assert 'docker' not in sys.modules\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=Path(__file__).resolve().parent.parent)
+
+
+def test_backend_registry(monkeypatch):
+    monkeypatch.setattr(s2ds_registry, "BACKENDS", dict(s2ds_registry.BACKENDS))
+    s2ds_registry.register_backend("CustomRelay", "src.s2ds.relay:SpliceRelay")
+    assert isinstance(s2ds_registry.create_instance("CustomRelay"), SpliceRelay)
+    assert "CustomRelay" in s2ds_registry.backend_names()
+    assert isinstance(s2ds_registry.create_instance("NoSuchRelay"), s2ds_registry.MockS2DS)
+
+
+def test_backend_from_entry_point(monkeypatch):
+    monkeypatch.setattr(s2ds_registry, "BACKENDS", dict(s2ds_registry.BACKENDS))
+    monkeypatch.setattr(s2ds_registry, "_entry_points_loaded", False)
+    entry_point = importlib.metadata.EntryPoint(
+        name="PluginRelay", value="src.s2ds.relay:AsyncioRelay", group=s2ds_registry.ENTRY_POINT_GROUP
+    )
+    monkeypatch.setattr(
+        importlib.metadata, "entry_points",
+        lambda: importlib.metadata.EntryPoints([entry_point])
+    )
+    assert isinstance(s2ds_registry.create_instance("PluginRelay"), AsyncioRelay)
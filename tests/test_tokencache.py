@@ -0,0 +1,120 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.metrics import S2CSMetrics
+from src.proto.scistream_pb2 import Hello, Request, UpdateTargets
+from src.s2cs import S2CS
+from src.tokencache import TokenCache
+
+
+class StubAuthState:
+    def __init__(self, response):
+        self.response = response
+
+    @property
+    def identities(self):
+        if self.response is None:
+            return frozenset()
+        return frozenset(self.response["identity_set"])
+
+    def introspect_token(self):
+        return self.response
+
+
+class StubTokenChecker:
+    """Answers check_token from a fixed table instead of introspecting against Globus"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.calls = 0
+
+    def check_token(self, access_token):
+        self.calls += 1
+        return StubAuthState(self.tokens.get(access_token))
+
+
+class TokenContext(MagicMock):
+    def invocation_metadata(self):
+        return [("authorization", self.token)]
+
+    def abort(self, code, details):
+        raise ValueError(f"Aborted with code {code} and details {details}")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def servicer():
+    s2cs = S2CS(listener_ip="127.0.0.1", verbose=False, type="Mock", client_secret="secret")
+    s2cs.checker = StubTokenChecker(
+        {"Bearer good": {"identity_set": ["user"], "exp": time.time() + 3600}}
+    )
+    return s2cs
+
+
+@pytest.mark.timeout(5)
+def test_stream_setup_introspects_once(servicer):
+    context = TokenContext(token="Bearer good")
+    servicer.req(Request(uid="test_uid", role="PROD", num_conn=1, rate=1, detach=True), context)
+    servicer.hello(Hello(uid="test_uid", role="PROD", prod_listeners=["10.0.0.1:5000"]), context)
+    servicer.update(UpdateTargets(uid="test_uid", remote_listeners=["10.0.0.1:5000"], role="PROD"), context)
+    assert servicer.checker.calls == 1
+    assert servicer.metrics.token_cache_lookups.value(result="miss") == 1
+    assert servicer.metrics.token_cache_lookups.value(result="hit") == 2
+
+
+@pytest.mark.timeout(5)
+def test_invalid_token_is_negatively_cached(servicer):
+    context = TokenContext(token="Bearer bad")
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            servicer.req(Request(uid="test_uid", role="PROD", num_conn=1, rate=1), context)
+    assert servicer.checker.calls == 1
+    assert servicer.metrics.token_cache_lookups.value(result="negative_hit") == 2
+
+
+def test_token_expiry_bounds_ttl():
+    clock = FakeClock()
+    cache = TokenCache(max_ttl=300, clock=clock)
+    cache.put("short", True, exp=time.time() + 10)
+    cache.put("long", True, exp=time.time() + 3600)
+    cache.put("expired", True, exp=time.time() - 1)
+    assert cache.get("expired") is None
+    clock.now = 20
+    assert cache.get("short") is None
+    assert cache.get("long") is True
+    clock.now = 301
+    assert cache.get("long") is None
+
+
+def test_lru_eviction_metrics():
+    metrics = S2CSMetrics()
+    clock = FakeClock()
+    cache = TokenCache(maxsize=2, negative_ttl=5, metrics=metrics, clock=clock)
+    cache.put("first", True)
+    cache.put("second", False)
+    assert cache.get("first") is True
+    cache.put("third", True)
+    ## second was the least recently used
+    assert cache.get("second") is None
+    assert cache.get("first") is True
+    assert metrics.token_cache_evictions.value(reason="capacity") == 1
+    clock.now = 400
+    assert cache.get("third") is None
+    assert metrics.token_cache_evictions.value(reason="expired") == 1
+    assert "first" not in repr(cache.entries)
+
+
+def test_zero_ttl_disables_cache():
+    cache = TokenCache(max_ttl=0)
+    cache.put("good", True)
+    cache.put("bad", False)
+    assert len(cache) == 0